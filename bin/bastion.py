@@ -51,8 +51,8 @@ import vault
 
 import alter_path
 from lib import aws
-from lib.ssh import SSHConnection, vault_tunnel
-from lib.vault import Vault
+from lib.ssh import SSHConnection, vault_tunnel, tunnel_manager
+from lib.vault import Vault, unseal_all
 
 if __name__ == "__main__":
     def create_help(header, options):
@@ -60,7 +60,7 @@ if __name__ == "__main__":
         return "\n" + header + "\n" + \
                "\n".join(map(lambda x: "  " + x, options)) + "\n"
 
-    commands = ["ssh", "scp", "ssh-cmd", "ssh-tunnel", "ssh-all"]
+    commands = ["ssh", "scp", "ssh-cmd", "ssh-tunnel", "ssh-all", "scp-all"]
     commands.extend(vault.COMMANDS.keys())
     commands_help = create_help("command supports the following:", commands)
 
@@ -89,6 +89,10 @@ if __name__ == "__main__":
                         metavar = "<file>",
                         default = os.environ.get("SSH_KEY"),
                         help = "SSH private key to use when connecting to AWS instances (default: SSH_KEY)")
+    parser.add_argument("--parallel",
+                        default=8,
+                        type=int,
+                        help = "Number of machines that ssh-all / scp-all act on at the same time (default: 8)")
     parser.add_argument("--bastion","-b",  help="Hostname of the EC2 bastion server to create SSH Tunnels on")
     parser.add_argument("internal", help="Hostname of the EC2 internal server to create the SSH Tunnels to")
     parser.add_argument("command",
@@ -143,16 +147,36 @@ if __name__ == "__main__":
         sys.exit(ret)
     elif args.command in ("ssh-tunnel",):
         ssh.external_tunnel(*args.arguments)
-    elif args.command in ("ssh-all",):
+    elif args.command in ("ssh-all", "scp-all"):
         addrs = aws.machine_lookup_all(session, args.internal, public_ip=False)
-        for addr in addrs:
-            print("{} at {}".format(args.internal, addr))
-            ssh = SSHConnection(args.ssh_key, addr, bastion)
-            ssh.cmd(*args.arguments)
+        manager = tunnel_manager(args.ssh_key, bastion)
+        if args.command == "ssh-all":
+            command = " ".join(args.arguments) if args.arguments else input("command: ")
+            results = manager.run_all(addrs, command, args.user, args.parallel)
+        else:
+            if len(args.arguments) != 3 or args.arguments[2] not in ("upload", "download"):
+                print("Usage: scp-all <local file> <remote file> upload|download")
+                print("       when downloading, '{}' in <local file> is replaced by the machine's IP")
+                sys.exit(1)
+            local, remote, direction = args.arguments
+            results = manager.copy_all(addrs, local, remote, direction == "upload", args.user, args.parallel)
+
+        for result in results:
+            print("{} at {} (exit code {}, {:.1f}s)".format(args.internal, result.host, result.returncode, result.duration))
+            if result.stdout:
+                print(result.stdout, end="")
+            if result.stderr:
+                print(result.stderr, end="", file=sys.stderr)
             print()
+        sys.exit(max([r.returncode for r in results], default=0))
+    elif args.command == "vault-unseal" and not args.private_ip:
+        # Unseal all of the servers in the Vault cluster at the same time
+        addrs = aws.machine_lookup_all(session, args.internal, public_ip=False)
+        with vault_tunnel(args.ssh_key, bastion) as port:
+            unseal_all([Vault(args.internal, addr, proxy=port) for addr in addrs])
     elif args.command in vault.COMMANDS:
-        with vault_tunnel(args.ssh_key, bastion):
-            vault.COMMANDS[args.command](Vault(args.internal, private), *args.arguments)
+        with vault_tunnel(args.ssh_key, bastion) as port:
+            vault.COMMANDS[args.command](Vault(args.internal, private, proxy=port), *args.arguments)
     else:
         parser.print_usage()
         sys.exit(1)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A script to collect the firstboot timelines from all instances with a given
+hostname (like all instances in an auto scale group) and report the slowest
+steps and the critical path of each instance's boot.
+
+Environmental Variables:
+    AWS_CREDENTIALS : File path to a JSON encode file containing the following keys
+                      "aws_access_key" and "aws_secret_key"
+    SSH_KEY : File path to a SSH private key, protected as required by SSH,
+              (normally this means that the private key is only readable by the user)
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import alter_path
+from lib import aws
+from lib import boot_timeline
+from lib.ssh import tunnel_manager
+
+def collect(session, ssh_key, hostname, parallel):
+    """Read the timeline from every instance with the given hostname
+
+    Args:
+        session (Session) : Boto3 session used to lookup the instances
+        ssh_key (string) : Path to the SSH private key for the instances
+        hostname (string) : Hostname of the instances, like endpoint.integration.boss
+        parallel (int) : Number of instances to read from at the same time
+
+    Returns:
+        (dict) : Dictionary of {instance IP: list of step dictionaries}
+    """
+    domain = hostname.split(".", 1)[1]
+    bastion = aws.machine_lookup(session, "bastion." + domain)
+    ips = aws.machine_lookup_all(session, hostname, public_ip=False)
+    if len(ips) == 0:
+        print("Could not locate any instances named {}".format(hostname))
+        return {}
+
+    manager = tunnel_manager(ssh_key, bastion)
+    results = manager.run_all(ips, "cat {}".format(boot_timeline.TIMELINE_FILE), max_workers=parallel)
+
+    timelines = {}
+    for result in results:
+        if result.returncode != 0:
+            print("{}: could not read the timeline ({})".format(result.host, result.stderr.strip()))
+            continue
+        timelines[result.host] = boot_timeline.steps(boot_timeline.parse(result.stdout))
+    return timelines
+
+def print_report(timelines, count):
+    fmt = lambda s: "-" if s is None else "{:.1f}s".format(s)
+
+    print("Slowest steps across {} instances".format(len(timelines)))
+    print("{:<50}{:>10}{:>10}{:>10}{:>10}".format("Step", "p50", "p90", "max", "count"))
+    for name, p50, p90, max_, n in boot_timeline.slowest(timelines, count):
+        print("{:<50}{:>10}{:>10}{:>10}{:>10}".format(name, fmt(p50), fmt(p90), fmt(max_), n))
+    print()
+
+    for host in sorted(timelines):
+        steps = timelines[host]
+        path = boot_timeline.critical_path(steps)
+        finished = path[-1]['end'] if len(path) > 0 else None
+        print("{}: firstboot finished {} after boot".format(host, fmt(finished)))
+        for step in path:
+            print("    {:>8} {:>8}  {}/{} ({})".format(fmt(step['start']), fmt(step['duration']),
+                                                    step['script'], step['step'], step['status']))
+        for step in steps:
+            if step['status'] != 'ok':
+                print("    {}/{} {}".format(step['script'], step['step'], step['status']))
+        print()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Script to collect and report on the firstboot timelines of instances")
+    parser.add_argument("--aws-credentials", "-a",
+                        metavar = "<file>",
+                        default = os.environ.get("AWS_CREDENTIALS"),
+                        type = argparse.FileType('r'),
+                        help = "File with credentials to use when connecting to AWS (default: AWS_CREDENTIALS)")
+    parser.add_argument("--ssh-key", "-s",
+                        metavar = "<file>",
+                        default = os.environ.get("SSH_KEY"),
+                        help = "SSH private key to use when connecting to AWS instances (default: SSH_KEY)")
+    parser.add_argument("--parallel",
+                        metavar = "<count>",
+                        default = 8,
+                        type = int,
+                        help = "Number of instances to read from at the same time (default: 8)")
+    parser.add_argument("--top",
+                        metavar = "<count>",
+                        default = 10,
+                        type = int,
+                        help = "Number of slowest steps to show (default: 10)")
+    parser.add_argument("--output", "-o",
+                        metavar = "<file>",
+                        help = "Save the collected timelines as JSON to the given file")
+    parser.add_argument("hostname",
+                        help = "Hostname of the instances, such as endpoint.integration.boss")
+
+    args = parser.parse_args()
+
+    if args.aws_credentials is None:
+        parser.print_usage()
+        print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
+        sys.exit(1)
+
+    if args.ssh_key is None:
+        parser.print_usage()
+        print("Error: SSH key not provided and SSH_KEY is not defined")
+        sys.exit(1)
+
+    session = aws.create_session(args.aws_credentials)
+    timelines = collect(session, args.ssh_key, args.hostname, args.parallel)
+    if len(timelines) == 0:
+        sys.exit(1)
+
+    print_report(timelines, args.top)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(timelines, fh, indent=3, sort_keys=True)
@@ -26,6 +26,7 @@ import alter_path
 from lib import exceptions
 from lib import aws
 from lib import utils
+from lib import telemetry
 from lib.cloudformation import CloudFormationConfiguration
 from lib.stepfunctions import heaviside
 
@@ -34,16 +35,25 @@ cur_dir = os.path.dirname(os.path.realpath(__file__))
 cf_dir = os.path.normpath(os.path.join(cur_dir, '..', 'cloud_formation'))
 sys.path.append(cf_dir) # Needed for importing CF configs
 
+# Actions that are recorded in the timing history
+RECORDED_ACTIONS = ["create", "update", "delete", "post-init"]
+
 def call_config(session, domain, config, func_name):
     """Import 'configs.<config>' and then call the requested function with
     <session> and <domain>.
     """
     module = importlib.import_module("configs." + config)
 
+    # Replace the module's functions so that calls made from within the
+    # config's create / update functions are also timed
+    for name, phase in [('create_config', 'template'), ('post_init', 'post-init')]:
+        if name in module.__dict__:
+            setattr(module, name, telemetry.timed(phase, module.__dict__[name]))
+
     if func_name in module.__dict__:
-        module.__dict__[func_name](session, domain)
+        return module.__dict__[func_name](session, domain)
     elif func_name == 'delete':
-        CloudFormationConfiguration(config, domain).delete(session)
+        return CloudFormationConfiguration(config, domain).delete(session)
     else:
         print("Configuration '{}' doesn't implement function '{}'".format(config, func_name))
 
@@ -58,7 +68,7 @@ if __name__ == '__main__':
     config_names = [x.split('/')[1].split('.')[0] for x in glob.glob("configs/*.py") if "__init__" not in x]
     config_help = create_help("config_name supports the following:", config_names)
 
-    actions = ["create", "update", "delete", "post-init", "pre-init", "generate"]
+    actions = ["create", "update", "delete", "post-init", "pre-init", "generate", "report"]
     actions_help = create_help("action supports the following:", actions)
 
     scenarios = ["development", "production", "ha-development"]
@@ -84,11 +94,14 @@ if __name__ == '__main__':
     parser.add_argument("--disable-preview",
                         action = "store_true",
                         help = "Disable update previews change sets (default: enable)"),
+    parser.add_argument("--upload-template",
+                        action = "store_true",
+                        help = "Always upload the template to S3 and use a TemplateURL (default: only templates too large for a TemplateBody)")
     parser.add_argument("action",
                         choices = actions,
                         metavar = "action",
                         help = "Action to execute")
-    parser.add_argument("domain_name", help="Domain in which to execute the configuration (example: subnet.vpc.boss)")
+    parser.add_argument("domain_name", help="Domain in which to execute the configuration (example: subnet.vpc.boss, 'all' for report)")
     parser.add_argument("config_name",
                         choices = config_names,
                         metavar = "config_name",
@@ -96,6 +109,11 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.action == "report":
+        domain = None if args.domain_name == "all" else args.domain_name
+        telemetry.report(args.config_name, domain)
+        sys.exit(0)
+
     if args.aws_credentials is None:
         parser.print_usage()
         print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
@@ -104,12 +122,19 @@ if __name__ == '__main__':
     os.environ["AMI_VERSION"] = args.ami_version
     os.environ["SCENARIO"] = args.scenario
     os.environ["DISABLE_PREVIEW"] = str(args.disable_preview)
+    os.environ["UPLOAD_TEMPLATE"] = str(args.upload_template)
 
     session = aws.create_session(args.aws_credentials)
 
+    if args.action in RECORDED_ACTIONS:
+        telemetry.start(args.config_name, args.domain_name, args.action,
+                        args.scenario, utils.get_commit(), session)
+
+    outcome = "error"
     try:
         func = args.action.replace('-','_')
         ret = call_config(session, args.domain_name, args.config_name, func)
+        outcome = "failure" if ret == False else "success"
         if ret == False:
             sys.exit(1)
         else:
@@ -146,3 +171,5 @@ if __name__ == '__main__':
         print("Fix the problem, then run the following command:")
         print("\t" + utils.get_command("post-init"))
         sys.exit(2)
+    finally:
+        telemetry.finish(outcome)
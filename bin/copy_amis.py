@@ -17,45 +17,193 @@
 """
 Script will copy the AMIs - This is useful at the end of a sprint when you want to make
 AMIs to with the sprint name.
+
+All of the AMIs are located with a single describe_images call (using the
+AMI catalog from lib/aws.py) and copied at the same time, optionally to
+multiple regions.  The script then waits for all of the copies to become
+available, printing a progress table as they do.
 """
 
 import argparse
 import sys
 import os
-import pprint
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
 
 import alter_path
 from lib import aws
 from lib import hosts
 from lib.names import AWSNames
 
-AMIS = ["endpoint.boss", "cachemanager.boss", "proofreader-web.boss", "auth.boss", "vault.boss", "consul.boss", "activities.boss"]
+AMIS = ["endpoint.neurodata", "cachemanager.neurodata", "proofreader-web.neurodata", "auth.neurodata",
+        "vault.neurodata", "consul.neurodata", "activities.neurodata"]
+
+COPY_WORKERS = 8 # number of copy_image calls to make at the same time
+POLL_INITIAL = 15 # seconds between the first checks of the copies' state
+POLL_MAX_INTERVAL = 120 # maximum seconds between checks of the copies' state
+COPY_TIMEOUT = 60 * 60 # seconds to wait for all copies to become available
+
+
+def lookup_amis(session, prefixes, ami_ending):
+    """Locate the AMI for each prefix using the account's AMI catalog
+
+    Uses the same rules as aws.ami_lookup(): ami_ending can be 'latest' (the
+    newest '<prefix>-h<hash>' AMI), the ending of an AMI name, or a build
+    name that an existing AMI was tagged with when a build was skipped.
+    Unlike aws.ami_lookup() a missing version doesn't fall back to 'latest'.
+
+    Args:
+        session (Session): boto3 session for the source region
+        prefixes (list): List of AMI name prefixes
+        ami_ending (str): short hash attached to AMIs to copy from
+
+    Returns:
+        (dict): Dictionary of {prefix: EC2 image or None if not found}
+    """
+    catalog = aws.ami_catalog(session)
+    return {prefix: catalog.lookup(prefix, ami_ending) for prefix in prefixes}
+
+def copy_ami(client, source_region, image, name):
+    """Copy an AMI and its tags
+
+    Args:
+        client (EC2.Client): boto3 EC2 client for the target region
+        source_region (str): Region of the AMI being copied
+        image (dict): EC2 image to copy
+        name (str): Name of the new AMI
+
+    Returns:
+        (str): Id of the new AMI
+    """
+    response = client.copy_image(SourceRegion=source_region,
+                                 SourceImageId=image['ImageId'],
+                                 Name=name,
+                                 Description="Copied from ami id {}".format(image['ImageId']))
+    ami_id = response['ImageId']
+
+    # Alias tags only apply to the source AMI
+    tags = [t for t in image.get('Tags', []) if not t['Key'].startswith(aws.ALIAS_TAG_PREFIX)]
+    if len(tags) > 0:
+        # The new AMI id may not be visible to create_tags immediately
+        for attempt in range(5):
+            try:
+                client.create_tags(Resources=[ami_id], Tags=tags)
+                break
+            except ClientError as ex:
+                if ex.response['Error']['Code'] != 'InvalidAMIID.NotFound' or attempt == 4:
+                    raise
+                time.sleep(2 ** attempt)
+    return ami_id
+
+def print_progress(copies, start):
+    """Print a table of the state of each copy"""
+    print("{:<35}{:<12}{:<24}{:<12}{:>8}".format("Name", "Region", "AMI", "State", "Time"))
+    for copy in copies:
+        elapsed = (copy['finished'] or time.time()) - start
+        print("{:<35}{:<12}{:<24}{:<12}{:>7.0f}s".format(copy['name'],
+                                                        copy['region'],
+                                                        copy['ami'] or "-",
+                                                        copy['state'],
+                                                        elapsed))
+    print()
+
+def wait_for_copies(clients, copies, start, timeout=COPY_TIMEOUT):
+    """Wait for all copies to finish, checking all copies in a region with a
+    single describe_images call and backing off between checks
+
+    Args:
+        clients (dict): Dictionary of {region: EC2.Client}
+        copies (list): List of copy dictionaries, updated with the current state
+        start (float): Time the copies were started
+        timeout (int): Number of seconds to wait for the copies
+    """
+    interval = POLL_INITIAL
+    while True:
+        pending = [c for c in copies if c['state'] == 'pending']
+        if len(pending) == 0:
+            return
+
+        if time.time() - start > timeout:
+            print("Copies not available after {} seconds".format(timeout))
+            return
+
+        time.sleep(interval)
+        interval = min(interval * 2, POLL_MAX_INTERVAL)
+
+        changed = False
+        for region in set(c['region'] for c in pending):
+            by_id = {c['ami']: c for c in pending if c['region'] == region}
+            try:
+                response = clients[region].describe_images(ImageIds=list(by_id))
+            except ClientError as ex:
+                # New AMI ids may not be visible yet
+                print("Could not check the copies in {}: {}".format(region, ex))
+                continue
+            for image in response['Images']:
+                copy = by_id[image['ImageId']]
+                if image['State'] != copy['state']:
+                    copy['state'] = image['State']
+                    copy['finished'] = time.time()
+                    changed = True
 
+        if changed:
+            print_progress(copies, start)
 
-def copy_amis(session, ami_ending, new_ami_ending):
+def copy_amis(session, ami_ending, new_ami_ending, regions=None, wait=True, timeout=COPY_TIMEOUT):
     """
-    changes Route53 entry for the api in domain to use cloudfront for the s3 maintenance bucket.
+    Copy the AMIs with the given ending to new AMIs with the new ending.
     Args:
         session(Session): boto3 session object
         ami_ending(str): short hash attached to AMIs to copy from
         new_ami_ending(str): new post_name to assign AMI copies.
+        regions(None|list): regions to copy the AMIs to (default: the session's region)
+        wait(bool): if the copies should be waited on until they are available
+        timeout(int): number of seconds to wait for the copies
 
     Returns:
-        Nothing
+        (bool): If all copies were successful
     """
-    client = session.client("ec2")
+    source_region = session.region_name
+    regions = regions or [source_region]
+    clients = {region: session.client("ec2", region_name=region) for region in regions}
+
+    images = lookup_amis(session, AMIS, ami_ending)
     for prefix in AMIS:
-        (ami_id, hash) = aws.ami_lookup(session, prefix, version=ami_ending)
-        print(str(ami_id))
+        if images[prefix] is None:
+            print("Could not locate AMI '{}-{}'".format(prefix, ami_ending))
+        else:
+            print("{} -> {}".format(images[prefix]['Name'], images[prefix]['ImageId']))
+
+    copies = [{'name': prefix + "-" + new_ami_ending,
+               'region': region,
+               'image': images[prefix],
+               'ami': None,
+               'state': 'pending',
+               'finished': None}
+              for region in regions for prefix in AMIS if images[prefix] is not None]
+
+    def submit(copy):
         try:
-            response = client.copy_image(SourceRegion=session.region_name,
-                                         SourceImageId=ami_id,
-                                         Name=prefix + "-" + new_ami_ending,
-                                         Description="Copied from ami id {}".format(ami_id))
-            pprint.pprint(response)
-        except:
+            copy['ami'] = copy_ami(clients[copy['region']], source_region, copy['image'], copy['name'])
+        except Exception:
             traceback.print_exc()
+            copy['state'] = 'error'
+            copy['finished'] = time.time()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+        list(executor.map(submit, copies))
+    print_progress(copies, start)
+
+    if wait:
+        wait_for_copies(clients, copies, start, timeout)
+
+    done = ('available',) if wait else ('available', 'pending')
+    missing = [prefix for prefix in AMIS if images[prefix] is None]
+    return len(missing) == 0 and all(c['state'] in done for c in copies)
 
 
 
@@ -78,6 +226,20 @@ def create_parser():
                         default=os.environ.get("AWS_CREDENTIALS"),
                         type=argparse.FileType('r'),
                         help="File with credentials to use when connecting to AWS (default: AWS_CREDENTIALS)")
+    parser.add_argument("--region", "-r",
+                        metavar="<region>",
+                        action="append",
+                        dest="regions",
+                        help="Region to copy the AMIs to, can be given multiple times (default: the credentials' region)")
+    parser.add_argument("--no-wait",
+                        action="store_false",
+                        dest="wait",
+                        help="Don't wait for the copies to become available")
+    parser.add_argument("--timeout",
+                        metavar="<seconds>",
+                        type=int,
+                        default=COPY_TIMEOUT,
+                        help="How long to wait for the copies to become available (default: {})".format(COPY_TIMEOUT))
     parser.add_argument("ami_ending",
                         help="ami_ending ex: hc1ea3281 or latest")
     parser.add_argument("new_ami_ending",
@@ -98,5 +260,5 @@ if __name__ == '__main__':
         sys.exit(1)
 
     session = aws.create_session(args.aws_credentials)
-    copy_amis(session, args.ami_ending, args.new_ami_ending)
-
+    if not copy_amis(session, args.ami_ending, args.new_ami_ending, args.regions, args.wait, args.timeout):
+        sys.exit(1)
@@ -18,6 +18,17 @@
 Script that creates a simple interface (with minimal commandline arguments) for
 building VM images using Packer and SaltStack.
 
+Each image is tagged with a fingerprint of the Salt states, pillars, and
+Packer files it was built from (see lib/fingerprint.py). If an AMI with the
+same fingerprint already exists the build is skipped and the existing AMI is
+tagged with the new build name instead.
+
+Images are built in two stages. First the boss-base image, containing the Salt
+states common to most images, is built from the Ubuntu AMI (or reused if it is
+unchanged). Then the role images are built from the boss-base AMI at the same
+time, so each only has to apply its role specific states. The role builds
+skip the Salt bootstrap, as Salt is already installed in the boss-base AMI.
+
 Author:
     Derek Pryor <Derek.Pryor@jhuapl.edu>
 """
@@ -34,9 +45,18 @@ from boto3.session import Session
 
 import alter_path
 from lib.constants import repo_path
+from lib.fingerprint import fingerprint
+from lib.aws import ALIAS_TAG_PREFIX
 
 os.environ["PATH"] += ":" + repo_path("bin") # allow executing Packer from the bin/ directory
 
+# The config for the image with the Salt states common to all role images,
+# which the role images are built from
+BASE_CONFIG = "boss-base"
+
+# Configs that are built directly from the Ubuntu AMI instead of the base image
+UNLAYERED_CONFIGS = ["lambda"]
+
 def get_commit():
     """Figure out the commit hash of the current git revision.
         Note: Only works if the CWD is a git repository
@@ -57,40 +77,85 @@ def execute(cmd, output_file):
     """
     return subprocess.Popen(shlex.split(cmd), stderr=subprocess.STDOUT, stdout=open(output_file, "w"))
 
-def locate_ami(aws_config):
+def create_session(aws_config):
+    with open(aws_config) as fh:
+        cred = json.load(fh)
+        return Session(aws_access_key_id = cred["aws_access_key"],
+                       aws_secret_access_key = cred["aws_secret_key"],
+                       region_name = 'us-east-1')
+
+def locate_ami(session):
     def contains(x, ys):
         for y in ys:
             if y not in x:
                 return False
         return True
 
-    with open(aws_config) as fh:
-        cred = json.load(fh)
-        session = Session(aws_access_key_id = cred["aws_access_key"],
-                          aws_secret_access_key = cred["aws_secret_key"],
-                          region_name = 'us-east-1')
-
-        client = session.client('ec2')
-        response = client.describe_images(Filters=[
-                        {"Name": "owner-id", "Values": ["099720109477"]},
-                        {"Name": "virtualization-type", "Values": ["hvm"]},
-                        {"Name": "root-device-type", "Values": ["ebs"]},
-                        {"Name": "architecture", "Values": ["x86_64"]},
-                        #{"Name": "platform", "Values": ["Ubuntu"]},
-                        #{"Name": "name", "Values": ["hvm-ssd"]},
-                        #{"Name": "name", "Values": ["14.04"]},
-                   ])
-
-        images = response['Images']
-        images = [i for i in images if contains(i['Name'], ('hvm-ssd', '14.04', 'server'))]
-        images.sort(key=lambda x: x["CreationDate"], reverse=True)
-
-        if len(images) == 0:
-            print("Error: could not locate base AMI, exiting ....")
-            sys.exit(1)
+    client = session.client('ec2')
+    response = client.describe_images(Filters=[
+                    {"Name": "owner-id", "Values": ["099720109477"]},
+                    {"Name": "virtualization-type", "Values": ["hvm"]},
+                    {"Name": "root-device-type", "Values": ["ebs"]},
+                    {"Name": "architecture", "Values": ["x86_64"]},
+                    #{"Name": "platform", "Values": ["Ubuntu"]},
+                    #{"Name": "name", "Values": ["hvm-ssd"]},
+                    #{"Name": "name", "Values": ["14.04"]},
+               ])
+
+    images = response['Images']
+    images = [i for i in images if contains(i['Name'], ('hvm-ssd', '14.04', 'server'))]
+    images.sort(key=lambda x: x["CreationDate"], reverse=True)
+
+    if len(images) == 0:
+        print("Error: could not locate base AMI, exiting ....")
+        sys.exit(1)
+
+    print("Using {}".format(images[0]['Name']))
+    return images[0]['ImageId']
+
+def config_name(config):
+    """Get the machine name from a Packer variable file
+
+    Args:
+        config (string) : Name of the Packer variable file
+
+    Returns:
+        (string) : The machine name, which is also the Salt minion id
+    """
+    with open(repo_path("packer", "variables", config)) as fh:
+        return json.load(fh)["name"]
+
+def find_fingerprint(session, name, fingerprint):
+    """Find an existing AMI built from inputs with the given fingerprint
+
+    Args:
+        session (Session) : Boto3 session used to lookup AMIs
+        name (string) : Packer config name, used to limit the search to the config's AMIs
+        fingerprint (string) : Fingerprint of the build inputs
 
-        print("Using {}".format(images[0]['Name']))
-        return images[0]['ImageId']
+    Returns:
+        (dict|None) : The newest matching EC2 image or None if there is no match
+    """
+    client = session.client('ec2')
+    response = client.describe_images(Owners=['self'],
+                                      Filters=[{"Name": "name", "Values": [name + ".neurodata-*"]},
+                                               {"Name": "tag:Fingerprint", "Values": [fingerprint]}])
+    images = [i for i in response['Images'] if i['State'] == 'available']
+    images.sort(key=lambda x: x["CreationDate"], reverse=True)
+    return images[0] if len(images) > 0 else None
+
+def alias_ami(session, image, build_name, commit):
+    """Tag an existing AMI so it can be located using a new build name
+
+    Args:
+        session (Session) : Boto3 session used to tag the AMI
+        image (dict) : The EC2 image to tag
+        build_name (string) : The build name the image should also be located by
+        commit (string) : Commit hash of the current git revision
+    """
+    client = session.client('ec2')
+    client.create_tags(Resources=[image['ImageId']],
+                       Tags=[{"Key": ALIAS_TAG_PREFIX + build_name, "Value": commit}])
 
 if __name__ == '__main__':
     for cmd in ("git", "packer"):
@@ -133,6 +198,15 @@ if __name__ == '__main__':
                         default = True,
                         dest="bastion",
                         help = "Don't use the aws-bastion file when building. (default: Use the bastion)")
+    parser.add_argument("--no-base",
+                        action = "store_false",
+                        default = True,
+                        dest = "base",
+                        help = "Build every image from the Ubuntu AMI. (default: Build role images from the {} AMI)".format(BASE_CONFIG))
+    parser.add_argument("--force",
+                        action = "store_true",
+                        default = False,
+                        help = "Build even if an AMI was already built from the same inputs. (default: Skip unchanged images)")
     parser.add_argument("config",
                         choices = config_help_names,
                         metavar = "<config>",
@@ -141,8 +215,13 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if not args.base and BASE_CONFIG in args.config:
+        parser.error("--no-base cannot be used when building the {} config".format(BASE_CONFIG))
+
     if "all" in args.config:
         args.config = config_names
+        if not args.base:
+            args.config.remove(BASE_CONFIG)
 
     bastion_config = "-var-file=" + repo_path("config", "aws-bastion")
     credentials_config = repo_path("config", "aws-credentials")
@@ -156,12 +235,14 @@ if __name__ == '__main__':
     if not os.path.isdir(packer_logs):
         os.mkdir(packer_logs)
 
-    ami = locate_ami(credentials_config)
+    session = create_session(credentials_config)
+    ami = locate_ami(session)
 
     cmd = """{packer} build
              {bastion} -var-file={credentials}
              -var-file={machine} -var 'name_suffix={name}'
              -var 'commit={commit}' -var 'force_deregister={deregister}'
+             -var 'fingerprint={fingerprint}' -var 'skip_bootstrap={skip_bootstrap}'
              -var 'aws_source_ami={ami}' -only={only} {packer_file}"""
     cmd_args = {
         "packer" : "packer",
@@ -173,15 +254,69 @@ if __name__ == '__main__':
         "commit" : git_hash,
         "ami" : ami,
         "deregister" : "true" if args.name in ["test", "sandy", "dean"] else "false",
-        "machine" : "" # replace for each call
+        "machine" : "", # replace for each call
+        "fingerprint" : "", # replace for each call
+        "skip_bootstrap" : "false", # replace for each call
     }
 
-    procs = []
-    for config in args.config:
+    def launch(config, source_ami, layered=False):
+        """Launch the build of the given config from the given AMI
+
+        Layered builds skip installing cURL and bootstrapping Salt, as the
+        base AMI already has both.
+
+        Returns:
+            (tuple) : (Popen or None if the config is unchanged and was skipped, fingerprint)
+        """
+        machine = repo_path("packer", "variables", config)
+        name = config_name(config)
+
+        # Skip images where none of the inputs changed since the last build
+        skip_bootstrap = "true" if layered else "false"
+        fp = fingerprint(machine, {"aws_source_ami": source_ami, "skip_bootstrap": skip_bootstrap})
+        image = find_fingerprint(session, name, fp)
+        if image is not None and not args.force:
+            print("Skipping {} configuration, unchanged since {} ({})".format(config, image['Name'], image['ImageId']))
+            if image['Name'] != "{}.neurodata-{}".format(name, args.name):
+                alias_ami(session, image, args.name, git_hash)
+            return None, fp
+
         print("Launching {} configuration".format(config))
         log_file = os.path.join(packer_logs, config + ".log")
-        cmd_args["machine"] = repo_path("packer", "variables", config)
-        proc = execute(cmd.format(**cmd_args), log_file)
+        proc = execute(cmd.format(**dict(cmd_args, machine=machine, fingerprint=fp, ami=source_ami,
+                                         skip_bootstrap=skip_bootstrap)), log_file)
+        return proc, fp
+
+    # Stage 1: build or reuse the base image shared by the role images
+    configs = [c for c in args.config if c != BASE_CONFIG]
+    layered = [c for c in configs if c not in UNLAYERED_CONFIGS] if args.base else []
+    if args.base and (BASE_CONFIG in args.config or len(layered) > 0):
+        proc, fp = launch(BASE_CONFIG, ami)
+        if proc is not None:
+            print("Waiting for the {} build to finish".format(BASE_CONFIG))
+            try:
+                proc.wait()
+            except KeyboardInterrupt: # <CTRL> + c
+                print("Killing build")
+                proc.kill()
+                sys.exit(1)
+
+        image = find_fingerprint(session, config_name(BASE_CONFIG), fp)
+        if image is None:
+            print("Error: could not locate the {} AMI, check packer/logs/{}.log".format(BASE_CONFIG, BASE_CONFIG))
+            sys.exit(1)
+        base_ami = image['ImageId']
+        print("Using {} ({}) for {}".format(image['Name'], base_ami, ", ".join(layered)))
+
+    # Stage 2: build the role images, all at the same time by default
+    procs = []
+    for config in configs:
+        if config in layered:
+            proc, _ = launch(config, base_ami, layered=True)
+        else:
+            proc, _ = launch(config, ami)
+        if proc is None:
+            continue
 
         if args.single_thread:
             print("Waiting for build to finish")
@@ -19,26 +19,43 @@ Update an existing lambda function.  Note, that the lambda handler function
 is not changed.
 
 load_lambdas_on_s3() zips spdb, bossutils, lambda, and lambda_utils as found
-in boss-manage's submodules and places it on the lambda build server.  Next,
-makedomainenv is run on the lambda build server to create the virtualenv for
-the lambda function.  Finally, the virutalenv is zipped and uploaded to S3.
+in boss-manage's submodules and copies the zip to the lambda build server,
+where the domain's ndingest settings are added to it.  The zip is built
+deterministically (see lib/zip.py), so it is only transferred if its contents
+changed and, if no files changed since the last build for the domain, the
+build is skipped.  Next, makedomainenv is run on the lambda build server to
+create the virtualenv for the lambda function.  Finally, the virutalenv is
+zipped and uploaded to S3.
 
 update_lambda_code() tells AWS to point the existing lambda function at the
-new zip in S3.
+new zip in S3. If the zip is already deployed the update is skipped.
+
+Multiple domains can be updated at once.  The zip of the files shared by all
+domains is built and copied to the lambda build server once, then each
+domain's settings are generated and copied, its zip built, and its function
+updated at the same time.  How long each step took for each domain is printed
+at the end.
 """
 import alter_path
-from lib.ssh import SSHConnection
+from lib.ssh import ControlMaster
+from lib.zip import build_zip
 from lib.names import AWSNames
 from lib import aws
 from lib import utils
 from lib import constants as const
-from lib import zip
 
 import argparse
 import configparser
+import hashlib
+import json
 import os
 import sys
-import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
 
 # This was an attempt to import CUBOIDSIZE from the spdb repo.  Can't import
 # without a compiling spdb's C library.
@@ -60,6 +77,20 @@ NDINGEST_SETTINGS_FOLDER = const.repo_path('salt_stack', 'salt', 'ndingest', 'fi
 # Template used for ndingest settings.ini generation.
 NDINGEST_SETTINGS_TEMPLATE = NDINGEST_SETTINGS_FOLDER + '/settings.ini'
 
+# Location of the generated settings.ini in the lambda zip
+NDINGEST_SETTINGS_NAME = 'ndingest.git/settings/settings.ini'
+
+# Location of the zip of the local modules on the lambda build server, this
+# must match the name used in the makedomainenv script
+SITE_ZIP = 'sitezips/{}.zip'
+
+# Locations on the lambda build server of the zip of the files shared by all
+# domains and of each domain's generated settings
+SHARED_ZIP = 'sitezips/shared.zip'
+SETTINGS_DIR = 'sitezips/settings/{}'
+
+LAMBDA_WORKERS = 8 # number of domains to build or update at the same time
+
 def get_lambda_zip_name(domain):
     """Get name of zip file containing lambda.
 
@@ -74,78 +105,380 @@ def get_lambda_zip_name(domain):
     """
     return 'multilambda.{}.zip'.format(domain)
 
-def update_lambda_code(session, domain, bucket):
+def get_build_cache(domain):
+    """Get the cached information about the last build for the domain.
+
+    Args:
+        domain (string): The VPC's domain name such as integration.boss.
+
+    Returns:
+        (dict): Dictionary with the 'inputs' hash, the 'bucket', and the
+                'artifact' CodeSha256 of the last build or an empty dictionary
+    """
+    try:
+        with open(utils.cache_path('lambda', domain + '.json'), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def save_build_cache(domain, cache):
+    with open(utils.cache_path('lambda', domain + '.json'), 'w') as fh:
+        json.dump(cache, fh, indent=4)
+
+def hash_inputs(sources, prefix=''):
+    """Hash the contents of all of the files that are built into the lambda zip.
+
+    Args:
+        sources (dict): Dictionary of {name in the zip: local file or directory path}
+        prefix (string): Value to include in the hash, such as the hash of other inputs
+
+    Returns:
+        (string): Hex digest of the hash of all of the files
+    """
+    manifest = utils.build_manifest(sources)
+    hash = hashlib.sha256(prefix.encode())
+    for name in sorted(manifest):
+        hash.update('{} {}\n'.format(name, manifest[name][0]).encode())
+    return hash.hexdigest()
+
+@contextmanager
+def timer(timings, step):
+    """Record how long the code executed within the context took as timings[step]"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[step] = time.time() - start
+
+def lambda_sources():
+    """Get the local files that are built into the lambda zip for every domain.
+
+    Returns:
+        (dict): Dictionary of {name in the zip: local file or directory path}
+    """
+    boss_tools = const.repo_path("salt_stack", "salt", "boss-tools", "files", "boss-tools.git")
+    return {
+        'spdb.git': const.repo_path("salt_stack", "salt", "spdb", "files", "spdb.git"),
+        'bossutils': os.path.join(boss_tools, 'bossutils'),
+        'lambda': os.path.join(boss_tools, 'lambda'),
+        'lambdautils': os.path.join(boss_tools, 'lambdautils'),
+        'ndingest.git': const.repo_path("salt_stack", "salt", "ndingest", "files", "ndingest.git"),
+    }
+
+def update_lambda_code(session, domain, bucket, code_sha256=None):
+    """Point the domain's multilambda function at the zip in S3.
+
+    Args:
+        session (Session): boto3.Session
+        domain (string): The VPC's domain name such as integration.boss.
+        bucket (string): S3 bucket containing the lambda zip
+        code_sha256 (None|string): Base64 encoded SHA256 of the lambda zip, if
+                                   it matches the deployed code the update is skipped
+    """
     names = AWSNames(domain)
     client = session.client('lambda')
+    if code_sha256 is not None:
+        deployed = client.get_function_configuration(FunctionName=names.multi_lambda)['CodeSha256']
+        if deployed == code_sha256:
+            print("{}: Lambda code is already deployed, skipping update".format(domain))
+            return
+
     resp = client.update_function_code(
         FunctionName=names.multi_lambda,
         S3Bucket=bucket,
         S3Key=get_lambda_zip_name(domain),
         Publish=True)
-    print(resp)
+    print("{}: Updated {} to version {}".format(domain, resp['FunctionName'], resp['Version']))
+
+def prepare_domain(session, domain, bucket, shared_inputs, force, timings):
+    """Generate the domain's ndingest settings and check if the domain's
+    lambda zip needs to be built.
+
+    Args:
+        session (Session): boto3.Session
+        domain (string): The VPC's domain name such as integration.boss.
+        bucket (string): S3 bucket to upload the lambda zip to
+        shared_inputs (string): Hash of the files shared by all domains, from hash_inputs()
+        force (bool): Build even if nothing has changed
+        timings (dict): Dictionary to record the step timings in
+
+    Returns:
+        (tuple): (settings.ini path, hash of all inputs, if a build is needed, cached CodeSha256)
+    """
+    with timer(timings, 'settings'):
+        settings = utils.cache_path('lambda', domain, 'settings.ini')
+        with open(NDINGEST_SETTINGS_TEMPLATE, 'r') as tmpl:
+            create_ndingest_settings(domain, tmpl, settings)
+
+    with timer(timings, 'check'):
+        inputs = hash_inputs({NDINGEST_SETTINGS_NAME: settings}, shared_inputs)
+        cache = get_build_cache(domain)
+        if not force and cache.get('inputs') == inputs and cache.get('bucket') == bucket:
+            try:
+                session.client('s3').head_object(Bucket=bucket, Key=get_lambda_zip_name(domain))
+                print("{}: Lambda code unchanged since the last build, skipping build".format(domain))
+                return settings, inputs, False, cache.get('artifact')
+            except ClientError:
+                print("{}: Lambda zip missing from S3, rebuilding".format(domain))
+
+    return settings, inputs, True, None
+
+def upload_shared(master, sources, timings):
+    """Zip the files shared by all domains and copy the zip to the lambda
+    build server, if it changed.
+
+    Args:
+        master (ControlMaster): Connection to the lambda build server
+        sources (dict): Local modules, from lambda_sources()
+        timings (dict): Dictionary to record the step timings in
+
+    Raises:
+        Exception: If the zip could not be copied
+    """
+    with timer(timings, 'zip'):
+        local_zip = utils.cache_path('lambda', 'shared.zip')
+        digest = build_zip([(path, name) for name, path in sorted(sources.items())], local_zip)
+
+    with timer(timings, 'upload'):
+        result = master.run('sha256sum {} 2> /dev/null'.format(SHARED_ZIP))
+        if result.returncode == 0 and result.stdout.split()[:1] == [digest]:
+            print("Zip of the local modules unchanged on lambda-build-server")
+            return
+
+        print("Copying the zip of the local modules to lambda-build-server")
+        result = master.copy(local_zip, SHARED_ZIP + '.tmp', upload=True)
+        if result.returncode == 0:
+            result = master.run('mv {0}.tmp {0}'.format(SHARED_ZIP))
+        if result.returncode != 0:
+            raise Exception("Could not copy the lambda code: {}".format(result.stderr.strip()))
+
+def build_domain(master, domain, bucket, settings, inputs, timings):
+    """Sync the domain's settings to the lambda build server, add them to a
+    copy of the shared zip, and run makedomainenv.
+
+    The output of makedomainenv is saved in the local cache directory.
+
+    Args:
+        master (ControlMaster): Connection to the lambda build server
+        domain (string): The VPC's domain name such as integration.boss.
+        bucket (string): S3 bucket to upload the lambda zip to
+        settings (string): Path to the domain's generated settings.ini
+        inputs (string): Hash of all of the inputs, saved in the build cache
+        timings (dict): Dictionary to record the step timings in
+
+    Returns:
+        (string): Base64 encoded SHA256 of the lambda zip, as reported by
+                  Lambda's CodeSha256
+
+    Raises:
+        Exception: If the zip could not be created, built, or uploaded
+    """
+    with timer(timings, 'zip'):
+        # Only transferred if the settings changed since the last build
+        settings_dir = SETTINGS_DIR.format(domain)
+        master.sync({NDINGEST_SETTINGS_NAME: settings}, settings_dir)
+
+        # The domain's settings.ini replaces the template in ndingest
+        cmd = ('cp {shared} {zip}.tmp && '
+               '(cd {settings} && zip -q $OLDPWD/{zip}.tmp {name}) && '
+               'mv {zip}.tmp {zip}')
+        result = master.run(cmd.format(shared=SHARED_ZIP,
+                                       zip=SITE_ZIP.format(domain),
+                                       settings=settings_dir,
+                                       name=NDINGEST_SETTINGS_NAME))
+        if result.returncode != 0:
+            raise Exception("Could not zip lambda code for {}: {}".format(domain, result.stderr.strip()))
+
+    # This section will run makedomainenv on lambda-build-server
+    with timer(timings, 'makedomainenv'):
+        print("{}: calling makedomainenv on lambda-build-server".format(domain))
+        cmd = 'source /etc/profile && source ~/.bash_profile && /home/ec2-user/makedomainenv {} {}'.format(domain, bucket)
+        result = master.run(cmd)
+
+        log = utils.cache_path('lambda', domain + '.log')
+        with open(log, 'w') as fh:
+            fh.write(result.stdout)
+            fh.write(result.stderr)
+
+        if result.returncode != 0:
+            raise Exception("makedomainenv returned {} (output in {})".format(result.returncode, log))
+
+    # Same format as Lambda's CodeSha256
+    cmd = 'openssl dgst -sha256 -binary ~/lambdazips/{} | base64'.format(get_lambda_zip_name(domain))
+    result = master.run(cmd)
+    artifact = result.stdout.strip()
+    if result.returncode != 0 or len(artifact) == 0:
+        raise Exception("Could not checksum the lambda zip: {}".format(result.stderr.strip()))
+
+    save_build_cache(domain, {'inputs': inputs, 'bucket': bucket, 'artifact': artifact})
+    return artifact
+
+def build_lambdas(session, domains, bucket, force=False, timings=None, max_workers=LAMBDA_WORKERS):
+    """Build the lambda zip for multiple domains, uploading each to S3.
+
+    The files shared by all domains are hashed once and, if any domain needs
+    to be built, zipped and copied to the lambda build server once. Each
+    domain's settings are then generated and, if anything changed, its zip
+    built by makedomainenv at the same time.
+
+    Args:
+        session (Session): boto3.Session
+        domains (list): List of VPC domain names such as integration.boss.
+        bucket (string): S3 bucket to upload the lambda zips to
+        force (bool): Build even if nothing has changed
+        timings (None|dict): Dictionary to record the step timings in, keyed
+                             by domain and 'shared' for the shared steps
+        max_workers (int): Maximum number of domains to build at the same time
+
+    Returns:
+        (tuple): (dict of {domain: CodeSha256 or None}, dict of {domain: Exception} for failed domains)
+    """
+    if timings is None:
+        timings = {}
+    shared = timings.setdefault('shared', OrderedDict())
+    for domain in domains:
+        timings.setdefault(domain, OrderedDict())
+
+    sources = lambda_sources()
+    with timer(shared, 'hash'):
+        shared_inputs = hash_inputs(sources)
+
+    artifacts = {}
+    errors = {}
+    def collect(futures, handle):
+        for domain, future in futures.items():
+            try:
+                handle(domain, future.result())
+            except Exception as ex:
+                print("{}: {}".format(domain, ex))
+                errors[domain] = ex
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = OrderedDict((domain, executor.submit(prepare_domain, aws.copy_session(session), domain, bucket,
+                                                       shared_inputs, force, timings[domain]))
+                              for domain in domains)
+        prepared = {}
+        def prepare(domain, result):
+            settings, inputs, build, artifact = result
+            if build:
+                prepared[domain] = (settings, inputs)
+            else:
+                artifacts[domain] = artifact
+        collect(futures, prepare)
+
+        if len(prepared) == 0:
+            return artifacts, errors
+
+        lambda_build_server = aws.get_lambda_server(session)
+        lambda_build_server_key = aws.get_lambda_server_key(session)
+        lambda_build_server_key = utils.keypair_to_file(lambda_build_server_key)
+        master = ControlMaster(lambda_build_server_key, lambda_build_server, 22, 'ec2-user')
+        master.start()
+        try:
+            try:
+                upload_shared(master, sources, shared)
+            except Exception as ex:
+                print(ex)
+                errors.update((domain, ex) for domain in prepared)
+                return artifacts, errors
+
+            futures = OrderedDict((domain, executor.submit(build_domain, master, domain, bucket,
+                                                           settings, inputs, timings[domain]))
+                                  for domain, (settings, inputs) in prepared.items())
+            collect(futures, artifacts.__setitem__)
+        finally:
+            master.close()
+
+    return artifacts, errors
+
+def update_lambdas(session, artifacts, bucket, force=False, timings=None, max_workers=LAMBDA_WORKERS):
+    """Point each domain's multilambda function at its zip in S3 at the same time.
+
+    Args:
+        session (Session): boto3.Session
+        artifacts (dict): Dictionary of {domain: CodeSha256 or None} from build_lambdas()
+        bucket (string): S3 bucket containing the lambda zips
+        force (bool): Update even if the zip is already deployed
+        timings (None|dict): Dictionary to record the step timings in, keyed by domain
+        max_workers (int): Maximum number of domains to update at the same time
+
+    Returns:
+        (dict): Dictionary of {domain: Exception} for domains that failed to update
+    """
+    if timings is None:
+        timings = {}
+
+    def update(domain):
+        with timer(timings.setdefault(domain, OrderedDict()), 'update'):
+            update_lambda_code(aws.copy_session(session), domain, bucket,
+                               None if force else artifacts[domain])
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = OrderedDict((domain, executor.submit(update, domain)) for domain in artifacts)
+        for domain, future in futures.items():
+            try:
+                future.result()
+            except Exception as ex:
+                print("{}: {}".format(domain, ex))
+                errors[domain] = ex
+    return errors
+
+def print_timings(timings, errors):
+    """Print a table of how long each step took for each domain
+
+    Args:
+        timings (dict): Step timings from build_lambdas() and update_lambdas()
+        errors (dict): Dictionary of {domain: Exception} for failed domains
+    """
+    fmt = lambda s: "-" if s is None else "{:.0f}s".format(s)
+
+    shared = timings.get('shared', {})
+    print("Shared: " + ", ".join("{} {}".format(step, fmt(t)) for step, t in shared.items()))
+
+    steps = ['settings', 'check', 'zip', 'makedomainenv', 'update']
+    print("{:<30}".format("Domain") + "".join("{:>15}".format(step) for step in steps) + "{:>10}".format("Status"))
+    for domain in sorted(d for d in timings if d != 'shared'):
+        row = "{:<30}".format(domain)
+        row += "".join("{:>15}".format(fmt(timings[domain].get(step))) for step in steps)
+        row += "{:>10}".format("error" if domain in errors else "ok")
+        print(row)
 
 # DP TODO: Move to a lib/ library
-def load_lambdas_on_s3(session, domain, bucket):
-    """Zip up spdb, bossutils, lambda and lambda_utils.  Upload to S3.
+def load_lambdas_on_s3(session, domain, bucket, force=False):
+    """Copy spdb, bossutils, lambda and lambda_utils to the lambda build server.  Upload to S3.
 
     Uses the lambda build server (an Amazon Linux AMI) to compile C code and
     prepare the virtualenv that's ultimately contained in the zip file placed
     in S3.
 
+    If none of the files built into the zip have changed since the last build
+    for the domain and the zip is still in S3 the build is skipped.
+
     Args:
         session (Session): boto3.Session
         domain (string): The VPC's domain name such as integration.boss.
-    """
-    tempname = tempfile.NamedTemporaryFile(delete=True)
-    zipname = tempname.name + '.zip'
-    tempname.close()
-    print('Using temp zip file: ' + zipname)
-
-    cwd = os.getcwd()
-    os.chdir(const.repo_path("salt_stack", "salt", "spdb", "files"))
-    zip.write_to_zip('spdb.git', zipname, False)
-    os.chdir(cwd)
-
-    os.chdir(const.repo_path("salt_stack", "salt", "boss-tools", "files", "boss-tools.git"))
-    zip.write_to_zip('bossutils', zipname)
-    zip.write_to_zip('lambda', zipname)
-    zip.write_to_zip('lambdautils', zipname)
-    os.chdir(cwd)
-
-    with open(NDINGEST_SETTINGS_TEMPLATE, 'r') as tmpl:
-        # Generate settings.ini file for ndingest.
-        create_ndingest_settings(domain, tmpl)
-
-    os.chdir(const.repo_path("salt_stack", "salt", "ndingest", "files"))
-    zip.write_to_zip('ndingest.git', zipname)
-    os.chdir(cwd)
-
-    print("Copying local modules to lambda-build-server")
-
-    #copy the zip file to lambda_build_server
-    lambda_build_server = aws.get_lambda_server(session)
-    lambda_build_server_key = aws.get_lambda_server_key(session)
-    lambda_build_server_key = utils.keypair_to_file(lambda_build_server_key)
-    ssh = SSHConnection(lambda_build_server_key, (lambda_build_server, 22, 'ec2-user'))
-    target_file = "sitezips/{}.zip".format(domain)
-    ret = ssh.scp(zipname, target_file, upload=True)
-    print("scp return code: " + str(ret))
-
-    os.remove(zipname)
+        bucket (string): S3 bucket to upload the lambda zip to
+        force (bool): Build even if nothing has changed
 
-    # This section will run makedomainenv on lambda-build-server
-    print("calling makedomainenv on lambda-build-server")
-    cmd = 'source /etc/profile && source ~/.bash_profile && /home/ec2-user/makedomainenv {} {}'.format(domain, bucket)
-    ssh.cmd(cmd)
+    Returns:
+        (string|None): Base64 encoded SHA256 of the lambda zip, as reported by
+                       Lambda's CodeSha256, or None if it could not be determined
+    """
+    artifacts, errors = build_lambdas(session, [domain], bucket, force)
+    if domain in errors:
+        raise errors[domain]
+    return artifacts[domain]
 
-def create_ndingest_settings(domain, fp):
+def create_ndingest_settings(domain, fp, out_path=NDINGEST_SETTINGS_TEMPLATE):
     """Create the settings.ini file for ndingest.
 
-    The file is placed in ndingest's settings folder.j
+    By default the file is placed in ndingest's settings folder.
 
     Args:
         domain (string): The VPC's domain name such as integration.boss.
         fp (file-like object): File like object to read settings.ini template from.
+        out_path (string): Path of the settings.ini file to create.
     """
     names = AWSNames(domain)
     parser = configparser.ConfigParser()
@@ -162,7 +495,7 @@ def create_ndingest_settings(domain, fp):
     # ToDo: find way to always get cuboid size from spdb.
     parser['spdb']['SUPER_CUBOID_SIZE'] = '512, 512, 16'
 
-    with open(NDINGEST_SETTINGS_FOLDER + '/settings.ini', 'w') as out:
+    with open(out_path, 'w') as out:
         parser.write(out)
 
 if __name__ == '__main__':
@@ -174,8 +507,18 @@ if __name__ == '__main__':
                         default = os.environ.get('AWS_CREDENTIALS'),
                         type = argparse.FileType('r'),
                         help = 'File with credentials for connecting to AWS (default: AWS_CREDENTIALS)')
-    parser.add_argument('domain',
-                        help = 'Domain that lambda functions live in, such as integration.boss.')
+    parser.add_argument('--force', '-f',
+                        action = 'store_true',
+                        help = 'Rebuild and update the lambda even if nothing changed since the last build')
+    parser.add_argument('--parallel', '-p',
+                        metavar = '<count>',
+                        default = LAMBDA_WORKERS,
+                        type = int,
+                        help = 'Number of domains to build and update at the same time (default: {})'.format(LAMBDA_WORKERS))
+    parser.add_argument('domains',
+                        nargs = '+',
+                        metavar = 'domain',
+                        help = 'Domain(s) that lambda functions live in, such as integration.boss.')
 
     args = parser.parse_args()
 
@@ -187,5 +530,12 @@ if __name__ == '__main__':
     session = aws.create_session(args.aws_credentials)
     bucket = aws.get_lambda_s3_bucket(session)
 
-    load_lambdas_on_s3(session, args.domain, bucket)
-    update_lambda_code(session, args.domain, bucket)
+    # Every domain shares the same build of the common files
+    timings = {}
+    artifacts, errors = build_lambdas(session, args.domains, bucket, args.force, timings, args.parallel)
+    errors.update(update_lambdas(session, artifacts, bucket, args.force, timings, args.parallel))
+
+    print()
+    print_timings(timings, errors)
+    if len(errors) > 0:
+        sys.exit(1)
@@ -144,14 +144,17 @@ def post_init(session, domain):
 def delete(session, domain):
     names = AWSNames(domain)
     # DP TODO: delete activities
-    CloudFormationConfiguration('activities', domain).delete(session)
-
-    sfn.delete(session, names.delete_cuboid)
-    sfn.delete(session, names.delete_experiment)
-    sfn.delete(session, names.delete_coord_frame)
-    sfn.delete(session, names.delete_collection)
-    sfn.delete(session, names.query_deletes)
-    sfn.delete(session, names.ingest_queue_populate)
-    sfn.delete(session, names.ingest_queue_upload)
-    sfn.delete(session, names.resolution_hierarchy)
-    sfn.delete(session, names.downsample_volume)
+    # The step functions are not part of the stack, so they can be deleted
+    # while the stack is being deleted
+    aws.run_concurrently(session, [
+        (CloudFormationConfiguration('activities', domain).delete,),
+        (sfn.delete, names.delete_cuboid),
+        (sfn.delete, names.delete_experiment),
+        (sfn.delete, names.delete_coord_frame),
+        (sfn.delete, names.delete_collection),
+        (sfn.delete, names.query_deletes),
+        (sfn.delete, names.ingest_queue_populate),
+        (sfn.delete, names.ingest_queue_upload),
+        (sfn.delete, names.resolution_hierarchy),
+        (sfn.delete, names.downsample_volume),
+    ], max_workers = 10)
@@ -27,7 +27,7 @@ from lib.cloudformation import CloudFormationConfiguration, Arg, Ref, Arn
 from lib.userdata import UserData
 from lib.names import AWSNames
 from lib.keycloak import KeyCloakClient
-from lib.external import ExternalCalls
+from lib.external import ExternalCalls, url_ready
 from lib import aws
 from lib import utils
 from lib import scalyr
@@ -298,9 +298,11 @@ def post_init(session, domain):
         bossadmin = vault.read("secret/auth/realm")
         auth_uri = vault.read("secret/endpoint/auth")['url']
 
-    # Verify Keycloak is accessible
-    print("Checking for Keycloak availability")
-    call.check_keycloak(const.TIMEOUT_KEYCLOAK)
+    # Verify Keycloak and the API are accessible
+    print("Checking for Keycloak and API availability")
+    call.wait_all([("Keycloak", call.keycloak_ready),
+                   ("API", lambda: url_ready(uri + '/ping'))],
+                  const.TIMEOUT_KEYCLOAK)
 
     # Add the API servers to the list of OIDC valid redirects
     with call.tunnel(names.auth, 8080) as auth_port:
@@ -327,7 +329,6 @@ def post_init(session, domain):
     resp = json.loads(urlopen(req).read().decode('utf-8'))
 
     # Make an API call that will log the boss admin into the endpoint
-    call.check_url(uri + '/ping', 60)
     headers = {
         'Authorization': 'Bearer {}'.format(resp['access_token']),
     }
@@ -442,7 +443,9 @@ def update(session, domain):
 
 def delete(session, domain):
     names = AWSNames(domain)
-    aws.route53_delete_records(session, domain, names.endpoint)
-    aws.sqs_delete_all(session, domain)
-    aws.policy_delete_all(session, domain, '/ingest/')
+    aws.run_concurrently(session, [
+        (aws.route53_delete_records, domain, names.endpoint),
+        (aws.sqs_delete_all, domain),
+        (aws.policy_delete_all, domain, '/ingest/'),
+    ])
     CloudFormationConfiguration('api', domain).delete(session)
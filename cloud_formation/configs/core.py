@@ -31,12 +31,12 @@ from lib.external import ExternalCalls
 from lib import aws
 from lib import utils
 from lib import scalyr
+from lib import telemetry
 from lib import constants as const
 
 import os
 import json
 import time
-from concurrent.futures import ThreadPoolExecutor
 
 keypair = None
 
@@ -368,14 +368,17 @@ def update(session, domain):
 
     consul_update_timeout = 5 # minutes
     consul_size = int(get_scenario(const.CONSUL_CLUSTER_SIZE))
-    min_time = consul_update_timeout * consul_size
-    max_time = min_time + 5 # add some time to allow the CF update to happen
+    # Restart as many instances at once as the cluster can lose without losing quorum
+    consul_batch = max(1, (consul_size - 1) // 2)
+    consul_batches = -(-consul_size // consul_batch) # ceiling division
+    max_time = consul_update_timeout * consul_batches + 5 # add some time to allow the CF update to happen
 
-    print("Update command will take {} - {} minutes to finish".format(min_time, max_time))
+    print("Update command will take up to {} minutes to finish".format(max_time))
     print("Stack will be available during that time")
-    resp = input("Update? [N/y] ")
+    resp = telemetry.prompt("Update? [N/y] ")
     if len(resp) == 0 or resp[0] not in ('y', 'Y'):
         print("Canceled")
+        telemetry.cancel()
         return
 
     config = create_config(session, domain)
@@ -402,21 +405,24 @@ def update(session, domain):
         # DP NOTE: Cycling the instances is done manually (outside of CF)
         #          so that Vault can be unsealed first, else the whole stacks
         #          would not be usable until all consul instance were restarted
-        with ThreadPoolExecutor(max_workers=3) as tpe:
-            # Need time for the ASG to detect the terminated instance,
-            # launch the new instance, and have the instance cluster
-            tpe.submit(aws.asg_restart,
-                            session,
-                            names.consul,
-                            consul_update_timeout * 60)
+        # Wait for the ASG to launch the new instances and for them to
+        # rejoin the cluster before terminating the next batch. This blocks
+        # until the last batch is ready, unlike the old per instance restart
+        # that only slept between terminations
+        aws.asg_restart(session,
+                        names.consul,
+                        consul_update_timeout * 60,
+                        batch_size = consul_batch,
+                        ready = lambda ids: call.check_consul(consul_size, ids))
 
     return success
 
 def delete(session, domain):
     # NOTE: CloudWatch logs for the DNS Lambda are not deleted
     names = AWSNames(domain)
-    aws.route53_delete_records(session, domain, names.auth)
-    aws.route53_delete_records(session, domain, names.consul)
-    aws.route53_delete_records(session, domain, names.vault)
-    aws.sns_unsubscribe_all(session, names.dns)
+    # The DNS records have to be removed before the stack's Hosted Zone can be deleted
+    aws.run_concurrently(session, [
+        (aws.route53_delete_records, domain, [names.auth, names.consul, names.vault]),
+        (aws.sns_unsubscribe_all, names.dns),
+    ])
     CloudFormationConfiguration('core', domain).delete(session)
@@ -29,10 +29,16 @@ import time
 import json
 import re
 import sys
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from boto3.session import Session
+from botocore.exceptions import ClientError
 
 from . import constants as const
 from . import hosts
+from . import exceptions
+from . import telemetry
 
 def create_session(credentials):
     """Read the AWS from the credentials dictionary and then create a boto3
@@ -50,6 +56,71 @@ def create_session(credentials):
                       region_name = credentials.get('aws_region', const.REGION))
     return session
 
+def copy_session(session):
+    """Create a new boto3 session with the same credentials and region as
+    the given session.
+
+    Boto3 sessions are not thread safe, so each thread should use its own copy.
+
+    Args:
+        session (Session) : Boto3 session to copy
+
+    Returns:
+        (Session) : New Boto3 session
+    """
+    credentials = session.get_credentials().get_frozen_credentials()
+    copy = Session(aws_access_key_id = credentials.access_key,
+                   aws_secret_access_key = credentials.secret_key,
+                   aws_session_token = credentials.token,
+                   region_name = session.region_name)
+    telemetry.count_api_calls(copy)
+    return copy
+
+def run_concurrently(session, tasks, max_workers = 8):
+    """Run independent AWS tasks at the same time and wait for all of them
+    to finish.
+
+    Each task is a tuple of a function and its arguments. The function is called
+    with a copy of session as the first argument, followed by the rest of the
+    task's arguments. A task failing does not stop the other tasks.
+
+    Example:
+        run_concurrently(session, [(sqs_delete_all, domain),
+                                   (route53_delete_records, domain, [name1, name2])])
+
+    Args:
+        session (Session) : Boto3 session that is copied for each task
+        tasks (list) : List of tuples (function, *args)
+        max_workers (int) : Maximum number of tasks to run at the same time
+
+    Returns:
+        (list) : List of the results of each task
+
+    Raises:
+        (Exception) : The first exception raised by a task, after all of the
+                      tasks have finished
+    """
+    def name(task):
+        return getattr(task[0], '__qualname__', str(task[0]))
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        futures = [executor.submit(task[0], copy_session(session), *task[1:]) for task in tasks]
+
+    error = None
+    results = []
+    for task, future in zip(tasks, futures):
+        try:
+            results.append(future.result())
+        except Exception as ex:
+            print("Error running {}: {}".format(name(task), ex))
+            if error is None:
+                error = ex
+            results.append(None)
+
+    if error is not None:
+        raise error
+    return results
+
 def machine_lookup_all(session, hostname, public_ip = True):
     """Lookup all of the IP addresses for a given AWS instance name.
 
@@ -171,25 +242,127 @@ def _find(xs, predicate):
     return None
 
 
-def asg_restart(session, hostname, timeout, callback=None):
-    """Terminate all of the instances for an ASG, with the given timeout between
-    each termination.
-    """
-    client = session.client('ec2')
-    resource = session.resource('ec2')
-    response = client.describe_instances(Filters=[{"Name":"tag:Name", "Values":[hostname]},
-                                                  {"Name":"instance-state-name", "Values":["running"]}])
+def asg_restart(session, hostname, timeout, callback=None, batch_size=1, ready=None, poll=5):
+    """Rolling restart of all of the instances for an ASG.
 
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            id = instance['InstanceId']
-            print("Terminating {} instance {}".format(hostname, id))
-            resource.Instance(id).terminate()
-            print("Sleeping for {} minutes".format(timeout/60.0))
-            time.sleep(timeout)
+    Up to batch_size instances are terminated at a time. Before the next batch
+    is terminated the ASG has to have launched a replacement for each of the
+    terminated instances, the replacements have to be InService and Healthy
+    in the ASG, InService in any ELB attached to the ASG, and the optional
+    ready function has to return True.
+
+    The call blocks until every batch has been replaced and is ready.
+
+    Note: batch_size should be kept below the number of instances that can
+          be lost without the service losing quorum
+
+    Args:
+        session (Session) : Boto3 session used to lookup information in AWS
+        hostname (string) : Hostname of the EC2 instances created by the ASG
+        timeout (int) : Maximum number of seconds to wait for a batch of
+                        replacement instances to become ready
+        callback (None|function) : Function called once after each batch is
+                                   ready (not once per instance)
+        batch_size (int) : Maximum number of instances to terminate at once
+        ready (None|function) : Function taking the list of replacement instance
+                                IDs and returning if the service is ready
+        poll (int) : Initial number of seconds between readiness checks,
+                     doubled after each check up to 30 seconds
 
-            if callback is not None:
-                callback()
+    Returns:
+        (list) : List of dicts, one per replacement instance, with the 'batch'
+                 number, the 'replacement' instance ID, the number of seconds
+                 from the batch's termination until the replacement was
+                 'in_service' in the ASG, and until the whole batch was 'ready'.
+                 Replacements are not matched to the instances they replaced,
+                 as the ASG doesn't record which instance a launch replaced.
+
+    Raises:
+        (StatusCheckError) : If a batch doesn't become ready within timeout
+    """
+    asg_name = asg_name_lookup(session, hostname)
+    if asg_name is None:
+        raise Exception("Could not locate the ASG for '{}'".format(hostname))
+
+    asg = session.client('autoscaling')
+    elb = session.client('elb')
+
+    def describe():
+        response = asg.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+        return response['AutoScalingGroups'][0]
+
+    def elb_in_service(group, ids):
+        for lb in group.get('LoadBalancerNames', []):
+            try:
+                response = elb.describe_instance_health(LoadBalancerName = lb,
+                                                        Instances = [{'InstanceId': id} for id in ids])
+            except ClientError: # Instance is not registered with the ELB yet
+                return False
+            for state in response['InstanceStates']:
+                if state['State'] != 'InService':
+                    return False
+        return True
+
+    group = describe()
+    original = sorted(i['InstanceId'] for i in group['Instances'])
+    known = set(original)
+
+    timings = []
+    for number, start in enumerate(range(0, len(original), batch_size), 1):
+        batch = original[start:start + batch_size]
+
+        started = time.time()
+        for id in batch:
+            print("Terminating {} instance {}".format(hostname, id))
+            # Terminating through the ASG, instead of EC2, causes the
+            # replacement instance to be launched immediately
+            asg.terminate_instance_in_auto_scaling_group(InstanceId = id,
+                                                         ShouldDecrementDesiredCapacity = False)
+
+        replacements = {} # instance id: seconds until InService
+        sleep = poll
+        while True:
+            if time.time() - started > timeout:
+                msg = "Replacements for {} not ready after {} seconds".format(", ".join(batch), timeout)
+                raise exceptions.StatusCheckError(msg, hostname)
+
+            time.sleep(sleep)
+            sleep = min(sleep * 2, 30)
+
+            group = describe()
+            for instance in group['Instances']:
+                id = instance['InstanceId']
+                if id in known or id in replacements:
+                    continue
+                if instance['LifecycleState'] == 'InService' and instance['HealthStatus'] == 'Healthy':
+                    replacements[id] = time.time() - started
+
+            if len(replacements) < len(batch):
+                continue
+            if not elb_in_service(group, list(replacements)):
+                continue
+            if ready is not None and not ready(list(replacements)):
+                continue
+            break
+
+        elapsed = time.time() - started
+        print("Batch {} replaced in {:.0f} seconds".format(", ".join(batch), elapsed))
+
+        known.update(replacements)
+        for replacement in sorted(replacements, key=replacements.get):
+            timings.append({'batch': number,
+                            'replacement': replacement,
+                            'in_service': replacements[replacement],
+                            'ready': elapsed})
+
+        if callback is not None:
+            callback()
+
+    print("{:<8}{:<22}{:>12}{:>8}".format("Batch", "Replacement", "InService", "Ready"))
+    for timing in timings:
+        print("{batch:<8}{replacement:<22}{in_service:>11.0f}s{ready:>7.0f}s".format(**timing))
+
+    return timings
 
 def asg_name_lookup(session, hostname):
     """Lookup the Group name for the ASG creating the EC2 instances with the given hostname
@@ -289,12 +462,119 @@ def azs_lookup(session, lambda_compatible_only=False):
                 rtn.remove(az)
     return rtn
 
+# Name suffixes of the AMIs indexed by AMICatalog. AMI names have the format
+# <name><suffix> or <name><suffix>-<version>
+AMI_CATALOG_SUFFIXES = [".boss", ".neurodata"]
+AMI_CATALOG_PATTERNS = ["*" + suffix + "*" for suffix in AMI_CATALOG_SUFFIXES]
+
+# Prefix of the tags used to locate an unchanged AMI by the name of a later
+# build that was skipped (see bin/packer.py)
+ALIAS_TAG_PREFIX = "Alias:"
+
+class AMICatalog(object):
+    """Index of the BOSS AMIs owned by the account.
+
+    All of the AMIs are fetched with a single describe_images call and
+    indexed by name prefix and version suffix, so any number of lookups can
+    be resolved without additional AWS calls.
+    """
+    def __init__(self, session):
+        """AMICatalog constructor
+
+        Args:
+            session (Session) : Boto3 session used to lookup the AMIs
+        """
+        client = session.client('ec2')
+        response = client.describe_images(Owners=['self'],
+                                          Filters=[{"Name": "name", "Values": AMI_CATALOG_PATTERNS}])
+
+        self.names = {} # name: image
+        self.versions = {} # (prefix, version): image
+        self.aliases = {} # (prefix, alias): newest image
+        self.latest = {} # prefix: newest image with a commit hash version
+
+        # Oldest first, so newer images replace older ones in the indexes
+        for image in sorted(response['Images'], key=lambda x: x["CreationDate"]):
+            name = image['Name']
+            self.names[name] = image
+            prefix, version = self._split(name)
+            if version is None:
+                continue
+
+            self.versions[(prefix, version)] = image
+            if version.startswith('h'):
+                self.latest[prefix] = image
+            for tag in image.get('Tags', []):
+                if tag['Key'].startswith(ALIAS_TAG_PREFIX):
+                    self.aliases[(prefix, tag['Key'][len(ALIAS_TAG_PREFIX):])] = image
+
+    @staticmethod
+    def _split(name):
+        """Split an AMI name into the name prefix and version
+
+        Args:
+            name (string) : AMI name
+
+        Returns:
+            (tuple) : Tuple of (prefix, version), where version is None if the
+                      name doesn't have a '<name><suffix>-<version>' format
+        """
+        for suffix in AMI_CATALOG_SUFFIXES:
+            idx = name.find(suffix + '-')
+            if idx > 0:
+                end = idx + len(suffix)
+                return name[:end], name[end + 1:]
+        return name, None
+
+    def lookup(self, ami_name, version = None):
+        """Lookup the EC2 image for the given AMI name, see ami_lookup()
+
+        A specific version that is not in the catalog is not resolved to the
+        latest image, so that shared images can be searched for first.
+
+        Args:
+            ami_name (string) : Name of AMI to lookup
+            version (string|None) : 'latest', a specific version, or None for an exact name
+
+        Returns:
+            (dict|None) : The EC2 image or None if the AMI is not in the catalog
+        """
+        if version is None:
+            return self.names.get(ami_name)
+        elif version == "latest":
+            return self.latest.get(ami_name)
+        else:
+            return self.versions.get((ami_name, version)) or self.aliases.get((ami_name, version))
+
+_ami_catalogs = weakref.WeakKeyDictionary()
+_ami_catalogs_lock = threading.Lock()
+
+def ami_catalog(session):
+    """Get the AMICatalog for the session, creating it on the first call
+
+    Args:
+        session (Session) : Boto3 session used to lookup the AMIs
+
+    Returns:
+        (AMICatalog) : The session's catalog
+    """
+    with _ami_catalogs_lock:
+        if session not in _ami_catalogs:
+            _ami_catalogs[session] = AMICatalog(session)
+        return _ami_catalogs[session]
+
 def ami_lookup(session, ami_name, version = None):
     """Lookup the Id for the AMI with the given name.
 
     If ami_name ends with '.boss', the AMI_VERSION environmental variable is used
     to either search for the latest commit hash tagged AMI ('.boss-h<hash>') or
-    for the AMI with the specific tag ('.boss-<AMI_VERSION>').
+    for the AMI with the specific tag ('.boss-<AMI_VERSION>').  An AMI tagged
+    with 'Alias:<AMI_VERSION>' also matches a specific version.
+
+    AMIs owned by the account are resolved using the session's AMICatalog,
+    so only the first lookup makes a call to AWS.  Other AMIs, including
+    shared AMIs with the specific version or alias, are searched for directly
+    before falling back to the latest AMI.
 
     Args:
         session (Session|None) : Boto3 session used to lookup information in AWS
@@ -310,24 +590,41 @@ def ami_lookup(session, ami_name, version = None):
     if session is None:
         return None
 
-    specific = False
+    ami_version = None
     if ami_name.endswith(".neurodata"):
         ami_version = os.environ["AMI_VERSION"] if version is None else version
-        if ami_version == "latest":
-            # limit latest searching to only versions tagged with hash information
-            ami_search = ami_name + "-h*"
-        else:
-            ami_search = ami_name + "-" + ami_version
-            specific = True
-    else:
+
+    image = ami_catalog(session).lookup(ami_name, ami_version)
+    if image is None:
+        return _ami_search(session, ami_name, ami_version)
+
+    tag = _find(image.get('Tags', []), lambda x: x["Key"] == "Commit")
+    commit = None if tag is None else tag["Value"]
+    return (image['ImageId'], commit)
+
+def _ami_search(session, ami_name, ami_version = None):
+    """Search for an AMI not in the account's AMICatalog, see ami_lookup()"""
+    specific = False
+    if ami_version is None:
         ami_search = ami_name
+    elif ami_version == "latest":
+        # limit latest searching to only versions tagged with hash information
+        ami_search = ami_name + "-h*"
+    else:
+        ami_search = ami_name + "-" + ami_version
+        specific = True
 
     client = session.client('ec2')
     response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_search]}])
+    if len(response['Images']) == 0 and specific:
+        # Unchanged images are not rebuilt, instead the existing AMI is tagged
+        # with the new build name (see bin/packer.py)
+        response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_name + "-*"]},
+                                                   {"Name": "tag-key", "Values": [ALIAS_TAG_PREFIX + ami_version]}])
     if len(response['Images']) == 0:
         if specific:
             print("Could not locate AMI '{}', trying to find the latest '{}' AMI".format(ami_search, ami_name))
-            return ami_lookup(session, ami_name, version = "latest")
+            return _ami_search(session, ami_name, "latest")
         else:
             return None
     else:
@@ -545,7 +842,7 @@ def keypair_lookup(session):
         return None
     while True:
         try:
-            idx = input("[0]: ")
+            idx = telemetry.prompt("[0]: ")
             idx = int(idx if len(idx) > 0 else "0")
             return response['KeyPairs'][idx]['KeyName']
         except KeyboardInterrupt:
@@ -956,11 +1253,14 @@ def get_dns_resource_for_domain_name(session, domain_name, dns_resource, hosted_
 def route53_delete_records(session, hosted_zone, cname):
     """Delete all of the matching CNAME records from a DNS Zone
 
+    All of the matching records, for all of the given names, are deleted in
+    a single change batch.
+
     Args:
         session (Session|None) : Boto3 session used to lookup information in AWS
                                  If session is None no delete is performed
         hosted_zone (string) : Name of the hosted zone
-        cname (string) : The DNS records to delete
+        cname (string|list) : The DNS records to delete, or a list of DNS records
     """
     if session is None:
         return None
@@ -972,23 +1272,30 @@ def route53_delete_records(session, hosted_zone, cname):
         print("Could not locate Route53 Hosted Zone '{}'".format(hosted_zone))
         return None
 
-    response = client.list_resource_record_sets(
-        HostedZoneId=hosted_zone_id,
-        StartRecordName=cname,
-        StartRecordType='CNAME'
-    )
+    cnames = [cname] if type(cname) == str else cname
 
     changes = []
-    for record in response['ResourceRecordSets']:
-        if not record['Name'].startswith(cname):
-            continue
-        changes.append({
-            'Action': 'DELETE',
-            'ResourceRecordSet': record
-        })
+    for cname in cnames:
+        response = client.list_resource_record_sets(
+            HostedZoneId=hosted_zone_id,
+            StartRecordName=cname,
+            StartRecordType='CNAME'
+        )
+
+        records = 0
+        for record in response['ResourceRecordSets']:
+            if not record['Name'].startswith(cname):
+                continue
+            records += 1
+            changes.append({
+                'Action': 'DELETE',
+                'ResourceRecordSet': record
+            })
+
+        if records == 0:
+            print("No {} records to remove".format(cname))
 
     if len(changes) == 0:
-        print("No {} records to remove".format(cname))
         return None
 
     response = client.change_resource_record_sets(
@@ -0,0 +1,154 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for analyzing the boot timelines recorded by the firstboot scripts.
+
+The timelines are recorded on each instance by boot_timeline.py (installed
+from salt_stack/salt/boss-tools/files/) as JSON lines of start and end events.
+The timeline file is kept across reboots, so only the events of the latest
+boot are analyzed.
+
+TIMELINE_FILE : Location of the timeline on the instance
+"""
+
+import json
+
+from . import telemetry
+
+# Must match TIMELINE_FILE in salt_stack/salt/boss-tools/files/boot_timeline.py
+TIMELINE_FILE = "/var/log/boss/boot-timeline.jsonl"
+
+def parse(text):
+    """Parse the contents of a timeline file
+
+    Args:
+        text (string) : Timeline file contents
+
+    Returns:
+        (list) : List of event dictionaries, skipping any invalid lines
+    """
+    events = []
+    for line in text.splitlines():
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            pass
+    return events
+
+def latest_boot(events):
+    """Select the events recorded during the instance's latest boot
+
+    Events are grouped by their 'boot' id. Events recorded before boot ids
+    were added have no id and are treated as a single boot.
+
+    Args:
+        events (list) : List of event dictionaries
+
+    Returns:
+        (list) : List of the event dictionaries with the same boot id as the
+                 last recorded event
+    """
+    if len(events) == 0:
+        return []
+    last = max(events, key=lambda e: e.get('time', 0))
+    return [e for e in events if e.get('boot') == last.get('boot')]
+
+def steps(events):
+    """Pair the start and end events of each step of the latest boot
+
+    Times are in seconds since the instance's kernel booted, so only the
+    events of the latest boot (see latest_boot()) are used.
+
+    Args:
+        events (list) : List of event dictionaries
+
+    Returns:
+        (list) : List of step dictionaries with 'script', 'step', 'start',
+                 'end', 'duration', and 'status' keys, ordered by start time.
+                 Steps that never ended have a status of 'incomplete' and
+                 None for the end and duration.
+    """
+    started = {}
+    result = []
+    for event in sorted(latest_boot(events), key=lambda e: e.get('time', 0)):
+        key = (event.get('script'), event.get('step'), event.get('pid'))
+        if event.get('event') == 'start':
+            started[key] = event
+        elif event.get('event') == 'end' and key in started:
+            start = started.pop(key)
+            result.append({'script': key[0],
+                           'step': key[1],
+                           'start': start.get('uptime'),
+                           'end': event.get('uptime'),
+                           'duration': event.get('duration'),
+                           'status': event.get('status')})
+
+    for (script, step, pid), start in started.items():
+        result.append({'script': script,
+                       'step': step,
+                       'start': start.get('uptime'),
+                       'end': None,
+                       'duration': None,
+                       'status': 'incomplete'})
+
+    result.sort(key=lambda s: s['start'] or 0)
+    return result
+
+def critical_path(steps):
+    """Find the chain of steps that determined when the boot finished
+
+    Starting from the step that finished last, each previous step in the
+    chain is the step that finished last before the current step started.
+
+    Args:
+        steps (list) : List of step dictionaries from steps()
+
+    Returns:
+        (list) : List of step dictionaries, ordered by start time
+    """
+    finished = [s for s in steps if s['end'] is not None and s['start'] is not None]
+    path = []
+    current = max(finished, key=lambda s: s['end'], default=None)
+    while current is not None:
+        path.append(current)
+        before = [s for s in finished if s['end'] <= current['start']]
+        current = max(before, key=lambda s: s['end'], default=None)
+    return list(reversed(path))
+
+def slowest(timelines, count=10):
+    """Find the slowest steps across multiple instances
+
+    Args:
+        timelines (dict) : Dictionary of {host: list of step dictionaries from steps()}
+        count (int) : Number of steps to return
+
+    Returns:
+        (list) : List of (step name, p50, p90, max, number of instances) tuples,
+                 ordered by the p90 duration
+    """
+    durations = {}
+    for host_steps in timelines.values():
+        for step in host_steps:
+            if step['duration'] is not None:
+                name = "{}/{}".format(step['script'], step['step'])
+                durations.setdefault(name, []).append(step['duration'])
+
+    result = [(name,
+               telemetry.percentile(values, 50),
+               telemetry.percentile(values, 90),
+               telemetry.percentile(values, 100),
+               len(values))
+              for name, values in durations.items()]
+    result.sort(key=lambda r: r[2], reverse=True)
+    return result[:count]
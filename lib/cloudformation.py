@@ -22,11 +22,13 @@ Author:
 import os
 import time
 import json
+import hashlib
 from botocore.exceptions import ClientError
 
 from . import hosts
 from . import aws
 from . import utils
+from . import telemetry
 
 def get_scenario(var, default = None):
     """Handle getting the appropriate value from a variable using the SCENARIO
@@ -91,6 +93,13 @@ class Ref(dict):
         # Force the format into a JSON compatible format
         return json.dumps(self)
 
+# CloudFormation limits on the size of a template passed inline (TemplateBody)
+# or through S3 (TemplateURL)
+TEMPLATE_BODY_LIMIT = 51200 # bytes
+TEMPLATE_URL_LIMIT = 460800 # bytes
+# Key prefix in the lambda S3 bucket that oversized templates are uploaded under
+TEMPLATE_PREFIX = "cloudformation"
+
 class Arg:
     """Class of static methods to create the CloudFormation template argument
     snippits.
@@ -357,6 +366,31 @@ class Arg:
         }
         return Arg(key, parameter, value)
 
+def s3_url(client, bucket, key):
+    """Build the HTTPS URL of an S3 object, using the endpoint of the region
+    the bucket is located in
+
+    Args:
+        client (S3.Client) : Boto3 S3 client
+        bucket (string) : Name of the S3 bucket
+        key (string) : Key of the object
+
+    Returns:
+        (string) : URL of the object
+    """
+    # us-east-1 buckets have no LocationConstraint and 'EU' is the legacy
+    # name of eu-west-1
+    region = client.get_bucket_location(Bucket=bucket).get('LocationConstraint')
+    region = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}.get(region, region)
+
+    if region == 'us-east-1':
+        host = "s3.amazonaws.com"
+    elif region.startswith('cn-'):
+        host = "s3.{}.amazonaws.com.cn".format(region)
+    else:
+        host = "s3.{}.amazonaws.com".format(region)
+    return "https://{}/{}/{}".format(host, bucket, key)
+
 # Developer Note
 #
 # Template arguments vs Hardcoded values
@@ -411,16 +445,67 @@ class CloudFormationConfiguration:
         """Create the JSON CloudFormation template from the resources that have
         be added to the object.
 
+        If no indent is given the template is serialized in its most compact
+        form, so that as much of the TemplateBody size limit is available for
+        resources as possible.
+
         Args:
             description (string) : Template description
+            indent (None|int) : Indent level for pretty printing the template
 
         Returns:
             (string) : The JSON formatted CloudFormation template
         """
+        separators = (',', ':') if indent is None else None
         return json.dumps({"AWSTemplateFormatVersion" : "2010-09-09",
                            "Description" : description,
                            "Parameters": self.parameters,
-                           "Resources": self.resources}, indent=indent)
+                           "Resources": self.resources}, indent=indent, separators=separators)
+
+    def _template_argument(self, session):
+        """Create the template argument for a create_stack / update_stack /
+        create_change_set call.
+
+        Templates that fit within TEMPLATE_BODY_LIMIT are passed inline as the
+        TemplateBody. Larger templates (or all templates if the UPLOAD_TEMPLATE
+        environmental variable is true) are uploaded to the lambda S3 bucket,
+        under a key derived from the template's content hash, and passed as the
+        TemplateURL. If the object already exists it is not uploaded again.
+
+        Args:
+            session (Session) : Boto3 session used to upload the template
+
+        Returns:
+            (dict) : Dictionary with either the TemplateBody or TemplateURL key
+        """
+        template = self._create_template()
+        size = len(template.encode('utf-8'))
+
+        upload = str(os.environ.get("UPLOAD_TEMPLATE"))
+        upload = upload.lower() in ('yes', 'true', 'y', 't')
+        if size <= TEMPLATE_BODY_LIMIT and not upload:
+            return {"TemplateBody": template}
+
+        if size > TEMPLATE_URL_LIMIT:
+            raise Exception("Template is {} bytes, larger than the {} byte limit for a TemplateURL"
+                                .format(size, TEMPLATE_URL_LIMIT))
+
+        bucket = aws.get_lambda_s3_bucket(session)
+        digest = hashlib.sha256(template.encode('utf-8')).hexdigest()
+        key = "{}/{}.{}.template".format(TEMPLATE_PREFIX, self.stack_name, digest)
+
+        client = session.client('s3')
+        try:
+            client.head_object(Bucket=bucket, Key=key)
+            print("Template {} already uploaded to s3://{}/{}".format(self.stack_name, bucket, key))
+        except ClientError as ex:
+            # A 403 means the template couldn't be checked, not that it is missing
+            if ex.response['Error']['Code'] != '404':
+                raise
+            print("Uploading template {} ({} bytes) to s3://{}/{}".format(self.stack_name, size, bucket, key))
+            client.put_object(Bucket=bucket, Key=key, Body=template.encode('utf-8'))
+
+        return {"TemplateURL": s3_url(client, bucket, key)}
 
     def generate(self):
         """Generate the CloudFormation template and arguments files """
@@ -439,12 +524,23 @@ class CloudFormationConfiguration:
         if len(response['Stacks']) == 0:
             return None
         else:
+            # Use the stack ID, so events can be looked up after a delete
+            stack_id = response['Stacks'][0]['StackId']
+            started = time.time()
+
             print("Waiting for {} ".format(action), end="", flush=True)
-            while get_status(response) == process:
-                time.sleep(5)
-                print(".", end="", flush=True)
-                response = client.describe_stacks(StackName=name)
-            print(" done")
+            try:
+                with telemetry.phase(action):
+                    while get_status(response) == process:
+                        time.sleep(5)
+                        print(".", end="", flush=True)
+                        response = client.describe_stacks(StackName=name)
+                print(" done")
+            finally:
+                try:
+                    telemetry.record_stack_events(client, stack_id, started)
+                except ClientError as ex:
+                    print("Could not record stack events: {}".format(ex))
 
             return get_status(response)
 
@@ -467,11 +563,11 @@ class CloudFormationConfiguration:
         client = session.client('cloudformation')
         response = client.create_stack(
             StackName = self.stack_name,
-            TemplateBody = self._create_template(),
             Parameters = self.arguments,
             Tags = [
                 {"Key": "Commit", "Value": utils.get_commit()}
-            ]
+            ],
+            **self._template_argument(session)
         )
 
         rtn = None
@@ -505,28 +601,29 @@ class CloudFormationConfiguration:
                 raise Exception("Could not determine argument '{}'".format(argument["ParameterKey"]))
 
         client = session.client('cloudformation')
+        template = self._template_argument(session)
 
         disable_preview = str(os.environ.get("DISABLE_PREVIEW"))
         disable_preview = disable_preview.lower() in ('yes', 'true', 'y', 't')
         if disable_preview:
             response = client.update_stack(
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
                 Parameters = self.arguments,
                 Tags = [
                     {"Key": "Commit", "Value": utils.get_commit()}
-                ]
+                ],
+                **template
             )
         else:
             commit = utils.get_commit()
             response = client.create_change_set(
                 ChangeSetName = 'h' + commit,
                 StackName = self.stack_name,
-                TemplateBody = self._create_template(),
                 Parameters = self.arguments,
                 Tags = [
                     {"Key": "Commit", "Value": commit}
-                ]
+                ],
+                **template
             )
 
             try:
@@ -565,8 +662,9 @@ class CloudFormationConfiguration:
                             ", ".join(change['Scope'])
                         ))
 
-                resp = input("Apply Update? [N/y] ")
+                resp = telemetry.prompt("Apply Update? [N/y] ")
                 if len(resp) == 0 or resp[0] not in ('y', 'Y'):
+                    telemetry.cancel()
                     raise Exception()
                 else:
                     response = client.execute_change_set(
@@ -1614,15 +1712,7 @@ class CloudFormationConfiguration:
         """
 
         if file is not None:
-            minified_file = utils.python_minifiy(file)
-            with open(minified_file, "r") as fh:
-                # Warning, sanitizing process does not handle backslashes
-                # in strings properly!
-                code = utils.json_sanitize(fh.read())
-                if len(code) >= 4096:
-                    raise Exception("Lambda code file is too large") # TODO need to figure out if / how to upload a manually created zip file
-
-            code = {"ZipFile": code}
+            code = {"ZipFile": utils.lambda_code(file)}
             if handler is None:
                 handler = "index.handler"
         elif s3 is not None:
@@ -13,33 +13,79 @@
 # limitations under the License.
 
 import time
-from urllib.request import urlopen, HTTPError
+import requests
+from urllib.request import urlopen
+from urllib.error import URLError
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from . import exceptions
 from . import aws
 from .utils import keypair_to_file
-from .ssh import SSHConnection, vault_tunnel
-from .vault import Vault
+from .ssh import tunnel_manager, BASTION_PROXY_PORT
+from .vault import Vault, unseal_all
+
+# Readiness checks are retried quickly at first and then back off up to
+# READY_MAX_INTERVAL seconds between attempts
+READY_INITIAL = 1 # seconds
+READY_MAX_INTERVAL = 15 # seconds
+ATTEMPT_TIMEOUT = 10 # seconds to wait for a single check's response
+
+# Errors raised by a check while the service cannot be reached yet
+# OSError covers URLError, socket.timeout, and refused connections
+NOT_READY_EXCEPTIONS = (OSError,
+                        requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout,
+                        exceptions.SSHError) # includes SSHTunnelError
+
+def wait_for(check, timeout, initial=READY_INITIAL, cap=READY_MAX_INTERVAL):
+    """Call check until it returns True, waiting an exponentially increasing
+    amount of time between attempts.
 
+    Args:
+        check (function) : Function that returns if the service is ready
+        timeout (int) : Number of seconds to wait for check to return True
+        initial (int) : Number of seconds to wait after the first attempt
+        cap (int) : Maximum number of seconds to wait between attempts
 
-def gen_timeout(total, step):
-    """Break the total timeout value into steps
-    that are a specific size.
+    Returns:
+        (float|None) : Number of seconds until check returned True, or None if
+                       check didn't return True before the timeout expired
+
+    Raises:
+        Any error raised by check that is not in NOT_READY_EXCEPTIONS
+    """
+    start = time.time()
+    interval = initial
+    while True:
+        try:
+            if check():
+                return time.time() - start
+        except NOT_READY_EXCEPTIONS:
+            pass # Connection errors mean not ready yet
+
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, cap)
+
+def url_ready(url, timeout=ATTEMPT_TIMEOUT):
+    """Check once if the URL returns a 200 response
 
     Args:
-        total (int) : total number seconds
-        step (int) : length of step
+        url (string) : URL to request
+        timeout (int) : Number of seconds to wait for a response
 
     Returns:
-        (list) : list containing a repeated number of step
-                 plus the remainder if step doesn't evenly divide
+        (bool) : If the URL returned a 200 response
     """
-    times, remainder = divmod(total, step)
-    rtn = [step for i in range(times)]
-    if remainder > 0:
-        rtn.insert(0, remainder) # Sleep for the partial time first
-    return rtn
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return response.getcode() == 200
+    except (URLError, OSError):
+        # HTTPError is a subclass of URLError
+        return False
 
 class ExternalCalls:
     """Class that helps with forming connections from the local machine to machines
@@ -64,12 +110,46 @@ class ExternalCalls:
         self.bastion_ip = aws.machine_lookup(session, self.bastion_hostname)
 
         self.vault_hostname = "vault." + domain
-        ips = aws.machine_lookup_all(session, self.vault_hostname, public_ip=False)
-        self.vaults = [Vault(self.vault_hostname, ip) for ip in ips]
+        self.vault_proxy_port = None
+        self._lookup_vaults()
+
+        # All tunnels and commands share a single connection to the bastion
+        self.tunnels = tunnel_manager(self.keypair_file, self.bastion_ip)
 
-        # keep track of previous connections to limit the need for looking up IP addresses
+        # keep track of previous lookups to limit the need for looking up IP addresses
         self.connections = {}
 
+    def _lookup_vaults(self):
+        """Lookup the private IP addresses of all of the Vault servers"""
+        ips = aws.machine_lookup_all(self.session, self.vault_hostname, public_ip=False)
+        proxy = self.vault_proxy_port if self.vault_proxy_port else True
+        self.vaults = [Vault(self.vault_hostname, ip, proxy=proxy) for ip in ips]
+
+    def _lookup(self, target, type_='ec2'):
+        """Lookup the private IP address of the target machine (AWS instance name)"""
+        key = (target, type_)
+        if key not in self.connections:
+            hostname = target
+            if not hostname.endswith("." + self.domain):
+                hostname += "." + self.domain
+            if type_ == 'ec2':
+                target_ip = aws.machine_lookup(self.session, hostname, public_ip=False)
+            elif type_ == 'rds':
+                target_ip = aws.rds_lookup(self.session, hostname.replace('.', '-'))
+            else:
+                raise Exception("Unsupported: tunnelling to machine type {}".format(type_))
+            self.connections[key] = target_ip
+
+        return self.connections[key]
+
+    @contextmanager
+    def _vault_tunnel(self):
+        """Forward a local port to the proxy running on the bastion"""
+        self.vault_proxy_port = self.tunnels.forward("localhost", BASTION_PROXY_PORT)
+        for vault in self.vaults:
+            vault.set_proxy(self.vault_proxy_port)
+        yield
+
     @contextmanager
     def vault(self):
         class ContextVault(object):
@@ -78,20 +158,22 @@ class ExternalCalls:
                 """Initialize and configure all of the vault servers.
 
                 Lookup all vault IPs for the VPC, initialize and configure the first server
-                and then unseal any other servers.
+                and then unseal all other servers at the same time.
                 """
                 self.vaults[0].initialize()
-                for vault in self.vaults[1:]:
-                    vault.unseal()
+                unseal_all(self.vaults[1:])
 
             @staticmethod
             def unseal():
                 """Unseal all of the vault servers.
 
-                Lookup all vault IPs for the VPC and unseal each server.
+                Lookup all vault IPs for the VPC and unseal all servers at the same time.
+
+                The IPs are looked up again, so any servers that were replaced
+                since the ExternalCalls object was created are included.
                 """
-                for vault in self.vaults:
-                    vault.unseal()
+                self._lookup_vaults()
+                return unseal_all(self.vaults)
 
             @staticmethod
             def read(path):
@@ -106,102 +188,169 @@ class ExternalCalls:
             provision = self.vaults[0].provision
             revoke = self.vaults[0].revoke
 
-        with vault_tunnel(self.keypair_file, self.bastion_ip):
+        with self._vault_tunnel():
             yield ContextVault()
 
+    @contextmanager
     def ssh(self, target):
         """Open a SSH connection to the target machine (AWS instance name) and return a method
         that can be used to execute commands on the remote machines.
+
+        The connection is kept open and reused by later calls.
         """
-        if target not in self.connections:
-            hostname = target
-            if not hostname.endswith("." + self.domain):
-                hostname += "." + self.domain
-            target_ip = aws.machine_lookup(self.session, hostname, public_ip=False)
-            self.connections[target] = SSHConnection(self.keypair_file, target_ip, self.bastion_ip)
+        target_ip = self._lookup(target)
+        yield lambda command: self.tunnels.cmd(target_ip, command)
 
-        return self.connections[target].cmds()
+    def ssh_all(self, target, command, max_workers=8):
+        """Execute a command on all of the target machines (AWS instance name) at the
+        same time.
 
+        Args:
+            target (string) : AWS instance name, which may match multiple machines
+            command (string) : Command to execute
+            max_workers (int) : Maximum number of machines to act on at the same time
+
+        Returns:
+            (list) : List of ssh.HostResult, one per machine
+        """
+        hostname = target
+        if not hostname.endswith("." + self.domain):
+            hostname += "." + self.domain
+        ips = aws.machine_lookup_all(self.session, hostname, public_ip=False)
+        return self.tunnels.run_all(ips, command, max_workers=max_workers)
+
+    @contextmanager
     def tunnel(self, target, port, type_='ec2'):
         """Open a SSH connectio to the target machine (AWS instance name) / port and return the local
         port of the tunnel to connect to.
+
+        The tunnel is kept open and reused by later calls.
         """
-        key = (target, port)
-        if key not in self.connections:
-            hostname = target
-            if not hostname.endswith("." + self.domain):
-                hostname += "." + self.domain
-            if type_ == 'ec2':
-                target_ip = aws.machine_lookup(self.session, hostname, public_ip=False)
-            elif type_ == 'rds':
-                target_ip = aws.rds_lookup(self.session, hostname.replace('.', '-'))
-            else:
-                raise Exception("Unsupported: tunnelling to machine type {}".format(type_))
-            self.connections[key] = SSHConnection(self.keypair_file, (target_ip, port), self.bastion_ip)
+        target_ip = self._lookup(target, type_)
+        yield self.tunnels.forward(target_ip, port)
+
 
-        return self.connections[key].tunnel()
+    def vault_ready(self):
+        """Check once if Vault is accessible"""
+        with self._vault_tunnel():
+            return self.vaults[0].status_check()
+
+    def keycloak_ready(self):
+        """Check once if Keycloak is accessible"""
+        # DP ???: use the actual login url so the actual API is checked..
+        #         (and parse response for 403 unauthorized vs any other error..)
+        with self.tunnel("auth", 8080) as port:
+            # Could move to connecting through the ELB, but then KC will have to be healthy
+            return url_ready("http://localhost:{}/auth/".format(port))
 
+    def _check(self, name, check, timeout, exception, target):
+        elapsed = wait_for(check, timeout)
+        if elapsed is not None:
+            print("{} ready after {:.0f} seconds".format(name, elapsed))
+            return True
+
+        if exception:
+            msg = "Cannot connect to {} after {} seconds".format(name, timeout)
+            raise exceptions.StatusCheckError(msg, target)
+        else:
+            return False
 
     def check_vault(self, timeout, exception=True):
         """Vault status check to see if Vault is accessible
         """
-        with vault_tunnel(self.keypair_file, self.bastion_ip):
-            for sleep in gen_timeout(timeout, 15): # 15 second sleep
-                if self.vaults[0].status_check():
-                    return True
-                time.sleep(sleep)
-
-            if exception:
-                msg = "Cannot connect to Vault after {} seconds".format(timeout)
-                raise exceptions.StatusCheckError(msg, self.vault_hostname)
-            else:
-                return False
+        return self._check("Vault", self.vault_ready, timeout, exception, self.vault_hostname)
 
     def check_keycloak(self, timeout, exception=True):
         """Keycloak status check to see if Keycloak is accessible
         """
-        # DP ???: use the actual login url so the actual API is checked..
-        #         (and parse response for 403 unauthorized vs any other error..)
+        return self._check("Keycloak", self.keycloak_ready, timeout, exception, "auth." + self.domain)
 
-        # SH Manually waiting 30 secs before opening the ssh tunnel
-        #    Have seen tunnel timeout a few times now before the URL returns OK.
-        time.sleep(30)
+    def check_url(self, url, timeout, exception=True):
+        return self._check(url, lambda: url_ready(url), timeout, exception, url)
 
-        with self.tunnel("auth", 8080) as port:
-            # Could move to connecting through the ELB, but then KC will have to be healthy
-            URL = "http://localhost:{}/auth/".format(port)
-
-            for sleep in gen_timeout(timeout, 15): # 15 second sleep
-                try:
-                    res = urlopen(URL)
-                    if res.getcode() == 200:
-                        return True
-                except HTTPError:
-                    pass
-                time.sleep(sleep)
-
-            if exception:
-                msg = "Cannot connect to Keycloak after {} seconds".format(timeout)
-                raise exceptions.StatusCheckError(msg, "auth." + self.domain)
+    def wait_all(self, checks, timeout, exception=True):
+        """Wait for multiple services to become accessible at the same time
+
+            call.wait_all([("Vault", call.vault_ready),
+                           ("Keycloak", call.keycloak_ready),
+                           ("API", lambda: url_ready(api_url))], timeout)
+
+        Args:
+            checks (list) : List of (name, check) tuples, where check is a function
+                            that returns if the service is accessible
+            timeout (int) : Number of seconds to wait for all of the services
+            exception (bool) : If a StatusCheckError should be raised if any
+                               service is not accessible before the timeout
+
+        Returns:
+            (dict) : Dict of service name and the number of seconds until it was
+                     accessible, or None if it was not accessible
+        """
+        with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            futures = [(name, executor.submit(wait_for, check, timeout)) for name, check in checks]
+            results = {name: future.result() for name, future in futures}
+
+        for name, _ in checks:
+            if results[name] is None:
+                print("{} not ready after {} seconds".format(name, timeout))
             else:
-                return False
+                print("{} ready after {:.0f} seconds".format(name, results[name]))
 
-    def check_url(self, url, timeout, exception=True):
-        for sleep in gen_timeout(timeout, 15): # 15 second sleep
-            try:
-                res = urlopen(url)
-                if res.getcode() == 200:
-                    return True
-            except HTTPError:
-                pass
-            time.sleep(sleep)
+        failed = [name for name, _ in checks if results[name] is None]
+        if exception and len(failed) > 0:
+            msg = "Cannot connect to {} after {} seconds".format(", ".join(failed), timeout)
+            raise exceptions.StatusCheckError(msg, ", ".join(failed))
 
-        if exception:
-            msg = "Cannot connect to URL after {} seconds".format(timeout)
-            raise exceptions.StatusCheckError(msg, url)
-        else:
+        return results
+
+    def check_consul(self, count, instance_ids=()):
+        """Consul status check to see if at least count servers of the Consul
+        cluster are alive, including the servers on the given instances
+
+        The Consul instance to query is looked up for each call, as instances
+        may have been replaced since the last call.
+
+        Args:
+            count (int) : Number of alive Consul servers required
+            instance_ids (list) : IDs of EC2 instances that have to be alive
+                                  servers in the cluster, like the replacement
+                                  instances during a rolling restart
+
+        Returns:
+            (bool) : If the Consul cluster has count alive servers, including
+                     the given instances
+        """
+        hostname = "consul." + self.domain
+        target_ip = aws.machine_lookup(self.session, hostname, public_ip=False)
+        if target_ip is None:
             return False
 
+        required = set()
+        if len(instance_ids) > 0:
+            client = self.session.client('ec2')
+            response = client.describe_instances(InstanceIds=list(instance_ids))
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    if 'PrivateIpAddress' not in instance:
+                        return False # Not fully launched yet
+                    required.add(instance['PrivateIpAddress'])
+
+        try:
+            result = self.tunnels.connection(target_ip).run("consul members -status=alive")
+        except (exceptions.SSHError, exceptions.SSHTunnelError):
+            return False
+        if result.returncode != 0:
+            return False
+
+        # Columns: Node Address Status Type Build Protocol DC
+        servers = set()
+        for line in result.stdout.splitlines()[1:]:
+            columns = line.split()
+            if len(columns) >= 4 and columns[2] == 'alive' and columns[3] == 'server':
+                servers.add(columns[1].rsplit(':', 1)[0])
+
+        return len(servers) >= count and required.issubset(servers)
+
     def check_django(self, machine, manage_py, exception=True):
         cmd = "sudo python3 {} check 2> /dev/null > /dev/null".format(manage_py) # suppress all output
 
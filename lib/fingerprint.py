@@ -0,0 +1,179 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for computing the fingerprint of the inputs of a Packer build.
+
+An image's fingerprint is a hash of every file that can change the image:
+the Salt states and pillars applied to the image's minion id by the top
+files, any states they reference, the Packer template, the Packer variable
+file, and any extra values (like the source AMI).
+
+States are tracked at the level of top level state directories, so if any
+file under salt/<name>/ (including the submodules in files/) changes the
+fingerprint of every image that uses a <name> state changes.
+"""
+
+import os
+import re
+import glob
+import json
+import hashlib
+from fnmatch import fnmatch
+
+from .constants import repo_path
+from .utils import build_manifest
+
+SALT_ROOT = repo_path("salt_stack", "salt")
+PILLAR_ROOT = repo_path("salt_stack", "pillar")
+PACKER_FILE = repo_path("packer", "vm.packer")
+
+# References from one state file to another state directory
+_REFERENCES = [
+    re.compile(r"^\s*-\s*([\w.-]+)\s*$"),           # include list item
+    re.compile(r"\bsls\s*:\s*([\w.-]+)"),           # require / watch sls
+    re.compile(r"salt://([\w.-]+)/"),               # file source
+    re.compile(r"""(?:from|import|include)\s+["']([\w.-]+)/"""), # jinja import
+]
+
+def parse_top(top_file):
+    """Parse a Salt top file into the list of states for each target
+
+    Only the simple glob target / list of states format used by this
+    repository is supported.
+
+    Args:
+        top_file (string) : Path to the top.sls file
+
+    Returns:
+        (list) : List of (target glob, [state names]) tuples
+    """
+    targets = []
+    with open(top_file, 'r') as fh:
+        for line in fh:
+            line = line.split('#', 1)[0].rstrip()
+            if len(line.strip()) == 0:
+                continue
+
+            match = re.match(r"^\s+['\"]?([^'\":]+)['\"]?\s*:\s*$", line)
+            if match:
+                targets.append((match.group(1), []))
+                continue
+
+            match = re.match(r"^\s+-\s*([\w.-]+)\s*$", line)
+            if match and len(targets) > 0:
+                targets[-1][1].append(match.group(1))
+    return targets
+
+def top_states(top_file, minion_id):
+    """Get the states in a top file that are applied to the given minion
+
+    Args:
+        top_file (string) : Path to the top.sls file
+        minion_id (string) : Salt minion id of the machine
+
+    Returns:
+        (list) : List of state names
+    """
+    states = []
+    for target, names in parse_top(top_file):
+        if fnmatch(minion_id, target):
+            states.extend(n for n in names if n not in states)
+    return states
+
+def state_dirs(states, salt_root=SALT_ROOT):
+    """Find all of the top level state directories the given states depend on
+
+    Args:
+        states (list) : List of state names
+        salt_root (string) : Path to the Salt state tree
+
+    Returns:
+        (list) : Sorted list of top level state directory names
+    """
+    found = set()
+    pending = [s.split('.')[0] for s in states]
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in found:
+            continue
+        path = os.path.join(salt_root, name)
+        if not os.path.isdir(path):
+            continue
+        found.add(name)
+
+        for file in glob.glob(os.path.join(path, '**', '*.sls'), recursive=True) + \
+                    glob.glob(os.path.join(path, '**', '*.jinja'), recursive=True):
+            with open(file, 'r') as fh:
+                for line in fh:
+                    for regex in _REFERENCES:
+                        for ref in regex.findall(line):
+                            ref = ref.split('.')[0]
+                            if ref not in found:
+                                pending.append(ref)
+    return sorted(found)
+
+def pillar_files(minion_id, pillar_root=PILLAR_ROOT):
+    """Find the pillar files applied to the given minion
+
+    Args:
+        minion_id (string) : Salt minion id of the machine
+        pillar_root (string) : Path to the Salt pillar tree
+
+    Returns:
+        (dict) : Dictionary of {name: path} for the pillar files and directories
+    """
+    top_file = os.path.join(pillar_root, "top.sls")
+    files = {"top.sls": top_file}
+    for name in top_states(top_file, minion_id):
+        path = os.path.join(pillar_root, *name.split('.'))
+        if os.path.isdir(path):
+            files[name] = path
+        elif os.path.exists(path + ".sls"):
+            files[name] = path + ".sls"
+    return files
+
+def fingerprint(variable_file, extra=None, salt_root=SALT_ROOT, pillar_root=PILLAR_ROOT, packer_file=PACKER_FILE):
+    """Compute the fingerprint of all of the inputs of an image build
+
+    Args:
+        variable_file (string) : Path to the Packer variable file for the image
+        extra (None|dict) : Additional values that change the image, like the source AMI
+        salt_root (string) : Path to the Salt state tree
+        pillar_root (string) : Path to the Salt pillar tree
+        packer_file (string) : Path to the Packer template
+
+    Returns:
+        (string) : Hex digest of the fingerprint
+    """
+    with open(variable_file, 'r') as fh:
+        minion_id = json.load(fh)["name"]
+
+    top_file = os.path.join(salt_root, "top.sls")
+    sources = {
+        "packer": packer_file,
+        "variables": variable_file,
+        "salt/top.sls": top_file,
+    }
+    for name in state_dirs(top_states(top_file, minion_id), salt_root):
+        sources["salt/" + name] = os.path.join(salt_root, name)
+    for name, path in pillar_files(minion_id, pillar_root).items():
+        sources["pillar/" + name] = path
+
+    manifest = build_manifest(sources)
+    hash = hashlib.sha256()
+    for name in sorted(manifest):
+        hash.update('{} {}\n'.format(name, manifest[name][0]).encode())
+    for key in sorted(extra or {}):
+        hash.update('{}={}\n'.format(key, extra[key]).encode())
+    return hash.hexdigest()
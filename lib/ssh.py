@@ -18,26 +18,65 @@ import os
 import signal
 import sys
 import time
-import random
-
-from contextlib import contextmanager
+import socket
+import shutil
+import atexit
+import tempfile
+import threading
+import io
+import json
+import tarfile
+
+from contextlib import contextmanager, ExitStack
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from .exceptions import SSHError, SSHTunnelError
+from .utils import build_manifest
 
 # Needed to prevent ssh from asking about the fingerprint from new machines
 SSH_OPTIONS = "-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -q"
-TUNNEL_SLEEP = 10 # seconds
+TUNNEL_TIMEOUT = 30 # seconds to wait for a tunnel to accept connections
+TUNNEL_POLL = 0.1 # seconds between checks of the tunnel's local port
+FORWARD_ATTEMPTS = 3 # number of located ports to try when creating a forward
+BASTION_PROXY_PORT = 3128 # port of the HTTP proxy on the bastion used to reach Vault
+FANOUT_WORKERS = 8 # default number of machines to act on at the same time
+SYNC_MANIFEST = ".boss-manifest.json" # file in a synced directory recording the synced files
+SYNC_DELETED = ".boss-deleted" # temporary file listing files to remove after a sync
+
+# Ports handed out by locate_port(), so the same port is never given out
+# twice by this process, even if the first user has not bound it yet
+_allocated_ports = set()
+_allocated_ports_lock = threading.Lock()
 
 def locate_port():
-    """Locate a local port to attach a SSH tunnel to.
+    """Locate a free local port to attach a SSH tunnel to.
 
-    Instead of trying to figure out if a port is in use, assume that it will
-    not be in use.
+    The OS is asked for a free ephemeral port by binding to port 0. The port
+    is then released, so that SSH can bind to it, and recorded so that it is
+    not handed out again by this process.
 
     Returns:
         (int) : Local port to use
     """
-    return random.randint(10000,60000)
+    with _allocated_ports_lock:
+        while True:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind(("localhost", 0))
+                port = sock.getsockname()[1]
+
+            if port not in _allocated_ports:
+                _allocated_ports.add(port)
+                return port
+
+def release_port(port):
+    """Allow a port returned by locate_port() to be handed out again.
+
+    Args:
+        port (int) : Local port that is no longer in use
+    """
+    with _allocated_ports_lock:
+        _allocated_ports.discard(port)
 
 def become_tty_fg():
     """Force a subprocess call to become the foreground process.
@@ -57,6 +96,41 @@ def become_tty_fg():
     os.tcsetpgrp(tty, os.getpgrp())
     signal.signal(signal.SIGTTOU, hdlr)
 
+def wait_for_port(proc, port, timeout=TUNNEL_TIMEOUT):
+    """Wait for the SSH process to start accepting connections on the local port.
+
+    Args:
+        proc (Popen) : Popen process object of the SSH tunnel
+        port (int) : Local port the SSH tunnel is listening on
+        timeout (int) : Number of seconds to wait for the port to accept connections
+
+    Raises:
+        SSHError : If the SSH process could not establish the connection
+        SSHTunnelError : If the SSH process exited or the port did not accept
+                         connections before the timeout expired
+    """
+    expire = time.time() + timeout
+    while True:
+        ret = proc.poll()
+        if ret is not None:
+            if ret == 255:
+                raise SSHError("Error establishing a SSH tunnel")
+            else:
+                raise SSHTunnelError("SSH tunnel exited with error code {}".format(ret))
+
+        try:
+            with socket.create_connection(("localhost", port), timeout=TUNNEL_POLL):
+                return # tunnel is up
+        except OSError:
+            pass
+
+        if time.time() >= expire:
+            proc.terminate()
+            proc.wait()
+            raise SSHTunnelError("SSH tunnel did not accept connections on port {} within {} seconds"
+                                    .format(port, timeout))
+        time.sleep(TUNNEL_POLL)
+
 def check_ssh(ret):
     if ret == 255:
         raise SSHError("Error establishing a SSH connection")
@@ -64,13 +138,21 @@ def check_ssh(ret):
 class ProcWrapper(list):
     """Wrapper that holds multiple Popen objects and can call
     terminate and wait on all contained objects.
+
+    Local ports from locate_port() used by the contained tunnels are added
+    to ports and are released by wait().
     """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.ports = []
     def prepend(self, item):
         self.insert(0, item)
     def terminate(self):
         [item.terminate() for item in self]
     def wait(self):
         [item.wait() for item in self]
+        [release_port(port) for port in self.ports]
+        self.ports = []
 
 def create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_user="ec2-user", bastion_port=22):
     """Create a SSH tunnel.
@@ -89,7 +171,8 @@ def create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_u
     Returns:
         (Popen) : Popen process object of the SSH tunnel
     """
-    fwd_cmd_fmt = "ssh -i {} {} -N -L {}:{}:{} -p {} {}@{}"
+    # ExitOnForwardFailure causes ssh to exit if the local port cannot be bound
+    fwd_cmd_fmt = "ssh -i {} {} -o ExitOnForwardFailure=yes -N -L {}:{}:{} -p {} {}@{}"
     fwd_cmd = fwd_cmd_fmt.format(key,
                                  SSH_OPTIONS,
                                  local_port,
@@ -100,15 +183,7 @@ def create_tunnel(key, local_port, remote_ip, remote_port, bastion_ip, bastion_u
                                  bastion_ip)
 
     proc = subprocess.Popen(shlex.split(fwd_cmd))
-
-    try:
-        r = proc.wait(TUNNEL_SLEEP)
-        if r == 255:
-            raise SSHError("Error establishing a SSH tunnel")
-        else:
-            raise SSHTunnelError("SSH tunnel exited with error code {}".format(ret))
-    except subprocess.TimeoutExpired:
-        pass # process is still running, tunnel is up
+    wait_for_port(proc, local_port)
 
     return proc
 
@@ -150,23 +225,24 @@ def create_tunnel_aplnis(key, local_port, remote_ip, remote_port, bastion_ip, ba
         #print("Using Bastion host at {}".format(apl_bastion_ip))
         wrapper = ProcWrapper()
         port = locate_port()
+        wrapper.ports.append(port)
 
         # Used http://superuser.com/questions/96489/ssh-tunnel-via-multiple-hops mssh.pl
         # to figure out the multiple tunnels
 
-        # Open up a SSH tunnel to bastion_ip:22 through apl_bastion_ip
-        # (to allow the second tunnel to be created)
-        proc = create_tunnel(apl_bastion_key, port, bastion_ip, 22, apl_bastion_ip, apl_bastion_user)
-        wrapper.prepend(proc)
-
         try:
+            # Open up a SSH tunnel to bastion_ip:22 through apl_bastion_ip
+            # (to allow the second tunnel to be created)
+            proc = create_tunnel(apl_bastion_key, port, bastion_ip, 22, apl_bastion_ip, apl_bastion_user)
+            wrapper.prepend(proc)
+
             # Create our normal tunnel, but connect to localhost:port to use the
             # first tunnel that we create
             proc = create_tunnel(key, local_port, remote_ip, remote_port, "localhost", bastion_user, port)
             wrapper.prepend(proc)
             return wrapper
         except:
-            # close the initial tunnel
+            # close the initial tunnel and release its port
             wrapper.terminate()
             wrapper.wait()
             raise # raise initial exception
@@ -197,6 +273,453 @@ def create_tunnel_bastion(local_port, remote_ip, remote_port):
         proc = create_tunnel(apl_bastion_key, local_port, remote_ip, remote_port, apl_bastion_ip, apl_bastion_user)
         return proc
 
+# The result of executing a command or copying a file on one machine
+HostResult = namedtuple('HostResult', ['host', 'returncode', 'stdout', 'stderr', 'duration'])
+
+class ControlMaster(object):
+    """A persistent OpenSSH ControlMaster connection.
+
+    Once started, port forwards, commands, and proxied connections are
+    multiplexed over the single authenticated connection, instead of each
+    performing a full SSH handshake.
+    """
+    def __init__(self, key, host, port=22, user="ec2-user", proxy=None):
+        """ControlMaster constructor
+
+        Args:
+            key (string) : Path to a SSH private key, protected as required by SSH
+            host (string) : IP of the machine to connect to
+            port (int) : Port on host to connect to
+            user (string) : User account on host to connect as
+            proxy (None|string) : ProxyCommand to use when connecting to host
+        """
+        self.key = key
+        self.host = host
+        self.port = port
+        self.user = user
+        self.proxy = proxy
+
+        self.proc = None
+        self.lock = threading.Lock()
+        # Unix socket paths are limited in length, so use a short temp directory
+        self.control_dir = tempfile.mkdtemp(prefix="boss-ssh-")
+        self.control_path = os.path.join(self.control_dir, "control")
+
+    def _options(self):
+        """Build the ssh / scp options that use the control socket"""
+        opts = ["-i", self.key] + shlex.split(SSH_OPTIONS)
+        opts += ["-o", "ControlPath=" + self.control_path]
+        if self.proxy:
+            opts += ["-o", "ProxyCommand=" + self.proxy]
+        return opts
+
+    def _ssh(self, *args):
+        """Build a ssh command line that uses the control socket"""
+        cmd = ["ssh"] + self._options() + ["-p", str(self.port)]
+        cmd += list(args)
+        cmd.append("{}@{}".format(self.user, self.host))
+        return cmd
+
+    def _control(self, *args):
+        """Send a control command to the master process
+
+        Returns:
+            (int) : Return code of the control command
+        """
+        return subprocess.call(self._ssh(*args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self, timeout=TUNNEL_TIMEOUT):
+        """Start the master connection, if it is not already running
+
+        Args:
+            timeout (int) : Number of seconds to wait for the connection
+
+        Raises:
+            SSHError : If the SSH connection could not be established
+            SSHTunnelError : If the connection was not ready before the timeout expired
+        """
+        with self.lock:
+            if self.alive:
+                return
+
+            cmd = self._ssh("-o", "ControlMaster=yes",
+                            "-o", "ControlPersist=no",
+                            "-o", "ServerAliveInterval=30",
+                            "-o", "ExitOnForwardFailure=yes",
+                            "-N")
+            self.proc = subprocess.Popen(cmd)
+
+            expire = time.time() + timeout
+            while self._control("-O", "check") != 0:
+                ret = self.proc.poll()
+                if ret is not None:
+                    check_ssh(ret)
+                    raise SSHTunnelError("SSH connection exited with error code {}".format(ret))
+
+                if time.time() >= expire:
+                    self.close()
+                    raise SSHTunnelError("SSH connection to {} not ready within {} seconds"
+                                            .format(self.host, timeout))
+                time.sleep(TUNNEL_POLL)
+
+    def forward(self, local_port, remote_ip, remote_port):
+        """Forward localhost:local_port to remote_ip:remote_port through the connection
+
+        Raises:
+            SSHTunnelError : If the port forward could not be created
+        """
+        fwd = "{}:{}:{}".format(local_port, remote_ip, remote_port)
+        if self._control("-O", "forward", "-L", fwd) != 0:
+            raise SSHTunnelError("Could not forward local port {} to {}:{}"
+                                    .format(local_port, remote_ip, remote_port))
+
+    def cancel(self, local_port, remote_ip, remote_port):
+        """Remove a port forward created by forward()"""
+        fwd = "{}:{}:{}".format(local_port, remote_ip, remote_port)
+        self._control("-O", "cancel", "-L", fwd)
+
+    def command(self, command):
+        """Execute a command on the remote machine
+
+        Args:
+            command (string) : Command to execute
+
+        Returns:
+            (int) : Return code of the command
+        """
+        ret = subprocess.call(self._ssh() + [command])
+        check_ssh(ret)
+        return ret
+
+    def run(self, command):
+        """Execute a command on the remote machine and capture its output
+
+        Args:
+            command (string) : Command to execute
+
+        Returns:
+            (CompletedProcess) : Result of the command, with stdout and stderr as strings
+        """
+        return subprocess.run(self._ssh() + [command],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def copy(self, local_file, remote_file, upload=False):
+        """Copy a file to or from the remote machine using scp
+
+        Args:
+            local_file (string) : Local file path to upload from or download to
+            remote_file (string) : Remote file path to upload from or download to
+            upload (bool) : If the local file is being uploaded to the remote file
+
+        Returns:
+            (CompletedProcess) : Result of the scp command, with stdout and stderr as strings
+        """
+        remote = "{}@{}:{}".format(self.user, self.host, remote_file)
+        files = [local_file, remote] if upload else [remote, local_file]
+        return subprocess.run(["scp"] + self._options() + ["-P", str(self.port)] + files,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def sync(self, sources, remote_dir):
+        """Copy files and directories to the remote machine, transferring only
+        the files that changed since the last sync to remote_dir.
+
+        A manifest of file hashes is kept in remote_dir. All changed files
+        are sent as a single compressed tar stream and files that no longer
+        exist locally are removed from remote_dir.
+
+        Args:
+            sources (dict) : Dictionary of {name in the remote directory: local file or directory path}
+            remote_dir (string) : Directory on the remote machine to sync the files to
+
+        Returns:
+            (dict) : Dictionary with the number of 'changed', 'unchanged', and 'deleted' files
+
+        Raises:
+            SSHError : If the files could not be transferred
+        """
+        local = build_manifest(sources)
+
+        remote_dir_ = shlex.quote(remote_dir)
+        result = self.run("cat {}/{} 2> /dev/null".format(remote_dir_, SYNC_MANIFEST))
+        try:
+            remote = json.loads(result.stdout) if result.returncode == 0 else {}
+        except ValueError:
+            remote = {}
+
+        changed = [name for name in local if remote.get(name) != local[name][0]]
+        deleted = [name for name in remote if name not in local]
+
+        # Files are extracted before the removed files are deleted
+        cmd = ("mkdir -p {dir} && cd {dir} && tar xzf - && "
+               "xargs -0 rm -f < {deleted} && rm -f {deleted}").format(dir=remote_dir_, deleted=SYNC_DELETED)
+        proc = subprocess.Popen(self._ssh() + [cmd], stdin=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|gz') as tar:
+                for name in changed:
+                    tar.add(local[name][1], arcname=name, recursive=False)
+
+                def add_data(name, data):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    tar.addfile(info, io.BytesIO(data))
+
+                add_data(SYNC_DELETED, "\0".join(deleted).encode())
+                add_data(SYNC_MANIFEST, json.dumps({k: v[0] for k, v in local.items()}).encode())
+        except BrokenPipeError:
+            pass # ssh exited early, the return code is checked below
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            ret = proc.wait()
+
+        check_ssh(ret)
+        if ret != 0:
+            raise SSHError("Problem syncing files to {}:{}".format(self.host, remote_dir))
+
+        return {'changed': len(changed),
+                'unchanged': len(local) - len(changed),
+                'deleted': len(deleted)}
+
+    def proxy_command(self):
+        """Get a ProxyCommand that connects through this connection
+
+        Returns:
+            (string) : ProxyCommand value for use in ssh's -o argument
+        """
+        return "ssh -o ControlPath={} -W %h:%p -p {} {}@{}".format(self.control_path,
+                                                                   self.port,
+                                                                   self.user,
+                                                                   self.host)
+
+    def close(self):
+        """Close the master connection, including all forwards and sessions"""
+        if self.alive:
+            self._control("-O", "exit")
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.terminate()
+                self.proc.wait()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+class SSHTunnelManager(object):
+    """Manage persistent SSH connections through a VPC's bastion machine.
+
+    A single connection to the bastion is kept open and is used for all
+    port forwards and as the proxy for connections to machines within the
+    VPC. If the bastion environmental variables are defined the bastion
+    connection is made through that machine.
+
+    Connections are opened on demand and are closed by close() or when
+    the process exits.
+    """
+    def __init__(self, key, bastion_ip, bastion_user="ec2-user"):
+        """SSHTunnelManager constructor
+
+        Args:
+            key (string) : Path to a SSH private key, protected as required by SSH
+            bastion_ip (string) : IP of the VPC's bastion machine
+            bastion_user (string) : User account on the bastion machine
+        """
+        self.key = key
+        self.lock = threading.Lock()
+
+        proxy = None
+        apl_bastion_ip = os.environ.get("BASTION_IP")
+        apl_bastion_key = os.environ.get("BASTION_KEY")
+        apl_bastion_user = os.environ.get("BASTION_USER")
+        if apl_bastion_ip is not None and apl_bastion_key is not None and apl_bastion_user is not None:
+            # traffic
+            # localhost -> apl_bastion -> bastion -> remote
+            proxy = "ssh -i {} {} -W %h:%p {}@{}".format(apl_bastion_key,
+                                                         SSH_OPTIONS,
+                                                         apl_bastion_user,
+                                                         apl_bastion_ip)
+
+        self.bastion = ControlMaster(key, bastion_ip, 22, bastion_user, proxy)
+        self.connections = {} # (ip, port, user) : ControlMaster
+        self.forwards = {} # (ip, port) : local port
+
+    def forward(self, remote_ip, remote_port, local_port=None):
+        """Forward a local port to remote_ip:remote_port through the bastion
+
+        Forwards are kept open until the manager is closed, so repeated
+        calls for the same remote_ip:remote_port return the same local port.
+
+        Args:
+            remote_ip (string) : IP of the machine the forward should point at
+                                 (relative to the bastion machine)
+            remote_port (int) : Port on remote_ip the forward should point at
+            local_port (None|int) : Local port to use, or None to locate a port
+
+        Returns:
+            (int) : Local port that is forwarded to remote_ip:remote_port
+        """
+        self.bastion.start()
+
+        key = (remote_ip, remote_port)
+        with self.lock:
+            if key not in self.forwards:
+                if local_port is not None:
+                    self.bastion.forward(local_port, remote_ip, remote_port)
+                else:
+                    # Another process may bind the located port before SSH does
+                    for attempt in range(FORWARD_ATTEMPTS):
+                        local_port = locate_port()
+                        try:
+                            self.bastion.forward(local_port, remote_ip, remote_port)
+                            break
+                        except SSHTunnelError:
+                            release_port(local_port)
+                            if attempt == FORWARD_ATTEMPTS - 1:
+                                raise
+                self.forwards[key] = local_port
+            return self.forwards[key]
+
+    def connection(self, remote_ip, remote_port=22, remote_user="ubuntu"):
+        """Get the started connection to a machine within the VPC
+
+        Args:
+            remote_ip (string) : IP of the machine to connect to
+            remote_port (int) : Port of the SSH server on remote_ip
+            remote_user (string) : User account on remote_ip to connect as
+
+        Returns:
+            (ControlMaster) : Connection to remote_ip, proxied through the bastion
+        """
+        self.bastion.start()
+
+        key = (remote_ip, remote_port, remote_user)
+        with self.lock:
+            if key not in self.connections:
+                self.connections[key] = ControlMaster(self.key,
+                                                      remote_ip,
+                                                      remote_port,
+                                                      remote_user,
+                                                      self.bastion.proxy_command())
+            conn = self.connections[key]
+
+        # Started outside of the lock so different machines can connect in parallel
+        conn.start()
+        return conn
+
+    def cmd(self, remote_ip, command, remote_user="ubuntu"):
+        """Execute a command on a machine within the VPC
+
+        Args:
+            remote_ip (string) : IP of the machine to execute the command on
+            command (string) : Command to execute
+            remote_user (string) : User account on remote_ip to connect as
+
+        Returns:
+            (int) : Return code of the command
+        """
+        return self.connection(remote_ip, remote_user=remote_user).command(command)
+
+    def _fanout(self, remote_ips, remote_user, action, max_workers):
+        """Call action(connection) for each machine, using at most max_workers
+        threads at the same time
+
+        Returns:
+            (list) : List of HostResult, in the same order as remote_ips
+        """
+        def run(ip):
+            start = time.time()
+            try:
+                result = action(self.connection(ip, remote_user=remote_user))
+                ret, out, err = result.returncode, result.stdout, result.stderr
+            except (SSHError, SSHTunnelError) as ex:
+                ret, out, err = 255, "", str(ex)
+            return HostResult(ip, ret, out, err, time.time() - start)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(run, remote_ips))
+
+    def run_all(self, remote_ips, command, remote_user="ubuntu", max_workers=FANOUT_WORKERS):
+        """Execute a command on multiple machines within the VPC at the same time
+
+        Args:
+            remote_ips (list) : IPs of the machines to execute the command on
+            command (string) : Command to execute
+            remote_user (string) : User account on the machines to connect as
+            max_workers (int) : Maximum number of machines to act on at the same time
+
+        Returns:
+            (list) : List of HostResult, in the same order as remote_ips
+        """
+        return self._fanout(remote_ips, remote_user, lambda conn: conn.run(command), max_workers)
+
+    def copy_all(self, remote_ips, local_file, remote_file, upload=True, remote_user="ubuntu", max_workers=FANOUT_WORKERS):
+        """Copy a file to or from multiple machines within the VPC at the same time
+
+        Note: When downloading, local_file may contain '{}', which is replaced
+              by each machine's IP, so the downloads don't overwrite each other
+
+        Args:
+            remote_ips (list) : IPs of the machines to copy the file to or from
+            local_file (string) : Local file path to upload from or download to
+            remote_file (string) : Remote file path to upload from or download to
+            upload (bool) : If the local file is being uploaded to the remote file
+            remote_user (string) : User account on the machines to connect as
+            max_workers (int) : Maximum number of machines to act on at the same time
+
+        Returns:
+            (list) : List of HostResult, in the same order as remote_ips
+        """
+        def copy(conn):
+            return conn.copy(local_file.replace("{}", conn.host), remote_file, upload)
+        return self._fanout(remote_ips, remote_user, copy, max_workers)
+
+    def close(self):
+        """Close all of the connections and forwards"""
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            for port in self.forwards.values():
+                release_port(port)
+            self.connections = {}
+            self.forwards = {}
+        self.bastion.close()
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def tunnel_manager(key, bastion_ip, bastion_user="ec2-user"):
+    """Get the shared SSHTunnelManager for the given bastion
+
+    Args:
+        key (string) : Path to a SSH private key, protected as required by SSH
+        bastion_ip (string) : IP of the VPC's bastion machine
+        bastion_user (string) : User account on the bastion machine
+
+    Returns:
+        (SSHTunnelManager) : Tunnel manager shared by all callers in this process
+    """
+    key_ = (key, bastion_ip, bastion_user)
+    with _managers_lock:
+        if key_ not in _managers:
+            _managers[key_] = SSHTunnelManager(*key_)
+        return _managers[key_]
+
+@atexit.register
+def close_tunnel_managers():
+    """Close all of the shared SSHTunnelManagers"""
+    with _managers_lock:
+        for manager in _managers.values():
+            manager.close()
+        _managers.clear()
+
 def unpack(obj, *args):
     if type(obj) == tuple:
         args_ = list(args)[len(obj)-1:]
@@ -205,11 +728,62 @@ def unpack(obj, *args):
         return (obj, *args)
 
 class SSHConnection(object):
+    """SSH connection to a machine, possibly through bastion machine(s)
+
+    Each call creates the needed tunnel(s) and a connection, unless used as a
+    context manager, in which case the tunnel(s) and a single ControlMaster
+    connection are kept open and reused by run(), sync(), cmd(), cmds(),
+    scp(), and scps() until the context exits.
+
+        with SSHConnection(key, target, bastion) as ssh:
+            ssh.run("command to execute")
+            ssh.sync(sources, remote_dir)
+    """
     def __init__(self, key, target, bastion=None, local_port=None):
         self.key = key
         self.remote_ip, self.remote_port, self.remote_user = unpack(target, 22, "ubuntu")
         self.bastion_ip, self.bastion_port, self.bastion_user = unpack(bastion, 22, "ec2-user")
-        self.local_port = local_port if local_port else random.randint(10000,60000)
+        # If None, a port is located for each connection and released afterwards
+        self.local_port = local_port
+
+        self.master = None
+        self._stack = None
+
+    def __enter__(self):
+        stack = ExitStack()
+        try:
+            self.master = stack.enter_context(self._master())
+        except:
+            stack.close()
+            raise
+        self._stack = stack
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.master = None
+        stack, self._stack = self._stack, None
+        stack.close()
+
+    @contextmanager
+    def _master(self):
+        """Get the started ControlMaster connection to the remote machine,
+        reusing the connection opened by __enter__() if there is one
+
+        Returns:
+            (ControlMaster) : Started connection to the remote machine
+        """
+        if self.master is not None:
+            yield self.master
+            return
+
+        with self._connect() as host_port:
+            host, port = host_port
+            master = ControlMaster(self.key, host, port, self.remote_user)
+            master.start()
+            try:
+                yield master
+            finally:
+                master.close()
 
     @contextmanager
     def _connect(self):
@@ -229,29 +803,34 @@ class SSHConnection(object):
                                   connect to localhost or remote_ip (depending
                                   on if a tunnel(s) was created
         """
-        if self.bastion_ip:
-            proc = create_tunnel_aplnis(self.key,
-                                        self.local_port, 
-                                        self.remote_ip,
-                                        self.remote_port, 
-                                        self.bastion_ip, 
-                                        self.bastion_user)
-        else:
-            proc = create_tunnel_bastion(self.local_port,
-                                         self.remote_ip,
-                                         self.remote_port)
-
-        if proc:
-            args = ("localhost", self.local_port)
-        else:
-            args = (self.remote_ip, self.remote_port)
-
+        local_port = self.local_port if self.local_port else locate_port()
         try:
-            yield args
-        finally:
+            if self.bastion_ip:
+                proc = create_tunnel_aplnis(self.key,
+                                            local_port,
+                                            self.remote_ip,
+                                            self.remote_port,
+                                            self.bastion_ip,
+                                            self.bastion_user)
+            else:
+                proc = create_tunnel_bastion(local_port,
+                                             self.remote_ip,
+                                             self.remote_port)
+
             if proc:
-                proc.terminate()
-                proc.wait()
+                args = ("localhost", local_port)
+            else:
+                args = (self.remote_ip, self.remote_port)
+
+            try:
+                yield args
+            finally:
+                if proc:
+                    proc.terminate()
+                    proc.wait()
+        finally:
+            if local_port != self.local_port:
+                release_port(local_port)
 
     def shell(self):
         """Create SSH tunnel(s) through bastion machine(s) and start a foreground
@@ -283,16 +862,11 @@ class SSHConnection(object):
             scp(local_file, remote_file, upload=False)
             scp(local_file, remote_file, upload=True)
         """
-        with self._connect() as host_port:
-            host, port = host_port
+        with self._master() as master:
             def scp(local_file, remote_file, upload=False):
-                first = local_file if upload else ""
-                second = "" if upload else local_file
-                scp_str = "scp -i {} {} -P {} {} {}@{}:{} {}" \
-                                .format(self.key, SSH_OPTIONS, port, first, self.remote_user, host, remote_file, second)
-                ret = subprocess.call(shlex.split(scp_str))
-                check_ssh(ret)
-                return ret
+                result = master.copy(local_file, remote_file, upload)
+                check_ssh(result.returncode)
+                return result.returncode
 
             yield scp
 
@@ -352,17 +926,38 @@ class SSHConnection(object):
             cmd("command to execute")
             cmd("command to execute")
         """
-        with self._connect() as host_port:
-            host, port = host_port
-            def cmd(command):
-                ssh_cmd_str = "ssh -i {} {} -p {} {}@{} '{}'" \
-                                    .format(self.key, SSH_OPTIONS, port, self.remote_user, host, command)
+        # All commands share a single connection
+        with self._master() as master:
+            yield master.command
+
+    def run(self, command):
+        """Create SSH tunnel(s) through bastion machine(s) and execute a command over
+        SSH, capturing its output.
+
+        Args:
+            command (string) : Command to execute on remote_ip
+
+        Returns:
+            (CompletedProcess) : Result of the command, with stdout and stderr as strings
+        """
+        with self._master() as master:
+            return master.run(command)
 
-                ret = subprocess.call(shlex.split(ssh_cmd_str))
-                check_ssh(ret)
-                return ret
+    def sync(self, sources, remote_dir):
+        """Create SSH tunnel(s) through bastion machine(s) and copy the files and
+        directories that changed since the last sync to remote_dir.
 
-            yield cmd
+        See ControlMaster.sync() for details.
+
+        Args:
+            sources (dict) : Dictionary of {name in the remote directory: local file or directory path}
+            remote_dir (string) : Directory on the remote machine to sync the files to
+
+        Returns:
+            (dict) : Dictionary with the number of 'changed', 'unchanged', and 'deleted' files
+        """
+        with self._master() as master:
+            return master.sync(sources, remote_dir)
 
     def cmd(self, command = None):
         """Create SSH tunnel(s) through bastion machine(s) and execute a command over
@@ -390,9 +985,9 @@ class SSHConnection(object):
         """Create SSH tunnel(s) through bastion machine(s), setup a SSH tunnel,
         and return the local port to connect to.
         """
-        with self._connect():
+        with self._connect() as host_port:
             # DP NOTE: assume that the caller already configured a bastion machine
-            yield self.local_port
+            yield host_port[1]
 
     def external_tunnel(self, port = None, local_port = None):
         """Create SSH tunnel(s) through bastion machine(s) and setup a SSH tunnel.
@@ -431,6 +1026,14 @@ class SSHConnection(object):
             input("Waiting to close tunnel...")
 
 def vault_tunnel(key, bastion):
-    ssh = SSHConnection(key, ("localhost", 3128), bastion, local_port=3128)
+    """Create a SSH tunnel to the HTTP proxy on the bastion used to reach Vault.
+
+        with vault_tunnel(key, bastion) as port:
+            Vault(machine, proxy=port)
+
+    Returns:
+        (context manager) : Context manager yielding the local port of the proxy
+    """
+    ssh = SSHConnection(key, ("localhost", BASTION_PROXY_PORT), bastion)
     return ssh.tunnel()
 
@@ -0,0 +1,382 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Library for recording how long CloudFormation stack actions take and
+reporting on the recorded history.
+
+Each run of an action records the total duration, the duration of each
+phase (template creation, waiting on CloudFormation, post-init), how long
+CloudFormation took to create / update / delete each resource, the number
+of AWS API calls made, and the outcome into a local SQLite database.
+
+Library code reports phases and resource timings to the active run, if
+there is one, so the library can be used without recording anything. Time
+spent waiting for the user to answer a prompt() is not counted, and a run
+where the user declined to continue is recorded as 'cancelled'.
+
+HISTORY_DB : Location of the SQLite database
+"""
+
+import os
+import math
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+HISTORY_DB = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "cloud_formation", "history.db"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    config TEXT,
+    domain TEXT,
+    action TEXT,
+    scenario TEXT,
+    commit_hash TEXT,
+    duration REAL,
+    api_calls INTEGER,
+    outcome TEXT
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER,
+    name TEXT,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS resources (
+    run_id INTEGER,
+    logical_id TEXT,
+    type TEXT,
+    status TEXT,
+    duration REAL
+);
+"""
+
+# A run is flagged as a regression if it took this much longer than the
+# median of the previous runs of the same action
+REGRESSION_FACTOR = 1.25
+
+_current = None
+
+class Run(object):
+    """The timing information for a single stack action"""
+
+    def __init__(self, config, domain, action, scenario=None, commit=None):
+        """Run constructor
+
+        Args:
+            config (string) : Name of the CloudFormation config
+            domain (string) : Domain the config is acting on
+            action (string) : The action being timed
+            scenario (None|string) : The scenario the config is using
+            commit (None|string) : The git commit of the code being run
+        """
+        self.config = config
+        self.domain = domain
+        self.action = action
+        self.scenario = scenario
+        self.commit = commit
+
+        self.started = time.time()
+        self.duration = None
+        self.api_calls = 0
+        self._api_calls_lock = threading.Lock() # sessions may be used by multiple threads
+        self.phases = [] # (name, duration)
+        self.resources = [] # (logical id, type, status, duration)
+        self.outcome = None
+        self.paused = 0 # seconds spent waiting for the user
+        self.cancelled = False
+
+    def count_api_calls(self, session):
+        """Count the API calls made by all clients created from the session
+
+        Args:
+            session (Session) : Boto3 session to count calls for
+        """
+        def count(**kwargs):
+            with self._api_calls_lock:
+                self.api_calls += 1
+        session.events.register('before-call', count)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the code executed within the context as the given phase"""
+        started = time.time()
+        paused = self.paused
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - started - (self.paused - paused)))
+
+    def finish(self, outcome):
+        """Mark the run as finished
+
+        Args:
+            outcome (string) : Result of the run (success, failure, error),
+                               replaced by 'cancelled' if the run was cancelled
+        """
+        self.duration = time.time() - self.started - self.paused
+        self.outcome = "cancelled" if self.cancelled else outcome
+
+    def save(self, db=HISTORY_DB):
+        """Save the run to the history database
+
+        Args:
+            db (string) : Path to the SQLite database
+        """
+        with connect(db) as conn:
+            cur = conn.execute("""INSERT INTO runs (started, config, domain, action, scenario,
+                                                    commit_hash, duration, api_calls, outcome)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                               (self.started, self.config, self.domain, self.action, self.scenario,
+                                self.commit, self.duration, self.api_calls, self.outcome))
+            run_id = cur.lastrowid
+            conn.executemany("INSERT INTO phases VALUES (?, ?, ?)",
+                             [(run_id, name, duration) for name, duration in self.phases])
+            conn.executemany("INSERT INTO resources VALUES (?, ?, ?, ?, ?)",
+                             [(run_id, *resource) for resource in self.resources])
+        return run_id
+
+def connect(db=HISTORY_DB):
+    """Open the history database, creating the tables if needed
+
+    Args:
+        db (string) : Path to the SQLite database
+
+    Returns:
+        (sqlite3.Connection) : Database connection
+    """
+    conn = sqlite3.connect(db)
+    conn.executescript(SCHEMA)
+    return conn
+
+def start(config, domain, action, scenario=None, commit=None, session=None):
+    """Start recording a run, which becomes the active run
+
+    Args:
+        config (string) : Name of the CloudFormation config
+        domain (string) : Domain the config is acting on
+        action (string) : The action being timed
+        scenario (None|string) : The scenario the config is using
+        commit (None|string) : The git commit of the code being run
+        session (None|Session) : Boto3 session to count API calls for
+
+    Returns:
+        (Run) : The active run
+    """
+    global _current
+    _current = Run(config, domain, action, scenario, commit)
+    if session is not None:
+        _current.count_api_calls(session)
+    return _current
+
+def count_api_calls(session):
+    """Count the API calls made by clients created from the session in the
+    active run, like sessions copied for use by another thread
+
+    Args:
+        session (Session) : Boto3 session to count calls for
+    """
+    if _current is not None:
+        _current.count_api_calls(session)
+
+def finish(outcome, db=HISTORY_DB):
+    """Finish and save the active run
+
+    Args:
+        outcome (string) : Result of the run (success, failure, error),
+                           replaced by 'cancelled' if the run was cancelled
+        db (string) : Path to the SQLite database
+    """
+    global _current
+    if _current is None:
+        return
+
+    run, _current = _current, None
+    run.finish(outcome)
+    try:
+        run.save(db)
+    except sqlite3.Error as ex:
+        print("Could not save timing history: {}".format(ex))
+
+def prompt(message):
+    """Ask the user for input, without counting the time spent waiting for
+    the answer in the active run or its phases
+
+    Args:
+        message (string) : Prompt to display
+
+    Returns:
+        (string) : The user's answer
+    """
+    started = time.time()
+    try:
+        return input(message)
+    finally:
+        if _current is not None:
+            _current.paused += time.time() - started
+
+def cancel():
+    """Record that the user declined to continue the active run"""
+    if _current is not None:
+        _current.cancelled = True
+
+@contextmanager
+def phase(name):
+    """Time the code executed within the context as a phase of the active run"""
+    if _current is None:
+        yield
+    else:
+        with _current.phase(name):
+            yield
+
+def timed(name, function):
+    """Wrap the given function so calls are timed as a phase of the active run"""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+def record_stack_events(client, stack_name, since):
+    """Record how long CloudFormation took to act on each resource in the stack
+
+    Args:
+        client (CloudFormation.Client) : Boto3 CloudFormation client
+        stack_name (string) : Name or ID of the stack
+        since (float) : Epoch time, events before this time are ignored
+    """
+    if _current is None:
+        return
+
+    started = {}
+    finished = {}
+    paginator = client.get_paginator('describe_stack_events')
+    for page in paginator.paginate(StackName=stack_name):
+        for event in page['StackEvents']:
+            timestamp = event['Timestamp'].timestamp()
+            if timestamp < since:
+                break
+            if event['ResourceType'] == 'AWS::CloudFormation::Stack':
+                continue
+
+            key = (event['LogicalResourceId'], event['ResourceType'])
+            status = event['ResourceStatus']
+            # Events are returned newest first
+            if status.endswith('_IN_PROGRESS'):
+                started[key] = timestamp
+            elif key not in finished:
+                finished[key] = (status, timestamp)
+        else:
+            continue
+        break
+
+    for key, (status, timestamp) in finished.items():
+        if key in started:
+            _current.resources.append((*key, status, timestamp - started[key]))
+
+def percentile(values, percent):
+    """Calculate the nearest rank percentile of the given values
+
+    Args:
+        values (list) : List of numbers
+        percent (int) : Percentile to calculate (0 - 100)
+
+    Returns:
+        (float|None) : The percentile or None if there are no values
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(percent / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+def report(config, domain=None, db=HISTORY_DB):
+    """Print the timing history for a config
+
+    For each action the number of runs, success rate, and duration percentiles
+    are printed along with the percentiles of each phase, the slowest
+    resources, and any runs that were slower than the previous runs.
+
+    Args:
+        config (string) : Name of the CloudFormation config
+        domain (None|string) : Limit the report to a specific domain
+        db (string) : Path to the SQLite database
+    """
+    fmt_s = lambda s: "-" if s is None else "{:.0f}s".format(s)
+
+    where = "config = ?"
+    args = [config]
+    if domain is not None:
+        where += " AND domain = ?"
+        args.append(domain)
+
+    with connect(db) as conn:
+        actions = [r[0] for r in conn.execute("SELECT DISTINCT action FROM runs WHERE " + where + " ORDER BY action", args)]
+        if len(actions) == 0:
+            print("No history for '{}'".format(config))
+            return
+
+        for action in actions:
+            runs = conn.execute("""SELECT id, started, domain, duration, api_calls, outcome, commit_hash
+                                   FROM runs WHERE """ + where + """ AND action = ?
+                                   ORDER BY started""", args + [action]).fetchall()
+            durations = [r[3] for r in runs if r[5] == 'success']
+            successes = len(durations)
+            cancelled = len([r for r in runs if r[5] == 'cancelled'])
+
+            print("{} {}: {} runs, {} successful, {} cancelled".format(config, action, len(runs) - cancelled,
+                                                                       successes, cancelled))
+            print("  {:<30}{:>8}{:>8}{:>8}".format("", "p50", "p90", "max"))
+            print("  {:<30}{:>8}{:>8}{:>8}".format("total",
+                                                   fmt_s(percentile(durations, 50)),
+                                                   fmt_s(percentile(durations, 90)),
+                                                   fmt_s(percentile(durations, 100))))
+
+            ids = [r[0] for r in runs if r[5] == 'success']
+            marks = ",".join("?" * len(ids))
+            phases = {}
+            for name, duration in conn.execute("SELECT name, duration FROM phases WHERE run_id IN ({})".format(marks), ids):
+                phases.setdefault(name, []).append(duration)
+            for name in sorted(phases):
+                print("  {:<30}{:>8}{:>8}{:>8}".format(name,
+                                                       fmt_s(percentile(phases[name], 50)),
+                                                       fmt_s(percentile(phases[name], 90)),
+                                                       fmt_s(percentile(phases[name], 100))))
+
+            resources = {}
+            for logical_id, duration in conn.execute("SELECT logical_id, duration FROM resources WHERE run_id IN ({})".format(marks), ids):
+                resources.setdefault(logical_id, []).append(duration)
+            slowest = sorted(resources, key=lambda r: percentile(resources[r], 50), reverse=True)[:5]
+            if len(slowest) > 0:
+                print("  Slowest resources")
+                for logical_id in slowest:
+                    print("    {:<28}{:>8}{:>8}{:>8}".format(logical_id,
+                                                             fmt_s(percentile(resources[logical_id], 50)),
+                                                             fmt_s(percentile(resources[logical_id], 90)),
+                                                             fmt_s(percentile(resources[logical_id], 100))))
+
+            previous = []
+            for run_id, started, domain_, duration, api_calls, outcome, commit in runs:
+                if outcome != 'success':
+                    continue
+                median = percentile(previous, 50)
+                if median is not None and duration > median * REGRESSION_FACTOR:
+                    print("  Regression: {} {} took {} (median {}) at commit {}".format(
+                            time.strftime("%Y-%m-%d %H:%M", time.localtime(started)),
+                            domain_, fmt_s(duration), fmt_s(median), commit))
+                previous.append(duration)
+            print()
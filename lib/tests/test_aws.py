@@ -0,0 +1,209 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import sys
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import aws
+from lib import exceptions
+
+
+class FakeASG(object):
+    """Autoscaling client that replaces a terminated instance after a number
+    of describe calls"""
+    def __init__(self, ids, delay=1):
+        self.instances = {id: 'InService' for id in ids}
+        self.delay = delay
+        self.pending = []
+        self.terminated = []
+        self.count = 0
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        for item in self.pending[:]:
+            item[1] -= 1
+            if item[1] <= 0:
+                self.pending.remove(item)
+                self.instances[item[0]] = 'InService'
+
+        instances = [{'InstanceId': id, 'LifecycleState': state, 'HealthStatus': 'Healthy'}
+                     for id, state in self.instances.items()]
+        return {'AutoScalingGroups': [{'Instances': instances, 'LoadBalancerNames': []}]}
+
+    def terminate_instance_in_auto_scaling_group(self, InstanceId, ShouldDecrementDesiredCapacity):
+        self.terminated.append(InstanceId)
+        del self.instances[InstanceId]
+        self.count += 1
+        new_id = 'i-new{}'.format(self.count)
+        self.instances[new_id] = 'Pending'
+        self.pending.append([new_id, self.delay])
+
+
+class TestAsgRestart(unittest.TestCase):
+    def setUp(self):
+        self.asg = FakeASG(['i-1', 'i-2', 'i-3', 'i-4', 'i-5'])
+        self.session = mock.MagicMock()
+        self.session.client.side_effect = lambda name: self.asg if name == 'autoscaling' else mock.MagicMock()
+
+        patcher = mock.patch.object(aws, 'asg_name_lookup', return_value='ConsulASG')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(aws.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batches(self):
+        batches = []
+        callback = lambda: batches.append(list(self.asg.terminated))
+
+        timings = aws.asg_restart(self.session, 'consul.test.boss', 300, callback, batch_size=2)
+
+        self.assertEqual(['i-1', 'i-2', 'i-3', 'i-4', 'i-5'], self.asg.terminated)
+        self.assertEqual([['i-1', 'i-2'], ['i-1', 'i-2', 'i-3', 'i-4'], self.asg.terminated], batches)
+        self.assertEqual([1, 1, 2, 2, 3], [t['batch'] for t in timings])
+        self.assertEqual(5, len(set(t['replacement'] for t in timings)))
+
+    def test_ready_check(self):
+        calls = []
+        def ready(ids):
+            calls.append(ids)
+            return len(calls) > 1
+
+        aws.asg_restart(self.session, 'consul.test.boss', 300, batch_size=5, ready=ready)
+
+        self.assertEqual(2, len(calls))
+        self.assertEqual(5, len(calls[0]))
+
+    def test_timeout(self):
+        with mock.patch.object(aws.time, 'time', side_effect=itertools.count(0, 1000)):
+            with self.assertRaises(exceptions.StatusCheckError):
+                aws.asg_restart(self.session, 'consul.test.boss', 300)
+
+
+class TestRunConcurrently(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(aws, 'copy_session', side_effect=lambda s: s)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results(self):
+        tasks = [(lambda session, x: (session, x * 2), i) for i in range(5)]
+
+        results = aws.run_concurrently('session', tasks, max_workers=2)
+
+        self.assertEqual([('session', i * 2) for i in range(5)], results)
+
+    def test_error_after_all_tasks(self):
+        calls = []
+        def fail(session):
+            raise ValueError('failed')
+
+        tasks = [(fail,), (lambda session: calls.append(1),)]
+
+        with self.assertRaises(ValueError):
+            aws.run_concurrently('session', tasks)
+        self.assertEqual([1], calls)
+
+
+class TestRoute53DeleteRecords(unittest.TestCase):
+    def test_single_change_batch(self):
+        session = mock.MagicMock()
+        client = session.client.return_value
+        client.list_resource_record_sets.side_effect = lambda **kwargs: {
+            'ResourceRecordSets': [{'Name': kwargs['StartRecordName'] + '.'},
+                                   {'Name': 'other.'}]
+        }
+
+        with mock.patch.object(aws, 'get_hosted_zone_id', return_value='ZONE'):
+            aws.route53_delete_records(session, 'test.boss', ['auth.test.boss', 'vault.test.boss'])
+
+        client.change_resource_record_sets.assert_called_once_with(
+            HostedZoneId = 'ZONE',
+            ChangeBatch = {'Changes': [
+                {'Action': 'DELETE', 'ResourceRecordSet': {'Name': 'auth.test.boss.'}},
+                {'Action': 'DELETE', 'ResourceRecordSet': {'Name': 'vault.test.boss.'}},
+            ]})
+
+
+class TestAMICatalog(unittest.TestCase):
+    def setUp(self):
+        def image(name, date, commit=None, aliases=()):
+            tags = [{'Key': aws.ALIAS_TAG_PREFIX + a, 'Value': 'x'} for a in aliases]
+            if commit:
+                tags.append({'Key': 'Commit', 'Value': commit})
+            return {'Name': name, 'ImageId': 'ami-' + name, 'CreationDate': date, 'Tags': tags}
+
+        self.client = mock.MagicMock()
+        self.client.describe_images.return_value = {'Images': [
+            image('vault.neurodata-h2', '2017-02', 'c2', aliases=['sprint2']),
+            image('vault.neurodata-h1', '2017-01', 'c1'),
+            image('vault.neurodata-sprint1', '2017-01-15', 'c1'),
+            image('auth.neurodata-h3', '2017-03', 'c3'),
+            image('proofreader-web.boss', '2016-12'),
+        ]}
+        self.session = mock.MagicMock()
+        self.session.client.return_value = self.client
+
+    def test_lookup(self):
+        self.assertEqual(aws.ami_lookup(self.session, 'vault.neurodata', 'latest'), ('ami-vault.neurodata-h2', 'c2'))
+        self.assertEqual(aws.ami_lookup(self.session, 'vault.neurodata', 'sprint1'), ('ami-vault.neurodata-sprint1', 'c1'))
+        self.assertEqual(aws.ami_lookup(self.session, 'vault.neurodata', 'sprint2'), ('ami-vault.neurodata-h2', 'c2'))
+        self.assertEqual(aws.ami_lookup(self.session, 'auth.neurodata', 'h3'), ('ami-auth.neurodata-h3', 'c3'))
+        self.assertEqual(aws.ami_lookup(self.session, 'proofreader-web.boss'), ('ami-proofreader-web.boss', None))
+
+        # All lookups are resolved from a single call
+        self.assertEqual(self.client.describe_images.call_count, 1)
+
+    def test_missing_version(self):
+        aws.ami_lookup(self.session, 'auth.neurodata', 'latest')
+        self.client.describe_images.side_effect = [{'Images': []}, {'Images': []}, self.client.describe_images.return_value]
+
+        with mock.patch('builtins.print'):
+            self.assertEqual(aws.ami_lookup(self.session, 'auth.neurodata', 'sprint9'), ('ami-auth.neurodata-h3', 'c3'))
+
+        # The specific and alias versions are searched for before the latest version
+        filters = [c[1]['Filters'][0]['Values'] for c in self.client.describe_images.call_args_list[1:]]
+        self.assertEqual([['auth.neurodata-sprint9'], ['auth.neurodata-*'], ['auth.neurodata-h*']], filters)
+
+    def test_shared_version(self):
+        aws.ami_lookup(self.session, 'auth.neurodata', 'latest')
+        self.client.describe_images.return_value = {'Images': [
+            {'Name': 'auth.neurodata-sprint9', 'ImageId': 'ami-shared', 'CreationDate': '2017-04'}]}
+
+        self.assertEqual(aws.ami_lookup(self.session, 'auth.neurodata', 'sprint9'), ('ami-shared', None))
+
+    def test_split_name(self):
+        self.assertEqual(('proofreader-web.boss', None), aws.AMICatalog._split('proofreader-web.boss'))
+        self.assertEqual(('endpoint.boss', 'release-1.2'), aws.AMICatalog._split('endpoint.boss-release-1.2'))
+        self.assertEqual(('vault.neurodata', 'h2'), aws.AMICatalog._split('vault.neurodata-h2'))
+
+    def test_not_in_catalog(self):
+        aws.ami_lookup(self.session, 'vault.neurodata', 'latest')
+        self.client.describe_images.return_value = {'Images': [
+            {'Name': 'amzn-nat', 'ImageId': 'ami-nat', 'CreationDate': '2015'}]}
+
+        self.assertEqual(aws.ami_lookup(self.session, 'amzn-nat'), ('ami-nat', None))
+        self.client.describe_images.assert_called_with(Filters=[{'Name': 'name', 'Values': ['amzn-nat']}])
+
+    def test_environment_version(self):
+        with mock.patch.dict(os.environ, {'AMI_VERSION': 'sprint1'}):
+            self.assertEqual(aws.ami_lookup(self.session, 'vault.neurodata'), ('ami-vault.neurodata-sprint1', 'c1'))
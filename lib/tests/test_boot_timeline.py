@@ -0,0 +1,100 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import unittest
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import boot_timeline
+
+
+def events(script, step, start, end, status='ok', pid=100):
+    return [{'script': script, 'step': step, 'event': 'start',
+             'time': 1000 + start, 'uptime': start, 'pid': pid},
+            {'script': script, 'step': step, 'event': 'end', 'status': status,
+             'duration': end - start, 'time': 1000 + end, 'uptime': end, 'pid': pid}]
+
+def timeline(*steps):
+    return "\n".join(json.dumps(e) for s in steps for e in events(*s)) + "\n"
+
+class TestBootTimeline(unittest.TestCase):
+    def test_parse_skips_partial_lines(self):
+        text = timeline(('boss', 'migrate', 10, 20)) + '{"script": "bo'
+        self.assertEqual(len(boot_timeline.parse(text)), 2)
+
+    def test_steps(self):
+        text = timeline(('scalyr', 'host', 12, 14),
+                        ('boss', 'migrate', 10, 20, 'error'))
+        steps = boot_timeline.steps(boot_timeline.parse(text))
+
+        self.assertEqual([s['step'] for s in steps], ['migrate', 'host'])
+        self.assertEqual(steps[0]['status'], 'error')
+        self.assertEqual(steps[0]['duration'], 10)
+        self.assertEqual(steps[1]['start'], 12)
+        self.assertEqual(steps[1]['end'], 14)
+
+    def test_steps_incomplete(self):
+        start = events('boss', 'migrate', 10, 20)[0]
+        steps = boot_timeline.steps([start])
+
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(steps[0]['status'], 'incomplete')
+        self.assertIsNone(steps[0]['duration'])
+
+    def test_steps_rerun(self):
+        # A firstboot script that is run again appends to the same timeline
+        text = timeline(('boss', 'migrate', 10, 20, 'error', 100),
+                        ('boss', 'migrate', 30, 35, 'ok', 200))
+        steps = boot_timeline.steps(boot_timeline.parse(text))
+
+        self.assertEqual([s['status'] for s in steps], ['error', 'ok'])
+
+    def test_steps_latest_boot(self):
+        # The timeline is kept when the instance reboots
+        first = [dict(e, boot='a') for e in events('boss', 'migrate', 10, 20, 'error')]
+        second = [dict(e, boot='b', time=e['time'] + 3600) for e in events('boss', 'setup', 5, 8)]
+        steps = boot_timeline.steps(second + first)
+
+        self.assertEqual([s['step'] for s in steps], ['setup'])
+        self.assertEqual(boot_timeline.steps(first + [second[0]])[0]['status'], 'incomplete')
+
+    def test_critical_path(self):
+        text = timeline(('bossutils', 'config', 5, 8),
+                        ('scalyr', 'host', 9, 11),
+                        ('boss', 'setup', 9, 15),
+                        ('boss', 'migrate', 15, 40))
+        steps = boot_timeline.steps(boot_timeline.parse(text))
+        path = boot_timeline.critical_path(steps)
+
+        self.assertEqual([s['step'] for s in path], ['config', 'setup', 'migrate'])
+
+    def test_critical_path_empty(self):
+        self.assertEqual(boot_timeline.critical_path([]), [])
+
+    def test_slowest(self):
+        timelines = {}
+        for i, host in enumerate(['a', 'b', 'c']):
+            text = timeline(('scalyr', 'host', 0, 1),
+                            ('boss', 'migrate', 1, 11 + i))
+            timelines[host] = boot_timeline.steps(boot_timeline.parse(text))
+
+        slowest = boot_timeline.slowest(timelines, count=1)
+
+        self.assertEqual(slowest, [('boss/migrate', 11, 12, 12, 3)])
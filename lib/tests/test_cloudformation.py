@@ -0,0 +1,102 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import aws # imported first to resolve the constants / cloudformation import cycle
+from lib import cloudformation
+from lib.cloudformation import CloudFormationConfiguration
+
+
+class TestTemplateArgument(unittest.TestCase):
+    def setUp(self):
+        self.config = CloudFormationConfiguration('test', 'pryordm1.neurodata')
+        self.config.resources['Queue'] = {"Type": "AWS::SQS::Queue"}
+
+        self.session = mock.MagicMock()
+        self.client = self.session.client.return_value
+        self.client.get_bucket_location.return_value = {'LocationConstraint': None}
+
+        patcher = mock.patch.dict(os.environ, {"UPLOAD_TEMPLATE": "False"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(aws, 'get_lambda_s3_bucket', return_value='bucket')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_compact_template(self):
+        template = self.config._create_template()
+        self.assertNotIn(' ', template)
+        self.assertEqual(self.config.resources, json.loads(template)['Resources'])
+
+    def test_small_template_inline(self):
+        arg = self.config._template_argument(self.session)
+
+        self.assertEqual(['TemplateBody'], list(arg.keys()))
+        self.session.client.assert_not_called()
+
+    def test_large_template_uploaded(self):
+        self.client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+        with mock.patch.object(cloudformation, 'TEMPLATE_BODY_LIMIT', 10):
+            arg = self.config._template_argument(self.session)
+
+        self.assertEqual(['TemplateURL'], list(arg.keys()))
+        self.assertTrue(arg['TemplateURL'].startswith('https://s3.amazonaws.com/bucket/cloudformation/TestPryordm1Neurodata.'))
+        self.assertEqual(1, self.client.put_object.call_count)
+
+    def test_template_url_region(self):
+        os.environ["UPLOAD_TEMPLATE"] = "True"
+        self.client.get_bucket_location.return_value = {'LocationConstraint': 'us-west-2'}
+
+        arg = self.config._template_argument(self.session)
+
+        self.assertTrue(arg['TemplateURL'].startswith('https://s3.us-west-2.amazonaws.com/bucket/cloudformation/'))
+        self.client.get_bucket_location.assert_called_once_with(Bucket='bucket')
+
+    def test_existing_template_not_uploaded(self):
+        os.environ["UPLOAD_TEMPLATE"] = "True"
+
+        arg = self.config._template_argument(self.session)
+
+        self.assertIn('TemplateURL', arg)
+        self.client.put_object.assert_not_called()
+
+    def test_head_error_raised(self):
+        os.environ["UPLOAD_TEMPLATE"] = "True"
+        self.client.head_object.side_effect = ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+
+        with self.assertRaises(ClientError):
+            self.config._template_argument(self.session)
+        self.client.put_object.assert_not_called()
+
+    def test_same_template_same_url(self):
+        os.environ["UPLOAD_TEMPLATE"] = "True"
+
+        first = self.config._template_argument(self.session)
+        second = self.config._template_argument(self.session)
+
+        self.assertEqual(first, second)
@@ -0,0 +1,141 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+import sys
+import unittest
+from unittest import mock
+from urllib.error import URLError
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import external
+from lib.exceptions import StatusCheckError
+from lib.external import ExternalCalls
+
+
+class TestWaitFor(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+        self.sleeps = []
+
+        for patcher in [mock.patch.object(external.time, 'time', side_effect=lambda: self.now),
+                        mock.patch.object(external.time, 'sleep', side_effect=sleep)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_ready(self):
+        results = iter([False, False, True])
+
+        elapsed = external.wait_for(lambda: next(results), 60)
+
+        self.assertEqual(3, elapsed)
+        self.assertEqual([1, 2], self.sleeps)
+
+    def test_backoff_cap(self):
+        elapsed = external.wait_for(lambda: False, 60)
+
+        self.assertIsNone(elapsed)
+        self.assertEqual([1, 2, 4, 8, 15, 15, 15], self.sleeps)
+        self.assertEqual(60, sum(self.sleeps))
+
+    def test_errors_not_ready(self):
+        def check():
+            raise URLError('refused')
+
+        self.assertIsNone(external.wait_for(check, 5))
+
+    def test_other_errors_raised(self):
+        def check():
+            raise KeyError('bug')
+
+        with self.assertRaises(KeyError):
+            external.wait_for(check, 5)
+        self.assertEqual([], self.sleeps)
+
+class TestUrlReady(unittest.TestCase):
+    @mock.patch.object(external, 'urlopen')
+    def test_ready(self, urlopen):
+        response = urlopen.return_value.__enter__.return_value
+        response.getcode.return_value = 200
+
+        self.assertTrue(external.url_ready('http://localhost/'))
+        urlopen.assert_called_once_with('http://localhost/', timeout=external.ATTEMPT_TIMEOUT)
+        urlopen.return_value.__exit__.assert_called_once_with(None, None, None)
+
+    @mock.patch.object(external, 'urlopen', side_effect=URLError('refused'))
+    def test_not_ready(self, urlopen):
+        self.assertFalse(external.url_ready('http://localhost/'))
+
+class TestWaitAll(unittest.TestCase):
+    def setUp(self):
+        # Don't look anything up in AWS
+        self.call = ExternalCalls.__new__(ExternalCalls)
+
+        patcher = mock.patch.object(external.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_all_ready(self):
+        results = self.call.wait_all([('Vault', lambda: True), ('API', lambda: True)], 5)
+
+        self.assertEqual({'Vault', 'API'}, set(results))
+        self.assertTrue(all(r is not None for r in results.values()))
+
+    def test_not_ready(self):
+        with mock.patch.object(external.time, 'time', side_effect=itertools.count(0, 10)):
+            with self.assertRaises(StatusCheckError) as ctx:
+                self.call.wait_all([('Vault', lambda: True), ('API', lambda: False)], 5)
+
+        self.assertEqual('API', ctx.exception.target)
+
+class TestCheckConsul(unittest.TestCase):
+    MEMBERS = ("Node            Address          Status  Type    Build  Protocol  DC\n"
+               "consul-1        10.0.0.1:8301    alive   server  0.7.5  2         dc1\n"
+               "consul-2        10.0.0.2:8301    alive   server  0.7.5  2         dc1\n"
+               "vault-1         10.0.0.9:8301    alive   client  0.7.5  2         dc1\n")
+
+    def setUp(self):
+        # Don't look anything up in AWS
+        self.call = ExternalCalls.__new__(ExternalCalls)
+        self.call.domain = 'test.boss'
+        self.call.session = mock.MagicMock()
+        self.call.session.client.return_value.describe_instances.return_value = {
+            'Reservations': [{'Instances': [{'PrivateIpAddress': '10.0.0.2'}]}]}
+        self.call.tunnels = mock.MagicMock()
+        self.run = self.call.tunnels.connection.return_value.run
+        self.run.return_value = mock.MagicMock(returncode=0, stdout=self.MEMBERS)
+
+        patcher = mock.patch.object(external.aws, 'machine_lookup', return_value='10.0.0.1')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_servers_alive(self):
+        self.assertTrue(self.call.check_consul(2, ['i-2']))
+
+    def test_clients_not_counted(self):
+        self.assertFalse(self.call.check_consul(3))
+
+    def test_replacement_not_joined(self):
+        self.call.session.client.return_value.describe_instances.return_value = {
+            'Reservations': [{'Instances': [{'PrivateIpAddress': '10.0.0.3'}]}]}
+
+        self.assertFalse(self.call.check_consul(2, ['i-3']))
@@ -0,0 +1,114 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import fingerprint
+
+SALT_TOP = """base:
+    'web*':
+        - app.server # the application
+        - logging
+
+    'db*':
+        - db
+"""
+
+PILLAR_TOP = """base:
+  '*':
+    - common
+
+  'web*':
+    - web
+"""
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.salt = os.path.join(self.tmp, 'salt')
+        self.pillar = os.path.join(self.tmp, 'pillar')
+
+        self.write('salt/top.sls', SALT_TOP)
+        self.write('salt/app/server.sls', 'include:\n    - python\n\napp:\n  file.managed:\n    - source: salt://files-only/app.conf\n')
+        self.write('salt/app/files/app.py', 'print("app")\n')
+        self.write('salt/python/init.sls', '{% from "versions/map.jinja" import version %}\n')
+        self.write('salt/versions/map.jinja', '{% set version = 3 %}\n')
+        self.write('salt/files-only/app.conf', 'conf\n')
+        self.write('salt/logging/init.sls', 'logging:\n  pkg.installed\n')
+        self.write('salt/db/init.sls', 'db:\n  pkg.installed:\n    - require:\n      - sls: logging\n')
+        self.write('pillar/top.sls', PILLAR_TOP)
+        self.write('pillar/common.sls', 'common: true\n')
+        self.write('pillar/web.sls', 'web: true\n')
+        self.write('packer/vm.packer', '{}')
+        self.write('packer/web', '{"name": "web", "role": "web"}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write(data)
+
+    def fingerprint(self, extra=None):
+        return fingerprint.fingerprint(os.path.join(self.tmp, 'packer/web'), extra,
+                                       salt_root=self.salt,
+                                       pillar_root=self.pillar,
+                                       packer_file=os.path.join(self.tmp, 'packer/vm.packer'))
+
+    def test_top_states(self):
+        top = os.path.join(self.salt, 'top.sls')
+        self.assertEqual(fingerprint.top_states(top, 'web'), ['app.server', 'logging'])
+        self.assertEqual(fingerprint.top_states(top, 'db'), ['db'])
+        self.assertEqual(fingerprint.top_states(top, 'other'), [])
+
+    def test_state_dirs(self):
+        self.assertEqual(fingerprint.state_dirs(['app.server', 'logging'], self.salt),
+                         ['app', 'files-only', 'logging', 'python', 'versions'])
+        self.assertEqual(fingerprint.state_dirs(['db'], self.salt), ['db', 'logging'])
+
+    def test_pillar_files(self):
+        files = fingerprint.pillar_files('web', self.pillar)
+        self.assertEqual(sorted(files), ['common', 'top.sls', 'web'])
+
+    def test_dependency_changes(self):
+        original = self.fingerprint()
+        self.assertEqual(original, self.fingerprint())
+
+        self.write('salt/versions/map.jinja', '{% set version = 4 %}\n')
+        changed = self.fingerprint()
+        self.assertNotEqual(original, changed)
+
+        self.write('pillar/web.sls', 'web: false\n')
+        self.assertNotEqual(changed, self.fingerprint())
+
+    def test_unrelated_changes(self):
+        original = self.fingerprint()
+        self.write('salt/db/init.sls', 'db:\n  pkg.removed\n')
+        self.write('salt/other/init.sls', 'other:\n  pkg.installed\n')
+        self.assertEqual(original, self.fingerprint())
+
+    def test_extra(self):
+        self.assertNotEqual(self.fingerprint({'aws_source_ami': 'ami-1'}),
+                            self.fingerprint({'aws_source_ami': 'ami-2'}))
@@ -0,0 +1,125 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the firstboot runner installed by Salt
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+files_dir = os.path.normpath(os.path.join(cur_dir, '..', '..', 'salt_stack', 'salt', 'boss-tools', 'files'))
+# Inserted first, so its boot_timeline is used instead of lib/boot_timeline.py
+sys.path.insert(0, files_dir)
+
+import firstboot_runner
+from firstboot_runner import Step
+
+
+class TestFirstbootRunner(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.state_file = os.path.join(tmp.name, 'steps.json')
+
+        # Don't write to the instance's boot timeline
+        patcher = mock.patch.object(firstboot_runner, 'boot_timeline')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def step(self, name, requires=(), after=(), once=True, error=None):
+        def function():
+            with self.lock:
+                self.calls.append(name)
+            if error is not None:
+                raise error
+        return Step(name, function, tuple(requires), tuple(after), once)
+
+    def run_steps(self, *steps):
+        return firstboot_runner.run('test', list(steps), max_workers=4, state_file=self.state_file)
+
+    def test_requires_order(self):
+        status = self.run_steps(self.step('c', requires=['b']),
+                                self.step('b', requires=['a']),
+                                self.step('a'))
+
+        self.assertEqual({'a': 'ok', 'b': 'ok', 'c': 'ok'}, status)
+        self.assertEqual(['a', 'b', 'c'], self.calls)
+        self.assertTrue(firstboot_runner.successful(status))
+
+    def test_failure_skips_requirements(self):
+        status = self.run_steps(self.step('a', error=Exception('failed')),
+                                self.step('b', requires=['a']),
+                                self.step('c', requires=['b']),
+                                self.step('d', after=['a']),
+                                self.step('e', requires=['d'], after=['c']))
+
+        self.assertEqual({'a': 'error', 'b': 'skipped', 'c': 'skipped', 'd': 'ok', 'e': 'ok'}, status)
+        self.assertEqual(['a', 'd', 'e'], self.calls)
+        self.assertFalse(firstboot_runner.successful(status))
+
+    def test_after_order(self):
+        status = self.run_steps(self.step('b', after=['a']),
+                                self.step('a'))
+
+        self.assertEqual({'a': 'ok', 'b': 'ok'}, status)
+        self.assertEqual(['a', 'b'], self.calls)
+
+    def test_system_exit(self):
+        status = self.run_steps(self.step('a', error=SystemExit(1)),
+                                self.step('b'))
+
+        self.assertEqual({'a': 'error', 'b': 'ok'}, status)
+
+    def test_missing_requirement(self):
+        status = self.run_steps(self.step('a', requires=['not registered']),
+                                self.step('b'))
+
+        self.assertEqual({'a': 'skipped', 'b': 'ok'}, status)
+        self.assertEqual(['b'], self.calls)
+
+    def test_after_cycle(self):
+        # Steps ordered after each other can never start, they are skipped
+        # instead of waiting forever
+        status = self.run_steps(self.step('a', after=['b']),
+                                self.step('b', after=['a']))
+
+        self.assertEqual({'a': 'skipped', 'b': 'skipped'}, status)
+        self.assertEqual([], self.calls)
+
+    def test_resume(self):
+        with open(self.state_file, 'w') as fh:
+            json.dump(['a', 'setup'], fh)
+
+        status = self.run_steps(self.step('a'),
+                                self.step('setup', once=False),
+                                self.step('b', requires=['a', 'setup']))
+
+        self.assertEqual({'a': 'done', 'setup': 'ok', 'b': 'ok'}, status)
+        self.assertEqual(['setup', 'b'], self.calls)
+        with open(self.state_file) as fh:
+            self.assertEqual(['a', 'b', 'setup'], json.load(fh))
+
+    def test_state_not_saved_on_error(self):
+        self.run_steps(self.step('a', error=Exception('failed')),
+                       self.step('b', once=False),
+                       self.step('c'))
+
+        self.assertEqual({'c'}, firstboot_runner.read_state(self.state_file))
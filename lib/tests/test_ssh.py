@@ -0,0 +1,293 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import ssh
+from lib.exceptions import SSHError, SSHTunnelError
+
+
+class TestWaitForPort(unittest.TestCase):
+    def setUp(self):
+        self.proc = mock.MagicMock()
+        self.proc.poll.return_value = None
+
+        self.sock = socket.socket()
+        self.sock.bind(('localhost', 0))
+        self.port = self.sock.getsockname()[1]
+        self.addCleanup(self.sock.close)
+
+    def test_listening(self):
+        self.sock.listen(1)
+
+        ssh.wait_for_port(self.proc, self.port, timeout=5)
+
+        self.proc.terminate.assert_not_called()
+
+    def test_ssh_error(self):
+        self.proc.poll.return_value = 255
+
+        with self.assertRaises(SSHError):
+            ssh.wait_for_port(self.proc, self.port, timeout=5)
+
+    def test_ssh_exited(self):
+        self.proc.poll.return_value = 1
+
+        with self.assertRaises(SSHTunnelError):
+            ssh.wait_for_port(self.proc, self.port, timeout=5)
+
+    def test_timeout(self):
+        # Socket is bound but not listening, so connections are refused
+        with self.assertRaises(SSHTunnelError):
+            ssh.wait_for_port(self.proc, self.port, timeout=0.3)
+
+        self.proc.terminate.assert_called_once_with()
+
+class TestLocatePort(unittest.TestCase):
+    def test_free_port(self):
+        port = ssh.locate_port()
+        self.addCleanup(ssh.release_port, port)
+
+        with socket.socket() as sock:
+            sock.bind(('localhost', port))
+
+    def test_unique_ports(self):
+        ports = [ssh.locate_port() for i in range(50)]
+        for port in ports:
+            self.addCleanup(ssh.release_port, port)
+
+        self.assertEqual(len(ports), len(set(ports)))
+
+class TestSSHTunnelManager(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ssh.subprocess, 'Popen')
+        self.popen = patcher.start()
+        self.popen.return_value.poll.return_value = None
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(ssh.subprocess, 'call', return_value=0)
+        self.call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.dict(os.environ, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.manager = ssh.SSHTunnelManager('key.pem', '1.2.3.4')
+        self.addCleanup(self.manager.close)
+
+    def commands(self):
+        return [c[0][0] for c in self.call.call_args_list]
+
+    def test_single_bastion_connection(self):
+        self.manager.forward('10.0.0.1', 8080)
+        self.manager.forward('10.0.0.2', 5432)
+        self.manager.cmd('10.0.0.3', 'ls')
+        self.manager.cmd('10.0.0.3', 'pwd')
+
+        # One master to the bastion and one to the target machine
+        self.assertEqual(2, self.popen.call_count)
+        bastion, target = [c[0][0] for c in self.popen.call_args_list]
+        self.assertEqual('ec2-user@1.2.3.4', bastion[-1])
+        self.assertEqual('ubuntu@10.0.0.3', target[-1])
+        self.assertIn('ProxyCommand=' + self.manager.bastion.proxy_command(), target)
+
+        executed = [c[-1] for c in self.commands() if c[-2] == 'ubuntu@10.0.0.3']
+        self.assertEqual(['ls', 'pwd'], executed)
+
+    def test_forward_reused(self):
+        port = self.manager.forward('10.0.0.1', 8080)
+        self.assertEqual(port, self.manager.forward('10.0.0.1', 8080))
+
+        forwards = [c for c in self.commands() if 'forward' in c]
+        self.assertEqual(1, len(forwards))
+        self.assertIn('{}:10.0.0.1:8080'.format(port), forwards[0])
+
+    def test_forward_error(self):
+        self.manager.bastion.start()
+        self.call.return_value = 255
+
+        with self.assertRaises(SSHTunnelError):
+            self.manager.forward('10.0.0.1', 8080)
+
+    def test_apl_bastion_proxy(self):
+        os.environ.update({'BASTION_IP': '5.6.7.8', 'BASTION_KEY': 'apl.pem', 'BASTION_USER': 'apl'})
+
+        manager = ssh.SSHTunnelManager('key.pem', '1.2.3.4')
+
+        self.assertIn('apl@5.6.7.8', manager.bastion.proxy)
+
+    def test_close(self):
+        self.manager.cmd('10.0.0.3', 'ls')
+        self.manager.close()
+
+        exits = [c for c in self.commands() if 'exit' in c]
+        self.assertEqual(2, len(exits))
+        self.assertEqual({}, self.manager.connections)
+
+    def test_forward_error_releases_ports(self):
+        self.manager.bastion.start()
+        self.call.return_value = 255
+
+        with self.assertRaises(SSHTunnelError):
+            self.manager.forward('10.0.0.1', 8080)
+
+        self.assertEqual(set(), ssh._allocated_ports)
+
+    def test_forward_retry(self):
+        self.manager.bastion.start()
+        results = iter([255])
+        self.call.side_effect = lambda cmd, **kwargs: next(results, 0)
+
+        port = self.manager.forward('10.0.0.1', 8080)
+
+        forwards = [c for c in self.commands() if 'forward' in c]
+        self.assertEqual(2, len(forwards))
+        self.assertIn('{}:10.0.0.1:8080'.format(port), forwards[1])
+
+    def test_run_all(self):
+        def run(cmd, **kwargs):
+            host = cmd[-2].split('@')[1]
+            if host == '10.0.0.2':
+                return subprocess.CompletedProcess(cmd, 1, '', 'failed')
+            return subprocess.CompletedProcess(cmd, 0, host + '\n', '')
+
+        with mock.patch.object(ssh.subprocess, 'run', side_effect=run):
+            results = self.manager.run_all(['10.0.0.1', '10.0.0.2', '10.0.0.3'], 'hostname', max_workers=2)
+
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'], [r.host for r in results])
+        self.assertEqual([0, 1, 0], [r.returncode for r in results])
+        self.assertEqual('10.0.0.3\n', results[2].stdout)
+        self.assertEqual('failed', results[1].stderr)
+        # One shared bastion connection and one connection per machine
+        self.assertEqual(4, self.popen.call_count)
+
+    def test_run_all_connection_error(self):
+        self.manager.bastion.start()
+        self.popen.return_value.poll.return_value = 255
+        self.call.return_value = 255
+
+        results = self.manager.run_all(['10.0.0.1'], 'hostname')
+
+        self.assertEqual(255, results[0].returncode)
+
+class TestSSHConnectionPorts(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'BASTION_IP': '5.6.7.8', 'BASTION_KEY': 'apl.pem', 'BASTION_USER': 'apl'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_port_released(self):
+        conn = ssh.SSHConnection('key.pem', '10.0.0.1')
+        with mock.patch.object(ssh, 'create_tunnel') as create_tunnel:
+            with conn.tunnel() as port:
+                self.assertIn(port, ssh._allocated_ports)
+                self.assertEqual(port, create_tunnel.call_args[0][1])
+
+        self.assertEqual(set(), ssh._allocated_ports)
+
+    def test_port_released_on_error(self):
+        conn = ssh.SSHConnection('key.pem', '10.0.0.1', ('10.0.0.2', 22, 'ec2-user'))
+        with mock.patch.object(ssh, 'create_tunnel', side_effect=[mock.MagicMock(), SSHTunnelError()]):
+            with self.assertRaises(SSHTunnelError):
+                with conn.tunnel():
+                    pass
+
+        self.assertEqual(set(), ssh._allocated_ports)
+
+    def test_master_reused(self):
+        conn = ssh.SSHConnection('key.pem', '10.0.0.1')
+        with mock.patch.object(ssh, 'create_tunnel') as create_tunnel, \
+             mock.patch.object(ssh, 'ControlMaster') as master:
+            with conn:
+                conn.run('one')
+                conn.run('two')
+                conn.sync({'src': 'src'}, '/tmp')
+
+            self.assertEqual(1, create_tunnel.call_count)
+            self.assertEqual(1, master.call_count)
+            master.return_value.start.assert_called_once_with()
+            master.return_value.close.assert_called_once_with()
+            self.assertEqual(2, master.return_value.run.call_count)
+            master.return_value.sync.assert_called_once_with({'src': 'src'}, '/tmp')
+
+            conn.run('three')
+            self.assertEqual(2, master.call_count)
+
+        self.assertIsNone(conn.master)
+        self.assertEqual(set(), ssh._allocated_ports)
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local)
+        self.addCleanup(shutil.rmtree, self.remote)
+
+        self.write('pkg/a.py', 'a')
+        self.write('pkg/sub/b.py', 'b')
+        self.write('pkg/.git/config', 'git')
+        self.write('c.txt', 'c')
+        os.symlink('a.py', os.path.join(self.local, 'pkg', 'link.py'))
+
+        self.sources = {'pkg': os.path.join(self.local, 'pkg'),
+                        'c.txt': os.path.join(self.local, 'c.txt')}
+
+        # Execute the "remote" commands locally
+        self.master = ssh.ControlMaster('key.pem', 'localhost')
+        self.master._ssh = lambda *args: ['bash', '-c']
+        self.addCleanup(self.master.close)
+
+    def write(self, name, data):
+        path = os.path.join(self.local, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.remote, name)) as fh:
+            return fh.read()
+
+    def test_initial_sync(self):
+        stats = self.master.sync(self.sources, self.remote)
+
+        self.assertEqual({'changed': 4, 'unchanged': 0, 'deleted': 0}, stats)
+        self.assertEqual('b', self.read('pkg/sub/b.py'))
+        self.assertEqual('a.py', os.readlink(os.path.join(self.remote, 'pkg', 'link.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.remote, 'pkg', '.git')))
+
+    def test_incremental_sync(self):
+        self.master.sync(self.sources, self.remote)
+
+        self.write('pkg/a.py', 'changed')
+        os.remove(os.path.join(self.local, 'c.txt'))
+        del self.sources['c.txt']
+        stats = self.master.sync(self.sources, self.remote)
+
+        self.assertEqual({'changed': 1, 'unchanged': 2, 'deleted': 1}, stats)
+        self.assertEqual('changed', self.read('pkg/a.py'))
+        self.assertFalse(os.path.exists(os.path.join(self.remote, 'c.txt')))
+        self.assertFalse(os.path.exists(os.path.join(self.remote, ssh.SYNC_DELETED)))
@@ -0,0 +1,146 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import telemetry
+from lib import aws
+
+
+def event(logical_id, status, timestamp, type_='AWS::EC2::Instance'):
+    return {'LogicalResourceId': logical_id,
+            'ResourceType': type_,
+            'ResourceStatus': status,
+            'Timestamp': datetime.fromtimestamp(timestamp, timezone.utc)}
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        fd, self.db = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.db)
+        self.addCleanup(setattr, telemetry, '_current', None)
+
+    def run_action(self, duration, outcome='success'):
+        with mock.patch.object(telemetry.time, 'time', side_effect=[0, 0, 10, duration]):
+            telemetry.start('core', 'test.boss', 'create')
+            with telemetry.phase('create'):
+                pass
+            telemetry.finish(outcome, self.db)
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(5, telemetry.percentile(values, 50))
+        self.assertEqual(9, telemetry.percentile(values, 90))
+        self.assertEqual(10, telemetry.percentile(values, 100))
+        self.assertIsNone(telemetry.percentile([], 50))
+
+    def test_no_active_run(self):
+        with telemetry.phase('create'):
+            pass
+        telemetry.record_stack_events(mock.MagicMock(), 'stack', 0)
+        telemetry.finish('success', self.db)
+
+        with telemetry.connect(self.db) as conn:
+            self.assertEqual(0, conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0])
+
+    def test_save(self):
+        self.run_action(100)
+
+        with telemetry.connect(self.db) as conn:
+            runs = conn.execute("SELECT config, domain, action, duration, outcome FROM runs").fetchall()
+            phases = conn.execute("SELECT name, duration FROM phases").fetchall()
+        self.assertEqual([('core', 'test.boss', 'create', 100, 'success')], runs)
+        self.assertEqual([('create', 10)], phases)
+
+    def test_prompt_cancelled(self):
+        times = [0, 10, 15, 75, 100, 110]
+        with mock.patch.object(telemetry.time, 'time', side_effect=times), \
+             mock.patch('builtins.input', return_value='n'):
+            telemetry.start('core', 'test.boss', 'update')
+            with telemetry.phase('update'):
+                self.assertEqual('n', telemetry.prompt('Apply Update? [N/y] '))
+                telemetry.cancel()
+            telemetry.finish('success', self.db)
+
+        with telemetry.connect(self.db) as conn:
+            runs = conn.execute("SELECT duration, outcome FROM runs").fetchall()
+            phases = conn.execute("SELECT name, duration FROM phases").fetchall()
+        # The 60 seconds spent waiting for the answer are not counted
+        self.assertEqual([(50, 'cancelled')], runs)
+        self.assertEqual([('update', 30)], phases)
+
+    def test_record_stack_events(self):
+        client = mock.MagicMock()
+        client.get_paginator.return_value.paginate.return_value = [{'StackEvents': [
+            event('Stack', 'CREATE_COMPLETE', 200, 'AWS::CloudFormation::Stack'),
+            event('Instance', 'CREATE_COMPLETE', 180),
+            event('Instance', 'CREATE_IN_PROGRESS', 120),
+            event('Queue', 'CREATE_COMPLETE', 110, 'AWS::SQS::Queue'),
+            event('Queue', 'CREATE_IN_PROGRESS', 105, 'AWS::SQS::Queue'),
+            event('Old', 'CREATE_COMPLETE', 50),
+        ]}]
+
+        run = telemetry.start('core', 'test.boss', 'create')
+        telemetry.record_stack_events(client, 'stack', 100)
+
+        self.assertEqual(sorted([('Instance', 'AWS::EC2::Instance', 'CREATE_COMPLETE', 60),
+                                 ('Queue', 'AWS::SQS::Queue', 'CREATE_COMPLETE', 5)]),
+                         sorted(run.resources))
+
+    def test_api_calls_copied_sessions(self):
+        session = aws.Session(aws_access_key_id='key', aws_secret_access_key='secret',
+                              region_name='us-east-1')
+        run = telemetry.start('core', 'test.boss', 'create', session=session)
+
+        def call(session):
+            session.events.emit('before-call.ec2.DescribeInstances', params={'headers': {}},
+                                 model=mock.MagicMock(), context={}, request_signer=None)
+
+        def calls(i):
+            copy = aws.copy_session(session)
+            for j in range(100):
+                call(copy)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(calls, range(8)))
+        call(session)
+
+        self.assertEqual(801, run.api_calls)
+
+    def test_report_regression(self):
+        for duration in [100, 110, 90, 200]:
+            self.run_action(duration)
+        self.run_action(500, 'failure')
+
+        out = io.StringIO()
+        with redirect_stdout(out):
+            telemetry.report('core', db=self.db)
+        out = out.getvalue()
+
+        self.assertIn('core create: 5 runs, 4 successful', out)
+        self.assertEqual(1, out.count('Regression'))
+        self.assertIn('took 200s (median 100s)', out)
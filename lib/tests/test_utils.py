@@ -0,0 +1,112 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import utils
+
+
+class TestMinify(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        patcher = mock.patch.object(utils, 'CACHE_DIR', self.tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Force the pure Python minifier
+        patcher = mock.patch.object(utils.shutil, 'which', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.source = os.path.join(self.tmp.name, 'index.py')
+        with open(self.source, 'w') as fh:
+            fh.write('''"""Module docstring"""
+import json # comment
+
+def handler(event, context):
+    """Function docstring"""
+
+    data = json.loads(event["body"])
+    return {"status": 200 if data else 400,
+            "body": "ok"}
+
+def noop():
+    """Only a docstring"""
+''')
+
+    def test_minify_source(self):
+        with open(self.source, 'r') as fh:
+            actual = utils._minify_source(fh.read())
+
+        expected = ('import json\n'
+                    'def handler(event,context):\n'
+                    ' data=json.loads(event["body"])\n'
+                    ' return{"status":200 if data else 400,"body":"ok"}\n'
+                    'def noop():\n'
+                    ' pass\n')
+
+        self.assertEqual(expected, actual)
+        compile(actual, self.source, 'exec')
+
+    def test_minify_cached(self):
+        first = utils.python_minifiy(self.source)
+
+        with mock.patch.object(utils, '_minify_source') as minify:
+            second = utils.python_minifiy(self.source)
+            minify.assert_not_called()
+
+        self.assertEqual(first, second)
+        self.assertTrue(first.startswith(self.tmp.name))
+
+    def test_minify_error_removes_tmp(self):
+        with mock.patch.object(utils, '_minify_source', side_effect=SyntaxError()):
+            with self.assertRaises(SyntaxError):
+                utils.python_minifiy(self.source)
+
+        self.assertEqual([], os.listdir(os.path.join(self.tmp.name, 'minified')))
+
+    def test_lambda_code_limit(self):
+        with self.assertRaises(Exception):
+            utils.lambda_code(self.source, limit=10)
+
+class TestBuildManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        for name, data in [('pkg/a.py', 'a'), ('pkg/sub/b.py', 'b'), ('pkg/.git/config', 'git'), ('c.txt', 'c')]:
+            path = os.path.join(self.tmp.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fh:
+                fh.write(data)
+        os.symlink('a.py', os.path.join(self.tmp.name, 'pkg', 'link.py'))
+
+    def test_manifest(self):
+        manifest = utils.build_manifest({'pkg': os.path.join(self.tmp.name, 'pkg'),
+                                         'c.txt': os.path.join(self.tmp.name, 'c.txt')})
+
+        self.assertEqual({'pkg/a.py', 'pkg/sub/b.py', 'pkg/link.py', 'c.txt'}, set(manifest))
+        # Links are hashed by their target, not followed
+        self.assertNotEqual(manifest['pkg/a.py'][0], manifest['pkg/link.py'][0])
@@ -0,0 +1,256 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from unittest import mock
+
+import hvac
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import vault
+from lib.vault import Vault
+
+
+class FakeClient(object):
+    """In memory Vault KV store"""
+    def __init__(self, data):
+        self.data = data
+        self.reads = Counter()
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        with self.lock:
+            self.reads[path] += 1
+        if path in self.data:
+            return {'data': dict(self.data[path])}
+        return None
+
+    def list(self, path):
+        keys = set()
+        for key in self.data:
+            if key.startswith(path):
+                rest = key[len(path):]
+                if '/' in rest:
+                    keys.add(rest.split('/')[0] + '/')
+                else:
+                    keys.add(rest)
+        return {'data': {'keys': sorted(keys)}} if keys else None
+
+    def write(self, path, **kwargs):
+        with self.lock:
+            self.data[path] = kwargs
+
+class TestExportImport(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient({
+            'secret/a': {'k': '1'},
+            'secret/b': {'k': '2'},
+            'secret/b/c': {'k': '3'},
+            'secret/b/d/e': {'k': '4'},
+        })
+        self.vault = Vault('vault.test.boss', '10.0.0.1')
+        patcher = mock.patch.object(self.vault, 'connect', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(vault.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_export(self):
+        exported = self.vault.export('secret/')
+
+        self.assertEqual(self.client.data, exported)
+
+    def test_export_no_duplicate_reads(self):
+        self.vault.export('secret')
+
+        self.assertEqual(1, max(self.client.reads.values()))
+
+    def test_import(self):
+        exported = dict(self.client.data)
+        self.client.data = {'secret/a': {'old': '0'}}
+
+        self.vault.import_(exported)
+
+        self.assertEqual(exported, self.client.data)
+
+    def test_import_update(self):
+        self.client.data = {'secret/a': {'old': '0'}}
+
+        self.vault.import_({'secret/a': {'k': '1'}}, update=True)
+
+        self.assertEqual({'old': '0', 'k': '1'}, self.client.data['secret/a'])
+
+    def test_import_retry(self):
+        write = self.client.write
+        failures = Counter()
+        def flaky(path, **kwargs):
+            failures[path] += 1
+            if failures[path] == 1:
+                raise hvac.exceptions.InternalServerError()
+            write(path, **kwargs)
+        self.client.write = flaky
+
+        self.vault.import_({'secret/a': {'k': '1'}, 'secret/b': {'k': '2'}})
+
+        self.assertEqual({'k': '2'}, self.client.data['secret/b'])
+
+    def test_import_failure(self):
+        def fail(path, **kwargs):
+            raise hvac.exceptions.InvalidRequest()
+        self.client.write = fail
+
+        with self.assertRaises(Exception):
+            self.vault.import_({'secret/a': {'k': '1'}})
+
+    def test_import_revalidate(self):
+        write = self.client.write
+        invalidate = mock.patch.object(self.vault, 'invalidate').start()
+        self.addCleanup(mock.patch.stopall)
+        def expired(path, **kwargs):
+            if not invalidate.called:
+                raise hvac.exceptions.Forbidden()
+            write(path, **kwargs)
+        self.client.write = expired
+
+        self.vault.import_({'secret/a': {'k': '1'}, 'secret/b': {'k': '2'}})
+
+        invalidate.assert_called_once_with(vault.VAULT_TOKEN)
+        self.assertEqual({'k': '2'}, self.client.data['secret/b'])
+
+    def test_export_revalidate(self):
+        read = self.client.read
+        invalidate = mock.patch.object(self.vault, 'invalidate').start()
+        self.addCleanup(mock.patch.stopall)
+        def expired(path):
+            if not invalidate.called:
+                raise hvac.exceptions.Unauthorized()
+            return read(path)
+        self.client.read = expired
+
+        exported = self.vault.export('secret/')
+
+        invalidate.assert_called_once_with(vault.VAULT_TOKEN)
+        self.assertEqual(self.client.data, exported)
+
+class TestConnect(unittest.TestCase):
+    def setUp(self):
+        self.private = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.private)
+
+        for patcher in [mock.patch.object(vault, 'PRIVATE_DIR', self.private),
+                        mock.patch.dict(vault._clients, clear=True),
+                        mock.patch.dict(vault._tokens, clear=True),
+                        mock.patch.object(vault.hvac, 'Client')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        vault.hvac.Client.side_effect = lambda **kwargs: mock.MagicMock()
+
+        self.vault = Vault('vault.test.boss', '10.0.0.1')
+        self.write_token('token1')
+
+    def write_token(self, token):
+        with open(self.vault.path(vault.VAULT_TOKEN), 'w') as fh:
+            fh.write(token)
+
+    def test_client_reused(self):
+        client = self.vault.connect(vault.VAULT_TOKEN)
+
+        self.assertIs(client, self.vault.connect(vault.VAULT_TOKEN))
+        self.assertIs(client, Vault('vault.test.boss', '10.0.0.1').connect(vault.VAULT_TOKEN))
+        self.assertEqual('token1', client.token)
+        self.assertEqual(1, client.is_authenticated.call_count)
+
+    def test_pool_sized_for_workers(self):
+        self.vault.connect()
+
+        session = vault.hvac.Client.call_args[1]['session']
+        adapter = session.get_adapter(self.vault.url)
+        self.assertEqual(vault.VAULT_WORKERS, adapter._pool_maxsize)
+
+    def test_different_proxy(self):
+        client = self.vault.connect(vault.VAULT_TOKEN)
+        self.vault.set_proxy(12345)
+
+        self.assertIsNot(client, self.vault.connect(vault.VAULT_TOKEN))
+
+    def test_token_changed(self):
+        client = self.vault.connect(vault.VAULT_TOKEN)
+        self.write_token('token2')
+        os.utime(self.vault.path(vault.VAULT_TOKEN), (0, 0))
+
+        self.assertEqual('token2', self.vault.connect(vault.VAULT_TOKEN).token)
+
+    def test_invalid_token(self):
+        vault.hvac.Client.side_effect = None
+        vault.hvac.Client.return_value.is_authenticated.return_value = False
+
+        with self.assertRaises(Exception):
+            self.vault.connect(vault.VAULT_TOKEN)
+        self.assertEqual({}, vault._clients)
+
+    def test_revalidate_after_auth_failure(self):
+        client = self.vault.connect(vault.VAULT_TOKEN)
+        client.read.side_effect = hvac.exceptions.Forbidden()
+
+        self.vault.read('secret/a')
+
+        new_client = self.vault.connect(vault.VAULT_TOKEN)
+        self.assertIsNot(client, new_client)
+        new_client.read.assert_called_once_with('secret/a')
+
+class TestUnsealAll(unittest.TestCase):
+    def make_vault(self, ip, sealed=True, progress=0):
+        v = Vault('vault.test.boss', ip)
+        client = mock.MagicMock()
+        client.is_sealed.return_value = sealed
+        client.unseal_multi.return_value = {'sealed': progress > 0, 'progress': 3 - progress, 't': 3}
+        v.connect = mock.MagicMock(return_value=client)
+        v.load_keys = mock.MagicMock(return_value=['k1', 'k2', 'k3'])
+        return v
+
+    def test_unseal_all(self):
+        vaults = [self.make_vault('10.0.0.1'),
+                  self.make_vault('10.0.0.2', sealed=False),
+                  self.make_vault('10.0.0.3', progress=1)]
+
+        results = vault.unseal_all(vaults)
+
+        self.assertEqual({'http://10.0.0.1:8200': 0,
+                          'http://10.0.0.2:8200': 0,
+                          'http://10.0.0.3:8200': 1}, results)
+        # Keys are only read once for the whole cluster
+        vaults[0].load_keys.assert_called_once_with()
+        vaults[2].load_keys.assert_not_called()
+        vaults[2].connect.return_value.unseal_multi.assert_called_once_with(['k1', 'k2', 'k3'])
+
+    def test_unseal_error(self):
+        vaults = [self.make_vault('10.0.0.1'), self.make_vault('10.0.0.2')]
+        vaults[1].connect.side_effect = Exception("connection refused")
+
+        with self.assertRaises(Exception):
+            vault.unseal_all(vaults)
+
+        vaults[0].connect.return_value.unseal_multi.assert_called_once_with(['k1', 'k2', 'k3'])
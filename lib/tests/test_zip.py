@@ -0,0 +1,121 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import zipfile
+
+# Allow unit test files to import the target library modules
+cur_dir = os.path.dirname(os.path.realpath(__file__))
+parent_dir = os.path.normpath(os.path.join(cur_dir, '..', '..'))
+sys.path.append(parent_dir)
+
+from lib import zip
+
+class TestBuildZip(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(os.path.join(self.src, 'pkg', '.git'))
+        os.makedirs(os.path.join(self.src, 'pkg', 'empty'))
+        with open(os.path.join(self.src, 'pkg', 'module.py'), 'w') as fh:
+            fh.write('print("hello")\n' * 100)
+        with open(os.path.join(self.src, 'pkg', '.git', 'HEAD'), 'w') as fh:
+            fh.write('ref')
+        with open(os.path.join(self.src, 'run.sh'), 'w') as fh:
+            fh.write('#!/bin/sh\n')
+        os.chmod(os.path.join(self.src, 'run.sh'), 0o700)
+        os.symlink('module.py', os.path.join(self.src, 'pkg', 'link.py'))
+
+        self.extra = os.path.join(self.tmp, 'extra.bin')
+        with open(self.extra, 'wb') as fh:
+            fh.write(os.urandom(1024)) # incompressible, stored
+
+        self.inputs = [(self.src, 'lambda'), (self.extra, 'data/extra.bin')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, inputs, name='out.zip'):
+        path = os.path.join(self.tmp, name)
+        zip.build_zip(inputs, path)
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+    def test_contents(self):
+        output = self.build(self.inputs)
+
+        with zipfile.ZipFile(io.BytesIO(output)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['data/extra.bin',
+                                             'lambda/',
+                                             'lambda/pkg/',
+                                             'lambda/pkg/empty/',
+                                             'lambda/pkg/link.py',
+                                             'lambda/pkg/module.py',
+                                             'lambda/run.sh'])
+            self.assertEqual(zf.read('lambda/pkg/module.py'), b'print("hello")\n' * 100)
+            self.assertEqual(zf.getinfo('lambda/pkg/module.py').compress_type, zipfile.ZIP_DEFLATED)
+
+            link = zf.getinfo('lambda/pkg/link.py')
+            self.assertEqual(link.external_attr >> 16, 0o120777)
+            self.assertEqual(zf.read(link), b'module.py')
+            self.assertEqual(zf.getinfo('lambda/run.sh').external_attr >> 16, 0o100755)
+            self.assertEqual(zf.getinfo('lambda/pkg/module.py').date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_deterministic(self):
+        path = os.path.join(self.tmp, 'out.zip')
+        first = zip.build_zip(self.inputs, path)
+
+        later = time.time() + 3600
+        os.utime(os.path.join(self.src, 'pkg', 'module.py'), (later, later))
+        second_path = os.path.join(self.tmp, 'second.zip')
+        second = zip.build_zip(list(reversed(self.inputs)), second_path)
+
+        self.assertEqual(first, second)
+        with open(path, 'rb') as fh, open(second_path, 'rb') as second_fh:
+            self.assertEqual(fh.read(), second_fh.read())
+
+    def test_duplicate(self):
+        with self.assertRaises(Exception):
+            self.build([(self.extra, 'a'), (self.extra, 'a')])
+
+    def test_replace_directory_file(self):
+        replacement = os.path.join(self.tmp, 'module.py')
+        with open(replacement, 'w') as fh:
+            fh.write('replaced')
+
+        # Like the lambda zip, where the domain's settings.ini replaces the template
+        outputs = []
+        for inputs in (self.inputs + [(replacement, 'lambda/pkg/module.py')],
+                       [(replacement, 'lambda/pkg/module.py')] + self.inputs):
+            output = self.build(inputs)
+            with zipfile.ZipFile(io.BytesIO(output)) as zf:
+                self.assertEqual(zf.read('lambda/pkg/module.py'), b'replaced')
+            outputs.append(output)
+
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_failure_removes_output(self):
+        missing = os.path.join(self.tmp, 'missing.py')
+
+        with self.assertRaises(OSError):
+            self.build(self.inputs + [(missing, 'missing.py')])
+
+        self.assertEqual(['extra.bin', 'src'], sorted(os.listdir(self.tmp)))
@@ -14,13 +14,35 @@
 
 import sys
 import os
+import io
 import subprocess
 import shlex
+import shutil
 import getpass
 import string
+import hashlib
+import tempfile
+import tokenize
 
 from contextlib import contextmanager
 
+# Local directory used to cache build artifacts between runs
+CACHE_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", ".cache"))
+
+def cache_path(*args):
+    """Get the complete file path for a file in the local cache directory,
+    creating any missing parent directories.
+
+    Args:
+        args : Path components under CACHE_DIR
+
+    Returns:
+        (string) : Complete file path
+    """
+    path = os.path.join(CACHE_DIR, *args)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    return path
+
 @contextmanager
 def open_(filename, mode='r'):
     """Custom version of open that understands stdin/stdout"""
@@ -44,7 +66,7 @@ def get_command(action=None):
     argv = sys.argv[:]
     if action:
         # DP HACK: hardcoded list of supported actions, should figure out something else
-        actions = ["create", "update", "delete", "post-init", "pre-init", "generate"]
+        actions = ["create", "update", "delete", "post-init", "pre-init", "generate", "report"]
         argv = [action if a in actions else a for a in argv]
 
     return " ".join(argv)
@@ -53,16 +75,75 @@ def json_sanitize(data):
     return (data.replace('"', '\"')
                 .replace('\\', '\\\\'))
 
+def _minify_source(source):
+    """Pure Python fallback used when pyminifier is not installed.
+
+    Strips all comments, docstrings, and blank lines and reduces each
+    indentation level to a single space.
+
+    Args:
+        source (string): Python source code
+
+    Returns:
+        (string): Minified Python source code
+    """
+    def is_word(tok):
+        return tok[0].isalnum() or tok[0] == '_' or tok[-1].isalnum() or tok[-1] == '_'
+
+    lines = [] # (depth, is_docstring, tokens)
+    depth = 0
+    current = []
+    for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+        if tok.type == tokenize.INDENT:
+            depth += 1
+        elif tok.type == tokenize.DEDENT:
+            depth -= 1
+        elif tok.type == tokenize.NEWLINE:
+            if current:
+                docstring = len(current) == 1 and current[0][0] == tokenize.STRING
+                lines.append((depth, docstring, [t for _, t in current]))
+            current = []
+        elif tok.type in (tokenize.COMMENT, tokenize.NL, tokenize.ENDMARKER):
+            pass
+        else:
+            current.append((tok.type, tok.string))
+
+    rtn = []
+    for i, (depth, docstring, tokens) in enumerate(lines):
+        if docstring:
+            prev_depth = lines[i-1][0] if i > 0 else 0
+            next_depth = lines[i+1][0] if i + 1 < len(lines) else 0
+            if prev_depth < depth and next_depth < depth:
+                # The docstring is the only statement in the block
+                tokens = ['pass']
+            else:
+                continue
+
+        line = tokens[0]
+        for prev, tok in zip(tokens, tokens[1:]):
+            if is_word(prev) and is_word(tok):
+                line += ' '
+            line += tok
+        rtn.append(' ' * depth + line)
+
+    return '\n'.join(rtn) + '\n'
+
+# Part of the cache key of _minify_source results
+# Increment when changing _minify_source, so old cached results are not used
+_MINIFY_VERSION = b'minify-1'
+
 def python_minifiy(file):
     """Outputs a minified version of the given Python file.
 
-    Runs pyminifier on the given file.  The minified filename has '.min'
-    added before the '.py' extension.  This function is used to help code
-    fit under the 4k limit when uploading lambda functions, directly, as
-    opposed to pointing to a zip file in S3.  The minification process
-    strips out all comments and uses minimal whitespace.
+    Runs pyminifier on the given file, or a pure Python minifier if pyminifier
+    is not installed. The result is cached under CACHE_DIR, keyed on the hash
+    of the file's contents and the minifier used, so a file is only minified
+    once.  This function is used to help code fit under the 4k limit when
+    uploading lambda functions, directly, as opposed to pointing to a zip file
+    in S3.  The minification process strips out all comments and uses minimal
+    whitespace.
 
-    Example: lambda.py => lambda.min.py
+    Example: lambda.py => .cache/minified/<sha256>.min.py
 
     Args:
         file (string): File name of Python file to minify.
@@ -73,17 +154,109 @@ def python_minifiy(file):
     Raises:
         (subprocess.CalledProcessError): on a non-zero return code from pyminifier.
     """
-    file_parts = os.path.splitext(file)
-    min_filename = file_parts[0] + '.min' + file_parts[1]
-    cmd = 'pyminifier -o ' + min_filename + ' ' + file
-    result = subprocess.run(
-        shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        print(result.stderr)
-    # Package up exception with output and raise if there was a failure.
-    result.check_returncode()
+    pyminifier = shutil.which('pyminifier')
+
+    with open(file, 'rb') as fh:
+        digest = hashlib.sha256(fh.read())
+    digest.update(b'pyminifier' if pyminifier else _MINIFY_VERSION)
+    min_filename = cache_path('minified', digest.hexdigest() + '.min.py')
+
+    if os.path.exists(min_filename):
+        return min_filename
+
+    # A unique temporary file, so concurrent runs don't write to the same file
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(min_filename), suffix='.tmp')
+    try:
+        if pyminifier:
+            os.close(fd)
+            cmd = 'pyminifier -o ' + tmp_filename + ' ' + file
+            result = subprocess.run(
+                shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                print(result.stderr)
+            # Package up exception with output and raise if there was a failure.
+            result.check_returncode()
+        else:
+            with open(file, 'r') as fh:
+                source = fh.read()
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(_minify_source(source))
+
+        # Only populate the cache with complete results
+        os.replace(tmp_filename, min_filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
     return min_filename
 
+def lambda_code(file, limit=4096):
+    """Read the minified and sanitized version of a Python file, for use as
+    the inline code of a lambda function.
+
+    Only the minified code is cached (see python_minifiy()), as sanitizing it
+    is cheaper than reading a cached result.
+
+    Args:
+        file (string): File name of Python file to minify.
+        limit (int): Maximum size of the resulting code
+
+    Returns:
+        (string): Minified and sanitized Python code
+
+    Raises:
+        (Exception): If the resulting code is larger than limit
+    """
+    with open(python_minifiy(file), 'r') as fh:
+        minified = fh.read()
+
+    # Warning, sanitizing process does not handle backslashes
+    # in strings properly!
+    code = json_sanitize(minified)
+
+    if len(code) >= limit:
+        raise Exception("Lambda code file is too large") # TODO need to figure out if / how to upload a manually created zip file
+
+    return code
+
+def build_manifest(sources):
+    """Hash all of the files in the given files and directories
+
+    Symbolic links are not followed, the link target is hashed instead.
+    Directories named .git are skipped.
+
+    Args:
+        sources (dict) : Dictionary of {name: local file or directory path}
+
+    Returns:
+        (dict) : Dictionary of {name of the file under its source name: (sha256 hex digest, local path)}
+    """
+    def hash_file(path):
+        hash = hashlib.sha256()
+        if os.path.islink(path):
+            hash.update(os.readlink(path).encode())
+        else:
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(65536), b''):
+                    hash.update(chunk)
+        return hash.hexdigest()
+
+    manifest = {}
+    for name, path in sources.items():
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                if '.git' in dirs:
+                    dirs.remove('.git')
+                # Symbolic links to directories are transferred as links
+                files += [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                for f in files:
+                    local = os.path.join(root, f)
+                    remote = os.path.join(name, os.path.relpath(local, path))
+                    manifest[remote] = (hash_file(local), local)
+        else:
+            manifest[name] = (hash_file(path), path)
+    return manifest
+
 def get_commit():
     """Get the git commit hash of the current directory.
 
@@ -18,6 +18,12 @@ import hvac
 import json
 from pprint import pprint
 import traceback
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
 VAULT_TOKEN = "vault_token"
 VAULT_KEY = "vault_key."
@@ -26,6 +32,109 @@ VAULT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "vaul
 POLICY_DIR = os.path.join(VAULT_DIR, "policies")
 PRIVATE_DIR = os.path.join(VAULT_DIR, "private")
 
+# Default local port of the SSH tunnel to the bastion's HTTP proxy
+VAULT_PROXY_PORT = 3128
+
+# Number of concurrent requests made by export and import
+# Each persistent client's connection pool is sized to match
+VAULT_WORKERS = 16
+
+# Errors that may succeed if the request is retried
+RETRY_EXCEPTIONS = (hvac.exceptions.InternalServerError,
+                    hvac.exceptions.VaultDown,
+                    requests.exceptions.ConnectionError)
+
+def retry(func, *args, attempts=3, delay=0.5, **kwargs):
+    """Call func, retrying with an increasing delay if a transient error is raised
+
+    Args:
+        func (callable) : Function to call
+        attempts (int) : Maximum number of times to call func
+        delay (float) : Seconds to wait before the first retry, doubled for each retry
+
+    Returns:
+        The return value of func
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except RETRY_EXCEPTIONS:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay * 2 ** attempt)
+
+# Errors that mean the token was rejected and should be revalidated
+AUTH_EXCEPTIONS = (hvac.exceptions.Forbidden,
+                   hvac.exceptions.Unauthorized)
+
+# Persistent clients shared by all Vault objects, so that HTTP connections
+# are kept alive and tokens are only validated once
+# (url, proxy, token) : hvac.Client
+_clients = {}
+# token file path : (modification time, token)
+_tokens = {}
+_clients_lock = threading.Lock()
+
+def _revalidate(method):
+    """Decorator that calls the method again with a freshly read and validated
+    token if Vault rejects the cached token
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except AUTH_EXCEPTIONS:
+            self.invalidate(VAULT_TOKEN)
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def unseal_all(vaults):
+    """Unseal multiple servers of a Vault cluster at the same time.
+
+    The unseal keys are read once and shared by all of the servers. After all
+    of the servers have been unsealed, a summary of their status is printed.
+
+    Args:
+        vaults (list) : List of Vault objects for the servers of a single cluster
+
+    Returns:
+        (dict) : Dict of Vault url and number of additional keys needed to finish unsealing
+
+    Raises:
+        Exception : If any of the servers could not be unsealed
+    """
+    if len(vaults) == 0:
+        return {}
+
+    # All servers in the cluster share the same private files
+    keys = vaults[0].load_keys()
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(vaults)) as executor:
+        futures = {executor.submit(vault.unseal, keys): vault for vault in vaults}
+        for future in as_completed(futures):
+            try:
+                results[futures[future].url] = future.result()
+            except Exception as ex:
+                results[futures[future].url] = ex
+
+    print("Vault unseal status")
+    for url in sorted(results):
+        result = results[url]
+        if isinstance(result, Exception):
+            status = "error: {}".format(result)
+        elif result == 0:
+            status = "unsealed"
+        else:
+            status = "sealed, {} more keys needed".format(result)
+        print("  {:<30} {}".format(url, status))
+
+    errors = [url for url in results if isinstance(results[url], Exception)]
+    if len(errors) > 0:
+        raise Exception("Could not unseal {} of {} Vault servers".format(len(errors), len(vaults)))
+
+    return results
+
 class Vault(object):
     def __init__(self, machine, ip = None, proxy = True):
         # If the machine is X.vault.vpc.boss remove the X.
@@ -45,11 +154,20 @@ class Vault(object):
             host = "localhost"
 
         self.url = "http://{}:8200".format(host)
-        if proxy:
-            self.proxy = {"http": "http://localhost:3128"}
+        if proxy is True:
+            self.set_proxy(VAULT_PROXY_PORT)
+        elif proxy:
+            self.set_proxy(proxy)
         else:
             self.proxy = {} # DP XXX: {} or None???
 
+    def set_proxy(self, port):
+        """Set the local port of the HTTP proxy used to reach Vault.
+        Args:
+            port (int) : Local port of the SSH tunnel to the proxy
+        """
+        self.proxy = {"http": "http://localhost:{}".format(port)}
+
     def path(self, filename):
         """Get the complete file path for given machine's private file.
         Args:
@@ -65,22 +183,76 @@ class Vault(object):
 
         return path
 
-    def connect(self, read_token = None):
-        client = hvac.Client(url=self.url, proxies=self.proxy)
+    def _read_token(self, read_token):
+        """Read the token from the given machine's private file, the file is
+        only read again if it has been modified.
+        Args:
+            read_token (string) : Name of the machine's private token file
+        Returns:
+            (string) : The token
+        """
+        token_file = self.path(read_token)
+        if not os.path.exists(token_file):
+            raise Exception("Token file '{}' doesn't exist".format(token_file))
 
-        if read_token is not None:
-            token_file = self.path(read_token)
-            if not os.path.exists(token_file):
-                raise Exception("Token file '{}' doesn't exist".format(token_file))
+        mtime = os.stat(token_file).st_mtime
+        with _clients_lock:
+            cached = _tokens.get(token_file)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
 
-            with open(token_file, "r") as fh:
-                client.token = fh.read()
-                try:
-                    if not client.is_authenticated():
-                        raise Exception("Vault token is not valid, cannot communicate with the Vault")
-                except:
-                    raise
-        return client
+        with open(token_file, "r") as fh:
+            token = fh.read()
+
+        with _clients_lock:
+            _tokens[token_file] = (mtime, token)
+        return token
+
+    def connect(self, read_token = None):
+        """Get a client for the Vault, reusing the persistent client for the
+        Vault and token if there is one.
+
+        If a token is used it is validated the first time the client is created.
+        Args:
+            read_token (None|string) : Name of the machine's private token file
+                                       to authenticate with
+        Returns:
+            (hvac.Client) : Vault client
+        """
+        token = None if read_token is None else self._read_token(read_token)
+        key = (self.url, self.proxy.get("http"), token)
+
+        with _clients_lock:
+            if key in _clients:
+                return _clients[key]
+
+        # The default requests pool keeps only 10 connections, so size it
+        # for the export / import workers that share this client
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=VAULT_WORKERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        client = hvac.Client(url=self.url, proxies=self.proxy, session=session)
+        if token is not None:
+            client.token = token
+            if not client.is_authenticated():
+                raise Exception("Vault token is not valid, cannot communicate with the Vault")
+
+        with _clients_lock:
+            return _clients.setdefault(key, client)
+
+    def invalidate(self, read_token = None):
+        """Discard the persistent client and cached token, so that the next
+        connect() reads and validates the token again.
+        Args:
+            read_token (None|string) : Name of the machine's private token file
+        """
+        token_file = None if read_token is None else self.path(read_token)
+        with _clients_lock:
+            cached = _tokens.pop(token_file, None)
+            token = None if cached is None else cached[1]
+            _clients.pop((self.url, self.proxy.get("http"), token), None)
 
     def status_check(self):
         """Check to see that Vault is up and available. Not checking the configuration
@@ -253,13 +425,31 @@ class Vault(object):
                     client.write("aws/roles/" + name, **keys)
         """
 
-    def unseal(self):
+    def load_keys(self):
+        """Read all of the unseal keys defined by VAULT_KEY.
+        Returns:
+            (list) : List of unseal keys
+        """
+        key_file = self.path(VAULT_KEY)
+        keys = []
+        for f in glob.glob(key_file + "*"):
+            with open(f, "r") as fh:
+                keys.append(fh.read())
+        return keys
+
+    def unseal(self, keys=None):
         """Unseal a sealed Vault. Connect using get_client() and if the Vault is
         not sealed read all of the keys defined by VAULT_KEY and unseal.
 
         If there are not enough keys to completely unseal the Vault, print a
         status message about how many more keys are required to finish the
         process.
+
+        Args:
+            keys (None|list) : Unseal keys to use, if None they are read using load_keys()
+
+        Returns:
+            (int) : Number of additional keys needed to finish unsealing
         """
 
         client = self.connect()
@@ -267,11 +457,8 @@ class Vault(object):
             print("Vault is already unsealed")
             return 0
 
-        key_file = self.path(VAULT_KEY)
-        keys = []
-        for f in glob.glob(key_file + "*"):
-            with open(f, "r") as fh:
-                keys.append(fh.read())
+        if keys is None:
+            keys = self.load_keys()
 
         if len(keys) == 0:
             raise Exception("Could not locate any key files, not unsealing")
@@ -356,6 +543,7 @@ class Vault(object):
         print("Auth Backends")
         print(json.dumps(client.list_auth_backends(), indent=True))
 
+    @_revalidate
     def provision(self, policy):
         """Create a new Vault access token.
 
@@ -369,6 +557,7 @@ class Vault(object):
         token = client.create_token(policies = [policy])
         return token["auth"]["client_token"]
 
+    @_revalidate
     def revoke(self, token):
         """Revoke a Vault access token.
 
@@ -378,6 +567,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.revoke_token(token)
 
+    @_revalidate
     def revoke_secret(self, lease_id):
         """Revoke a Vault lease
 
@@ -387,6 +577,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.revoke_secret(lease_id)
 
+    @_revalidate
     def revoke_secret_prefix(self, prefix):
         """Revoke a Vault secret by prefix
 
@@ -396,6 +587,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.revoke_secret_prefix(prefix)
 
+    @_revalidate
     def write(self, path, **kwargs):
         """A generic method for writing data into Vault.
 
@@ -409,6 +601,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.write(path, **kwargs)
 
+    @_revalidate
     def update(self, path, **kwargs):
         """A generic method for adding/updating data to/in Vault.
 
@@ -428,6 +621,7 @@ class Vault(object):
 
         client.write(path, **existing)
 
+    @_revalidate
     def read(self, path):
         """A generic method for reading data from Vault.
 
@@ -437,6 +631,7 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         return client.read(path)
 
+    @_revalidate
     def delete(self, path):
         """A generic method for deleting data from Vault.
 
@@ -446,11 +641,20 @@ class Vault(object):
         client = self.connect(VAULT_TOKEN)
         client.delete(path)
 
-    def export(self, path):
+    @_revalidate
+    def export(self, path, max_workers=VAULT_WORKERS):
         """A generic method for reading all of the paths and keys from Vault.
 
+        The tree under path is walked by a pool of workers sharing a single
+        connection, each path is read only once. Errors from the workers,
+        including a rejected token, are raised unchanged.
+
         Args:
             path (string) : Vault path to dump data from
+            max_workers (int) : Maximum number of concurrent Vault requests
+
+        Returns:
+            (dict) : Dict of Vault path and dict of key / values stored at the path
         """
         if path[-1] != '/':
             path += '/'
@@ -459,35 +663,87 @@ class Vault(object):
 
         # DP NOTE: not using self.read becuase of the different token needed
         client = self.connect(VAULT_TOKEN)
-        results =  client.read(path[:-1])
-        if results is not None:
-            rtn[path[:-1]] = results['data']
-
-        results = client.list(path)
-        for key in results['data']['keys']:
-            key = path + key
-            if key[-1] == '/':
-                data = self.export(key)
-                rtn.update(data)
-            else:
-                # DP NOTE: This will currently do a duplicate read if
-                #          data is stored at key and in paths under
-                #          key
-                #          To prevent this, check to see if (key + '/') is in keys
-                data = self.read(key)
-                rtn[key] = data['data']
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            read_paths = set()
+
+            def read(path):
+                # A key may hold data and also be a prefix for other keys,
+                # so make sure each path is only read once
+                if path not in read_paths:
+                    read_paths.add(path)
+                    pending[executor.submit(retry, client.read, path)] = ('read', path)
+
+            def list_(path):
+                pending[executor.submit(retry, client.list, path)] = ('list', path)
+
+            read(path[:-1])
+            list_(path)
+
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    action, path_ = pending.pop(future)
+                    results = future.result()
+                    if results is None:
+                        continue
+
+                    if action == 'read':
+                        rtn[path_] = results['data']
+                    else:
+                        for key in results['data']['keys']:
+                            key = path_ + key
+                            if key[-1] == '/':
+                                read(key[:-1])
+                                list_(key)
+                            else:
+                                read(key)
 
         return rtn
 
-    def import_(self, exported, update=False):
+    @_revalidate
+    def import_(self, exported, update=False, max_workers=VAULT_WORKERS):
         """A generic method for writing / updating data in multiple paths in Vault.
 
+        Paths are written in parallel by a pool of workers sharing a single
+        connection, failed writes are retried. If the token is rejected the
+        error is raised unchanged, so the import is retried with a new token.
+
         Args:
             exported (dict): Dict of Vault path and dict of key / values to store at the path
             update (bool): If an Update should be done or if a Write should be done
+            max_workers (int) : Maximum number of concurrent Vault requests
+
+        Raises:
+            Exception : If any of the paths could not be written
         """
-        for path in exported:
+        client = self.connect(VAULT_TOKEN)
+
+        def write(path):
             kv = exported[path]
-            fn = self.update if update else self.write
-            fn(path, **kv)
+            if update:
+                existing = retry(client.read, path)
+                existing = {} if existing is None else existing["data"]
+                existing.update(kv)
+                kv = existing
+            retry(client.write, path, **kv)
+
+        failed = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(write, path): path for path in exported}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as ex:
+                    failed[futures[future]] = ex
+
+        for path in sorted(failed):
+            if isinstance(failed[path], AUTH_EXCEPTIONS):
+                raise failed[path]
+
+        if len(failed) > 0:
+            for path in sorted(failed):
+                print("Could not write '{}': {}".format(path, failed[path]))
+            raise Exception("Could not import {} of {} paths".format(len(failed), len(exported)))
 
@@ -14,8 +14,16 @@
 
 import os
 import shutil
+import hashlib
+import tempfile
 import zipfile
 
+DEFAULT_LEVEL = 6 # zlib compression level used by build_zip()
+
+# Fixed modification time (the earliest zip time) so that the same inputs
+# always produce the same zip file
+_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
 def zip_directory(directory, name = "lambda"):
     target = os.path.join(tempfile.mkdtemp(), name)
     return shutil.make_archive(target, "zip", directory, directory)
@@ -81,3 +89,109 @@ def write_to_zip(path, zippath, append=True, arcname=None):
         write_zip_file(path, fzip, arcname)
     fzip.close()
 
+
+
+def _zip_entries(inputs):
+    """Expand the inputs into a sorted list of (arcname, path, kind) entries.
+
+    Directories are walked, skipping .git directories, and symbolic links are
+    not followed. A file given directly in the inputs replaces a file with the
+    same name found in a directory.
+    """
+    entries = {}
+    explicit = set()
+    def add(arcname, path, kind, direct=False):
+        if arcname in entries:
+            if direct and arcname not in explicit:
+                pass # replaces the file from the directory
+            elif not direct and arcname in explicit:
+                return # already replaced
+            else:
+                raise Exception("Duplicate zip entry '{}'".format(arcname))
+        if direct:
+            explicit.add(arcname)
+        entries[arcname] = (path, kind)
+
+    for path, arcname in inputs:
+        arcname = arcname.strip('/')
+        if os.path.isdir(path) and not os.path.islink(path):
+            add(arcname + '/', path, 'dir')
+            for root, dirs, files in os.walk(path):
+                if '.git' in dirs:
+                    dirs.remove('.git')
+                rel = os.path.relpath(root, path)
+                dst = arcname if rel == '.' else arcname + '/' + rel.replace(os.sep, '/')
+                for d in list(dirs):
+                    full = os.path.join(root, d)
+                    if os.path.islink(full):
+                        dirs.remove(d) # os.walk doesn't follow it, store it as a link
+                        add(dst + '/' + d, full, 'link')
+                    else:
+                        add(dst + '/' + d + '/', full, 'dir')
+                for f in files:
+                    full = os.path.join(root, f)
+                    add(dst + '/' + f, full, 'link' if os.path.islink(full) else 'file')
+        else:
+            add(arcname, path, 'link' if os.path.islink(path) else 'file', direct=True)
+
+    return [(arcname,) + entries[arcname] for arcname in sorted(entries)]
+
+def _zip_info(arcname, mode, compress_type):
+    """Create the ZipInfo for an entry with a fixed date and the given unix mode"""
+    info = zipfile.ZipInfo(arcname, date_time=_DATE_TIME)
+    info.create_system = 3 # unix, so the mode is used when extracting
+    info.external_attr = (mode << 16) | (0x10 if arcname.endswith('/') else 0)
+    info.compress_type = compress_type
+    return info
+
+def build_zip(inputs, output, level=DEFAULT_LEVEL):
+    """Build a zip file from multiple files and directories.
+
+    Entries are written in sorted order with fixed timestamps and permissions,
+    so the same inputs always produce the same zip file. Symbolic links are
+    stored as links and .git directories are skipped. A file given directly
+    in the inputs replaces a file with the same name found in one of the
+    input directories.
+
+    Args:
+        inputs (list) : List of (local file or directory path, name in the zip) tuples
+        output (string) : Path of the zip file to create
+        level (int) : zlib compression level
+
+    Returns:
+        (string) : Hex digest of the SHA256 hash of the zip file
+
+    Raises:
+        Exception : If the inputs contain duplicate names. If the zip file
+                    could not be created output is not left behind.
+    """
+    entries = _zip_entries(inputs)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            with zipfile.ZipFile(fh, 'w') as zf:
+                for arcname, path, kind in entries:
+                    if kind == 'dir':
+                        zf.writestr(_zip_info(arcname, 0o40755, zipfile.ZIP_STORED), b'')
+                    elif kind == 'link':
+                        zf.writestr(_zip_info(arcname, 0o120777, zipfile.ZIP_STORED),
+                                    os.readlink(path).encode())
+                    else:
+                        # Only the executable bit is kept, so the output doesn't depend on umask
+                        mode = 0o100755 if os.stat(path).st_mode & 0o111 else 0o100644
+                        with open(path, 'rb') as data:
+                            zf.writestr(_zip_info(arcname, mode, zipfile.ZIP_DEFLATED),
+                                        data.read(), compresslevel=level)
+
+        sha = hashlib.sha256()
+        with open(tmp, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(65536), b''):
+                sha.update(chunk)
+        os.chmod(tmp, 0o644) # mkstemp creates the file only readable by the user
+        os.replace(tmp, output)
+    except:
+        os.remove(tmp)
+        raise
+
+    return sha.hexdigest()
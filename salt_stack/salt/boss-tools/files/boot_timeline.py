@@ -0,0 +1,176 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Boot timeline instrumentation for the firstboot scripts.
+
+Each step of a firstboot script is wrapped in step(), which appends a start
+and an end event to TIMELINE_FILE as JSON lines. Every event records the
+wall clock time, the number of seconds since the kernel booted, and the
+kernel's boot id, so the timelines of all firstboot scripts can be combined
+and compared across instances (see bin/boot_timeline.py). The timeline is
+kept across reboots, so the boot id separates the events of each boot.
+
+publish() sends the step durations of the current boot and the time since
+boot to CloudWatch.
+
+TIMELINE_FILE : Location of the timeline on the instance
+NAMESPACE : CloudWatch namespace for the boot metrics
+"""
+
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+from functools import wraps
+
+TIMELINE_FILE = "/var/log/boss/boot-timeline.jsonl"
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+NAMESPACE = "BOSS/Boot"
+METADATA_URL = "http://169.254.169.254/latest/meta-data/"
+
+log = logging.getLogger(__name__)
+
+def uptime():
+    """Get the number of seconds since the kernel booted"""
+    try:
+        with open("/proc/uptime") as fh:
+            return float(fh.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def boot_id():
+    """Get the random id the kernel generated for the current boot"""
+    try:
+        with open(BOOT_ID_FILE) as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+def record(event, timeline=TIMELINE_FILE):
+    """Append an event to the timeline
+
+    Each event is written with a single append, so multiple scripts can
+    record to the same timeline at the same time. Errors are logged and
+    ignored, so recording never causes a firstboot script to fail.
+
+    Args:
+        event (dict) : Event data
+        timeline (string) : Path to the timeline file
+    """
+    event = dict(event, time=time.time(), uptime=uptime(), pid=os.getpid(), boot=boot_id())
+    try:
+        os.makedirs(os.path.dirname(timeline), exist_ok=True)
+        with open(timeline, "a") as fh:
+            fh.write(json.dumps(event, sort_keys=True) + "\n")
+    except OSError as ex:
+        log.warning("Could not record boot event: {}".format(ex))
+
+@contextmanager
+def step(script, name, timeline=TIMELINE_FILE):
+    """Record the start and end of the code executed within the context
+
+    If an exception is raised within the context the end event has a status
+    of 'error' and the exception is re-raised.
+
+    Args:
+        script (string) : Name of the firstboot script
+        name (string) : Name of the step
+        timeline (string) : Path to the timeline file
+    """
+    start = time.time()
+    record({"script": script, "step": name, "event": "start"}, timeline)
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        record({"script": script, "step": name, "event": "end",
+                "status": status, "duration": time.time() - start}, timeline)
+
+def timed(script, name=None):
+    """Decorator that records each call of the function as a step
+
+    Args:
+        script (string) : Name of the firstboot script
+        name (None|string) : Name of the step, defaults to the function name
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with step(script, name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def load(timeline=TIMELINE_FILE):
+    """Read all of the events in the timeline
+
+    Returns:
+        (list) : List of event dictionaries, skipping any partially written lines
+    """
+    events = []
+    try:
+        with open(timeline) as fh:
+            for line in fh:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+    except OSError:
+        pass
+    return events
+
+def publish(script, host, timeline=TIMELINE_FILE):
+    """Publish the durations of the script's steps during the current boot
+    and the time since boot the script finished to CloudWatch
+
+    The instance's role needs the cloudwatch:PutMetricData permission
+    (see aplBootMetricsPolicy in config/iam/policies.json). Errors, like a
+    missing permission, are logged and ignored.
+
+    Args:
+        script (string) : Name of the firstboot script
+        host (string) : Value of the Host dimension, like the instance's FQDN
+        timeline (string) : Path to the timeline file
+    """
+    try:
+        import boto3
+        from urllib.request import urlopen
+
+        zone = urlopen(METADATA_URL + "placement/availability-zone", timeout=5).read().decode()
+        client = boto3.client("cloudwatch", region_name=zone[:-1])
+
+        boot = boot_id()
+        metrics = []
+        for event in load(timeline):
+            if event.get("boot") != boot:
+                continue # Step from an earlier boot of the instance
+            if event.get("script") == script and event.get("event") == "end":
+                metrics.append({"MetricName": "StepDuration",
+                                "Dimensions": [{"Name": "Host", "Value": host},
+                                               {"Name": "Step", "Value": "{}/{}".format(script, event["step"])}],
+                                "Value": event["duration"],
+                                "Unit": "Seconds"})
+        metrics.append({"MetricName": "FirstbootComplete",
+                        "Dimensions": [{"Name": "Host", "Value": host},
+                                       {"Name": "Script", "Value": script}],
+                        "Value": uptime() or 0,
+                        "Unit": "Seconds"})
+
+        # PutMetricData accepts at most 20 metrics per call
+        for i in range(0, len(metrics), 20):
+            client.put_metric_data(Namespace=NAMESPACE, MetricData=metrics[i:i+20])
+    except Exception as ex:
+        log.warning("Could not publish boot metrics: {}".format(ex))
@@ -27,10 +27,14 @@
 
 import os
 import bossutils
+import boot_timeline
+import firstboot_runner
 
 bossutils.utils.set_excepthook()
 logging = bossutils.logger.BossLogger().logger
 
+SCRIPT = "bossutils-firstboot"
+
 def read_vault_token():
     """If the Boss configuration file contains a Vault token, call
     Vault().rotate_token() to read a new token from the cubbyhole."""
@@ -40,6 +44,17 @@ def read_vault_token():
         vault = bossutils.vault.Vault()
         vault.rotate_token()
 
+@firstboot_runner.step("download config")
+def download_config():
+    logging.info("CONFIG_FILE = \"{}\"".format(bossutils.configuration.CONFIG_FILE))
+    logging.info("Creating /etc/boss (if it does not exist)")
+    base_dir = os.path.dirname(bossutils.configuration.CONFIG_FILE)
+    os.makedirs(base_dir, exist_ok = True)
+
+    bossutils.configuration.download_and_save()
+    #read_vault_token() # Not currently supported when generating access tokens
+
+@firstboot_runner.step("set hostname", requires=["download config"])
 def set_hostname():
     """Update the hostname of the machine, by configuring the following
         * updating /etc/hosts to add the current IP address, FQDN, and hostname
@@ -53,7 +68,7 @@ def set_hostname():
         current_hostname = fh.read().strip()
 
     fqdn = config["system"]["fqdn"]
-    hostname, domain = fqdn.split(".", 1)
+    hostname = fqdn.split(".", 1)[0]
     ip = bossutils.utils.read_url(bossutils.utils.METADATA_URL + "local-ipv4")
 
     # while not needed with Rout53 provided DNS, this allows a machine to still
@@ -80,6 +95,12 @@ def set_hostname():
     logging.info("Calling hostname")
     bossutils.utils.execute("hostname -F /etc/hostname")
 
+@firstboot_runner.step("resolvconf", requires=["download config"])
+def set_search_domain():
+    """Add the machine's domain to the DNS search domains"""
+    config = bossutils.configuration.BossConfig()
+    domain = config["system"]["fqdn"].split(".", 1)[1]
+
     logging.info("Updating /etc/resolvconf/resolv.conf.d/base")
     with open("/etc/resolvconf/resolv.conf.d/base", "a") as fh:
         fh.write("\nsearch {}\n".format(domain))
@@ -88,15 +109,10 @@ def set_hostname():
     bossutils.utils.execute("resolvconf -u")
 
 if __name__ == '__main__':
-    logging.info("CONFIG_FILE = \"{}\"".format(bossutils.configuration.CONFIG_FILE))
-    logging.info("Creating /etc/boss (if it does not exist)")
-    base_dir = os.path.dirname(bossutils.configuration.CONFIG_FILE)
-    os.makedirs(base_dir, exist_ok = True)
-
-    bossutils.configuration.download_and_save()
-    #read_vault_token() # Not currently supported when generating access tokens
-    set_hostname()
-
+    status = firstboot_runner.run(SCRIPT)
+    if "download config" in firstboot_runner.read_state():
+        boot_timeline.publish(SCRIPT, bossutils.configuration.BossConfig()["system"]["fqdn"])
 
     # Since the service is to be run once, disable it
-    bossutils.utils.stop_firstboot()
\ No newline at end of file
+    if firstboot_runner.successful(status):
+        bossutils.utils.stop_firstboot()
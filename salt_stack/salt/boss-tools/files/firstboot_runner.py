@@ -0,0 +1,207 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dependency ordered runner for the firstboot steps.
+
+Firstboot steps are registered with the step() decorator, declaring the
+names of the steps that have to finish before they can start. run() starts
+every step as soon as its requirements have finished, so independent steps
+run at the same time. A step that fails only causes the steps that require
+it to be skipped. Steps can also be ordered after other steps without
+requiring them to succeed.
+
+The names of the steps that finished are saved in STATE_FILE, so requirements
+can be satisfied by a different firstboot script (like 'download config',
+from the bossutils-firstboot script) and steps that already finished are not
+run again if a firstboot script is re-run after a failure.
+
+Role specific steps are placed in STEPS_DIR by their Salt states and are
+loaded with load().
+
+STEPS_DIR : Directory of the role specific step modules
+STATE_FILE : Location of the list of finished steps
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import importlib.util
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import boot_timeline
+
+STEPS_DIR = "/etc/boss/firstboot.d"
+STATE_FILE = "/var/lib/boss/firstboot-steps.json"
+MAX_WORKERS = 4
+
+log = logging.getLogger(__name__)
+
+Step = namedtuple("Step", ["name", "function", "requires", "after", "once"])
+
+# Steps registered with step(), in registration order
+STEPS = OrderedDict()
+
+def step(name, requires=(), after=(), once=True):
+    """Decorator that registers the function as a firstboot step
+
+    Args:
+        name (string) : Name of the step
+        requires (list) : Names of the steps that must finish before this
+                          step can start
+        after (list) : Names of the steps that must have run, successfully
+                       or not, before this step can start
+        once (bool) : If the step should not be run again once it has finished.
+                      Steps that only change the state of the running process
+                      (like loading Django) should use False.
+    """
+    def decorator(function):
+        if name in STEPS:
+            raise Exception("Firstboot step '{}' is already registered".format(name))
+        STEPS[name] = Step(name, function, tuple(requires), tuple(after), once)
+        return function
+    return decorator
+
+def load(directory=STEPS_DIR):
+    """Import all of the step modules in the given directory
+
+    Args:
+        directory (string) : Directory containing the step modules
+    """
+    if not os.path.isdir(directory):
+        return
+
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".py"):
+            continue
+        path = os.path.join(directory, filename)
+        spec = importlib.util.spec_from_file_location("firstboot_d_" + filename[:-3], path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+def read_state(state_file=STATE_FILE):
+    """Read the names of the steps that have already finished
+
+    Returns:
+        (set) : Set of step names
+    """
+    try:
+        with open(state_file) as fh:
+            return set(json.load(fh))
+    except (OSError, ValueError):
+        return set()
+
+def write_state(finished, state_file=STATE_FILE):
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    with open(state_file, "w") as fh:
+        json.dump(sorted(finished), fh)
+
+def run(script, steps=None, max_workers=MAX_WORKERS, state_file=STATE_FILE):
+    """Run the firstboot steps, starting each step once its requirements
+    have finished
+
+    Each step is recorded in the boot timeline under the given script name.
+
+    Args:
+        script (string) : Name of the firstboot script
+        steps (None|list) : Steps to run (default: all registered steps)
+        max_workers (int) : Maximum number of steps to run at the same time
+        state_file (string) : Location of the list of finished steps
+
+    Returns:
+        (dict) : Dictionary of {step name: status}, where the status is
+                 'ok', 'done' (finished by a previous run), 'error', or
+                 'skipped' (a requirement didn't finish)
+    """
+    steps = list(STEPS.values()) if steps is None else steps
+    saved = read_state(state_file)
+    finished = set(saved)
+    lock = threading.Lock()
+
+    status = {s.name: "done" for s in steps if s.once and s.name in saved}
+    waiting = [s for s in steps if s.name not in status]
+
+    def execute(step_):
+        start = time.time()
+        log.info("Starting {}".format(step_.name))
+        try:
+            with boot_timeline.step(script, step_.name):
+                step_.function()
+        except BaseException:
+            # Includes SystemExit, which would otherwise be re-raised by
+            # future.result() and stop all of the other steps
+            log.exception("{} failed after {:.1f}s".format(step_.name, time.time() - start))
+            return "error"
+
+        log.info("Finished {} in {:.1f}s".format(step_.name, time.time() - start))
+        with lock:
+            finished.add(step_.name)
+            if step_.once:
+                saved.add(step_.name)
+                write_state(saved, state_file)
+        return "ok"
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while len(waiting) > 0 or len(running) > 0:
+            # Repeat until no more steps can be started or skipped, as skipping
+            # a step can allow the steps ordered after it to start
+            changed = True
+            while changed:
+                changed = False
+                pending = set(s.name for s in waiting) | set(s.name for s in running.values())
+                for step_ in list(waiting):
+                    if any(a in pending for a in step_.after):
+                        continue
+                    if all(r in finished for r in step_.requires):
+                        waiting.remove(step_)
+                        running[executor.submit(execute, step_)] = step_
+                    elif any(status.get(r) in ("error", "skipped") for r in step_.requires):
+                        waiting.remove(step_)
+                        pending.discard(step_.name)
+                        status[step_.name] = "skipped"
+                        changed = True
+
+            if len(running) == 0:
+                # The remaining steps require steps that are not being run,
+                # or are ordered after each other
+                blocked = [s for s in waiting if not all(r in finished for r in s.requires)]
+                for step_ in blocked or list(waiting):
+                    missing = [r for r in step_.requires + step_.after if r not in finished]
+                    log.error("Skipping {}, requirements not finished: {}".format(step_.name, ", ".join(missing)))
+                    waiting.remove(step_)
+                    status[step_.name] = "skipped"
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                status[running.pop(future).name] = future.result()
+
+    for name, result in status.items():
+        if result == "skipped":
+            boot_timeline.record({"script": script, "step": name, "event": "skipped"})
+    return status
+
+def successful(status):
+    """Determine if all of the steps finished
+
+    Args:
+        status (dict) : Result of run()
+
+    Returns:
+        (bool) : If every step has a status of 'ok' or 'done'
+    """
+    return all(s in ("ok", "done") for s in status.values())
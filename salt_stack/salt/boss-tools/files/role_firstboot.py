@@ -0,0 +1,50 @@
+#!/usr/local/bin/python3
+
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+### BEGIN INIT INFO
+# Provides: role-firstboot
+# Required-Start:
+# Required-Stop:
+# Default-Start: 2 3 4 5
+# Default-Stop:
+# Short-Description: Role specific firstboot script
+# Description: Firstboot service script that runs the role specific firstboot
+#               steps installed in /etc/boss/firstboot.d, running independent
+#               steps at the same time.
+#
+### END INIT INFO
+
+import bossutils
+import boot_timeline
+import firstboot_runner
+
+bossutils.utils.set_excepthook()
+logging = bossutils.logger.BossLogger().logger
+
+SCRIPT = "role-firstboot"
+
+if __name__ == '__main__':
+    firstboot_runner.load()
+    status = firstboot_runner.run(SCRIPT)
+    for name in sorted(status):
+        logging.info("{}: {}".format(name, status[name]))
+    boot_timeline.publish(SCRIPT, bossutils.configuration.BossConfig()["system"]["fqdn"])
+
+    # Since the service is to be run once, disable it
+    # If a step failed the service is left enabled, so that the failed steps
+    # are retried on the next boot
+    if firstboot_runner.successful(status):
+        bossutils.utils.stop_firstboot()
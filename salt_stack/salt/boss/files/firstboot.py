@@ -1,5 +1,3 @@
-#!/usr/local/bin/python3
-
 # Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -14,61 +12,140 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-### BEGIN INIT INFO
-# Provides: boss-firstboot
-# Required-Start:
-# Required-Stop:
-# Default-Start: 2 3 4 5
-# Default-Stop:
-# Short-Description: boss Python library firstboot script
-# Description: Firstboot service script that configures the BOSS Django install
-#               to work correctly.
-#
-### END INIT INFO
+"""BOSS Django firstboot steps, run by the role-firstboot script from
+/etc/boss/firstboot.d
+
+Configures the BOSS Django install to work correctly. All of the management
+commands are run in the role-firstboot process, so Django and the BOSS apps
+are only loaded once, and collectstatic runs at the same time as the
+migrations.
+"""
+
+import os
+import re
+import sys
 
 import bossutils
+import firstboot_runner
 
-bossutils.utils.set_excepthook()
 logging = bossutils.logger.BossLogger().logger
 
+DJANGO_ROOT = "/srv/www/django"
+
+# Apps to run makemigrations for, None for all apps
+MAKEMIGRATIONS_APPS = [None, "bosscore", "bossoidc", "bossingest", "bossmeta", "mgmt"]
+
+# Shared between the 'get migrations' and 'put migrations' steps
+migration_manager = bossutils.migration_manager.MigrationManager()
+
+# The working directory and import path are process wide, so they are set
+# when the steps are loaded, before firstboot_runner.run() starts running
+# steps at the same time, instead of from within the 'django setup' step
+if os.path.isdir(DJANGO_ROOT):
+    os.chdir(DJANGO_ROOT)
+    sys.path.insert(0, DJANGO_ROOT)
+
 
-def django_initialize():
+@firstboot_runner.step("get migrations", requires=["download config"])
+def get_migrations():
     logging.info("Get migration settings from S3")
-    mm = bossutils.migration_manager.MigrationManager()
-    migration_success = mm.get_migrations()
-    if not migration_success:
-        logging.info("getting migrations from s3 failed.  Skipping makemigrations, migrate")
-        return False
-    else:
-        logging.info("Finished getting migration settings")
-
-        logging.info("Initializing Django")
-        migrate_cmd = "yes | sudo python3 /srv/www/django/manage.py "
-        bossutils.utils.execute(migrate_cmd + "makemigrations", whole=True, shell=True)
-        bossutils.utils.execute(migrate_cmd + "makemigrations bosscore", whole=True, shell=True)  # will hang if it cannot contact the auth server
-        bossutils.utils.execute(migrate_cmd + "makemigrations bossoidc", whole=True, shell=True)
-        bossutils.utils.execute(migrate_cmd + "makemigrations bossingest", whole=True, shell=True)
-        bossutils.utils.execute(migrate_cmd + "makemigrations bossmeta", whole=True, shell=True)
-        bossutils.utils.execute(migrate_cmd + "makemigrations mgmt", whole=True, shell=True)
-        bossutils.utils.execute(migrate_cmd + "migrate", whole=True, shell=True)
-        bossutils.utils.execute(migrate_cmd + "collectstatic --no-input", whole=True, shell=True)
-
-        bossutils.utils.execute("sudo service uwsgi-emperor reload")
-        bossutils.utils.execute("sudo service nginx restart")
-        logging.info("Finished Initializing Django")
-
-        logging.info("Put migration settings in S3")
-        migration_put_success = mm.put_migrations()
-        if not migration_put_success:
-            logging.error(
-                "At least one migration failed when putting them in s3.")
-        else:
-            logging.info("Migrations")
-        return True
-
-if __name__ == '__main__':
-    sucessful_initialization = django_initialize()
-
-    # Since the service is to be run once, disable it
-    if sucessful_initialization:
-        bossutils.utils.stop_firstboot()
+    if not migration_manager.get_migrations():
+        raise Exception("Getting migrations from S3 failed")
+
+
+@firstboot_runner.step("django setup", requires=["download config", "ndingest settings"], once=False)
+def setup_django():
+    """Load the BOSS Django project into this process, using the same settings
+    module as manage.py"""
+    with open(os.path.join(DJANGO_ROOT, "manage.py")) as fh:
+        match = re.search(r"""DJANGO_SETTINGS_MODULE["']\s*,\s*["']([\w.]+)["']""", fh.read())
+    if match is None:
+        raise Exception("Could not find the DJANGO_SETTINGS_MODULE in manage.py")
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", match.group(1))
+
+    import django
+    django.setup()
+
+
+def management_command(*args):
+    """Create a step function that runs the given Django management command
+
+    Management commands can call sys.exit() on errors, which is turned into an
+    exception so that it doesn't end the firstboot script.
+    """
+    def run():
+        from django.core.management import call_command
+        try:
+            call_command(*args, interactive=False)
+        except SystemExit as ex:
+            raise Exception("{} exited with status {}".format(" ".join(args), ex.code))
+    return run
+
+
+def agreeing_questioner():
+    """Create a migration questioner that answers yes to the questions
+    makemigrations asks
+
+    makemigrations used to be run with 'yes' piped into it. The default
+    non-interactive questioner answers no to "Did you rename X to Y?", which
+    turns a renamed field or model into a drop and an add, losing the data
+    when the migration is applied. This questioner keeps the old answers.
+    """
+    from django.db.migrations.questioner import NonInteractiveMigrationQuestioner
+
+    class AgreeingQuestioner(NonInteractiveMigrationQuestioner):
+        def ask_rename(self, model_name, old_name, new_name, field_instance):
+            return True
+
+        def ask_rename_model(self, old_model_state, new_model_state):
+            return True
+
+        def ask_merge(self, app_label):
+            return True
+
+    return AgreeingQuestioner
+
+# makemigrations bosscore will hang if it cannot contact the auth server,
+# so it also requires the DNS search domain
+@firstboot_runner.step("makemigrations", requires=["django setup", "get migrations", "resolvconf"])
+def make_migrations():
+    """Run makemigrations for each app, logging any failures and continuing
+    with the next app"""
+    # The makemigrations command creates its own non-interactive questioner,
+    # so the class it uses is replaced while the commands run
+    from django.core.management.commands import makemigrations
+    default = makemigrations.NonInteractiveMigrationQuestioner
+    makemigrations.NonInteractiveMigrationQuestioner = agreeing_questioner()
+    try:
+        for app in MAKEMIGRATIONS_APPS:
+            args = [] if app is None else [app]
+            try:
+                management_command("makemigrations", *args)()
+            except Exception:
+                logging.exception(" ".join(["makemigrations"] + args) + " failed")
+    finally:
+        makemigrations.NonInteractiveMigrationQuestioner = default
+
+
+# The failure of one command doesn't stop the following commands from running,
+# the commands only need to run in order
+firstboot_runner.step("migrate", requires=["django setup", "get migrations"], after=["makemigrations"])(management_command("migrate"))
+firstboot_runner.step("collectstatic", requires=["django setup"])(management_command("collectstatic"))
+
+
+@firstboot_runner.step("uwsgi-emperor reload", requires=["get migrations"], after=["migrate", "collectstatic"])
+def reload_uwsgi():
+    bossutils.utils.execute("sudo service uwsgi-emperor reload")
+
+
+@firstboot_runner.step("nginx restart", requires=["get migrations"], after=["uwsgi-emperor reload"])
+def restart_nginx():
+    bossutils.utils.execute("sudo service nginx restart")
+
+
+@firstboot_runner.step("put migrations", requires=["get migrations"], after=["migrate"])
+def put_migrations():
+    logging.info("Put migration settings in S3")
+    if not migration_manager.put_migrations():
+        logging.error("At least one migration failed when putting them in s3.")
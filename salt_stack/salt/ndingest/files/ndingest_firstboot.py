@@ -1,5 +1,3 @@
-#!/usr/local/bin/python3
-
 # Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -14,32 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-### BEGIN INIT INFO
-# Provides: firstboot-ndingest
-# Required-Start:
-# Required-Stop:
-# Default-Start: 2 3 4 5
-# Default-Stop:
-# Short-Description: boss Python library firstboot script
-# Description: Firstboot service script that configures the ndingest to populate
-#               the ndingest.ini with the correct settings
-#
-### END INIT INFO
+"""ndingest firstboot step, run by the role-firstboot script from
+/etc/boss/firstboot.d"""
 
 import bossutils
+import firstboot_runner
 
-bossutils.utils.set_excepthook()
 logging = bossutils.logger.BossLogger().logger
 
+@firstboot_runner.step("ndingest settings", requires=["download config"])
 def ndingest_initialize():
     logging.info("Create settings.ini for ndingest")
     bossutils.utils.execute("sudo python3 /srv/salt/ndingest/build_settings.py")
     logging.info("Finished creating settings.ini")
 
-
-if __name__ == '__main__':
-    ndingest_initialize()
-
-
-    # Since the service is to be run once, disable it
-    bossutils.utils.stop_firstboot()
\ No newline at end of file
@@ -1,5 +1,3 @@
-#!/usr/local/bin/python3
-
 # Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -14,24 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-### BEGIN INIT INFO
-# Provides: scalyr-firstboot
-# Required-Start:
-# Required-Stop:
-# Default-Start: 2 3 4 5
-# Default-Stop:
-# Short-Description: Scalyr firstboot script
-# Description: Firstboot service script that runs the initial Scalyr configuration commands.
-#
-### END INIT INFO
+"""Scalyr firstboot step, run by the role-firstboot script from
+/etc/boss/firstboot.d"""
 
-# Setup the exception hook to log errors thrown during execution
 import os
 import bossutils
+import firstboot_runner
 
-bossutils.utils.set_excepthook()
 logging = bossutils.logger.BossLogger().logger
 
+# Only needs the FQDN from the config, not the hostname or Django to be setup
+@firstboot_runner.step("scalyr host", requires=["download config"])
 def configure_scalyr():
     """
     Creates a new config file in /etc/scalyr-agent-2/agent.d that sets the
@@ -53,9 +44,3 @@ def configure_scalyr():
         logging.error(
             "Setting host name for Scalyr failed. {} not found.".format(file))
 
-
-if __name__ == '__main__':
-    configure_scalyr()
-
-    # Since the service is to be run once, disable it
-    bossutils.utils.stop_firstboot()
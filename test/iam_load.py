@@ -1,19 +1,279 @@
 #!/usr/bin/env python3
 
+"""A benchmark of Vault's issuing of dynamic AWS IAM credentials.
+
+Credentials are requested from Vault by multiple workers at the same time,
+either a fixed number of credentials or as many as possible for a fixed
+duration. Each credential is then used to make an IAM call, retrying until
+IAM accepts the new credential, to measure how long it takes before the
+credential can be used.
+
+The issuance and first use latency percentiles, the number of calls that
+failed because of IAM eventual consistency, and the number of errors are
+printed and can be saved as JSON.
+
+Vault is reached either through the bastion of the given domain or directly,
+such as a local Vault dev server, if --vault-url is given. When using a dev
+server the AWS secret backend is mounted and configured with the AWS
+credentials.
+
+Environmental Variables:
+    AWS_CREDENTIALS : File path to a JSON encode file containing the following keys
+                      "aws_access_key" and "aws_secret_key"
+    SSH_KEY : File path to a SSH private key
+    VAULT_TOKEN : Vault token to use with --vault-url
+"""
+
 import argparse
 import os
 import sys
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import hvac
+from botocore.exceptions import ClientError
 
 import alter_path
 from lib import aws
-from lib.vault import Vault
+from lib.telemetry import percentile
+from lib.vault import Vault, VAULT_TOKEN
 from lib.ssh import vault_tunnel
 
+ROLE = 'ingest-loadtest'
+
+# IAM errors caused by a new credential not being visible to IAM yet
+CONSISTENCY_ERRORS = ('InvalidClientTokenId', 'AccessDenied', 'SignatureDoesNotMatch')
+
+def summarize(values):
+    """Summarize a list of latencies
+
+    Args:
+        values (list) : List of latencies in seconds
+
+    Returns:
+        (dict) : Dict of count, mean, p50, p95, p99, and max latencies
+    """
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': percentile(values, 100),
+    }
+
+def first_use(cred, timeout):
+    """Use a new credential, retrying until IAM accepts it
+
+    Args:
+        cred (dict) : Vault AWS credential
+        timeout (int) : Number of seconds to keep retrying
+
+    Returns:
+        (int) : Number of calls rejected because of IAM eventual consistency
+
+    Raises:
+        ClientError : If the credential was not accepted before the timeout or
+                      if there was a different error
+    """
+    client = aws.create_session({'aws_access_key': cred['access_key'],
+                                 'aws_secret_key': cred['secret_key']}).client('iam')
+    expire = time.time() + timeout
+    delay = 0.25
+    retries = 0
+    while True:
+        try:
+            client.list_users(MaxItems=1)
+            return retries
+        except ClientError as ex:
+            if ex.response['Error']['Code'] not in CONSISTENCY_ERRORS or time.time() >= expire:
+                raise
+            retries += 1
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+def benchmark(make_client, concurrency, load=None, duration=None, use=True, consistency_timeout=60):
+    """Request credentials from Vault using multiple workers
+
+    Args:
+        make_client (function) : Function that creates a new authenticated hvac.Client
+        concurrency (int) : Number of workers requesting credentials at the same time
+        load (None|int) : Total number of credentials to request
+        duration (None|int) : Number of seconds to request credentials for
+        use (bool) : If each credential should be used after it is issued
+        consistency_timeout (int) : Seconds to wait for IAM to accept a new credential
+
+    Returns:
+        (dict) : Benchmark results
+    """
+    lock = threading.Lock()
+    issued = []
+    used = []
+    consistency = {'retries': 0, 'failures': 0}
+    errors = []
+    remaining = [load]
+
+    def next_request():
+        with lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+        return deadline is None or time.time() < deadline
+
+    def worker():
+        client = make_client() # one connection per worker, like separate ingest clients
+        while next_request():
+            start = time.time()
+            try:
+                cred = client.read('aws/creds/' + ROLE)['data']
+            except Exception as ex:
+                with lock:
+                    errors.append("issue: {}".format(ex))
+                continue
+            issue_time = time.time()
+
+            with lock:
+                issued.append(issue_time - start)
+
+            if use:
+                try:
+                    retries = first_use(cred, consistency_timeout)
+                    with lock:
+                        used.append(time.time() - issue_time)
+                        consistency['retries'] += retries
+                except ClientError as ex:
+                    with lock:
+                        if ex.response['Error']['Code'] in CONSISTENCY_ERRORS:
+                            consistency['failures'] += 1
+                        errors.append("use: {}".format(ex))
+
+    start = time.time()
+    deadline = start + duration if duration else None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for i in range(concurrency)]:
+            future.result()
+    elapsed = time.time() - start
+
+    return {
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'throughput': len(issued) / elapsed if elapsed > 0 else None,
+        'issuance': summarize(issued),
+        'first_use': summarize(used) if use else None,
+        'consistency_retries': consistency['retries'],
+        'consistency_failures': consistency['failures'],
+        'errors': len(errors),
+        'error_samples': errors[:10],
+    }
+
+def print_results(results):
+    fmt = lambda s: "-" if s is None else "{:.3f}s".format(s)
+
+    print("Issued {} credentials in {:.1f}s ({:.1f}/s) with {} workers".format(
+            results['issuance']['count'], results['elapsed'],
+            results['throughput'] or 0, results['concurrency']))
+    print("{:<12}{:>10}{:>10}{:>10}{:>10}".format("", "p50", "p95", "p99", "max"))
+    for name in ('issuance', 'first_use'):
+        stats = results[name]
+        if stats is not None:
+            print("{:<12}{:>10}{:>10}{:>10}{:>10}".format(name,
+                    fmt(stats['p50']), fmt(stats['p95']), fmt(stats['p99']), fmt(stats['max'])))
+    print("IAM eventual consistency: {} retries, {} credentials never accepted".format(
+            results['consistency_retries'], results['consistency_failures']))
+    print("Errors: {}".format(results['errors']))
+    for error in results['error_samples']:
+        print("\t{}".format(error))
+
+def run(args, session, make_client):
+    """Create the IAM policy and Vault role, run the benchmark, and clean up"""
+    iam = session.resource('iam')
+    client = session.client('iam')
+    domain = args.domain.replace('.', '-')
+    vault = make_client()
+
+    print("Creating IAM policy")
+    policy = iam.create_policy(
+        PolicyName = '{}-ingest_client-loadtest'.format(domain),
+        PolicyDocument = json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Action": [
+                        "iam:ListUsers"
+                    ],
+                    "Resource": [
+                        "*"
+                    ]
+                }
+            ]
+        }),
+        Path = '/{}/ingest/'.format(domain),
+        Description = 'Vault IAM load test'
+    )
+    print("\tcomplete")
+
+    try:
+        print("Creating Vault AWS role")
+        vault.write('aws/roles/' + ROLE, arn = policy.arn)
+        print("\tcomplete")
+
+        try:
+            print("Starting test")
+            results = benchmark(make_client,
+                                args.concurrency,
+                                load = None if args.duration else args.load,
+                                duration = args.duration,
+                                use = not args.no_use,
+                                consistency_timeout = args.consistency_timeout)
+            print("\tcomplete")
+            return results
+        finally:
+            try:
+                vault.revoke_secret_prefix('aws/creds/' + ROLE)
+            except Exception as ex:
+                print(ex)
+
+            try:
+                vault.delete('aws/roles/' + ROLE)
+            except Exception as ex:
+                print(ex)
+    finally:
+        attached = client.list_entities_for_policy(
+            PolicyArn = policy.arn,
+            EntityFilter = 'User'
+        )['PolicyUsers']
+
+        if len(attached) > 0:
+            print("Still have attached users")
+            for a in attached:
+                try:
+                    client.detach_user_policy(UserName = a['UserName'],
+                                              PolicyArn = policy.arn)
+                    for key in client.list_access_keys(UserName = a['UserName'])['AccessKeyMetadata']:
+                        client.delete_access_key(UserName = a['UserName'],
+                                                 AccessKeyId = key['AccessKeyId'])
+                    client.delete_user(UserName = a['UserName'])
+                except Exception as ex:
+                    print("{}: {}".format(a['UserName'], ex))
+
+        policy.delete()
+
+def configure_dev_server(client, credentials):
+    """Mount and configure the AWS secret backend of a Vault dev server"""
+    try:
+        client.enable_secret_backend('aws')
+    except hvac.exceptions.InvalidRequest:
+        pass # already mounted
+    client.write('aws/config/root', access_key = credentials['aws_access_key'],
+                                    secret_key = credentials['aws_secret_key'],
+                                    region = credentials.get('aws_region', 'us-east-1'))
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description = "Script to load test create a large number of IAM credentials using Vault")
+    parser = argparse.ArgumentParser(description = "Script to benchmark creating a large number of IAM credentials using Vault")
 
     parser.add_argument("--aws-credentials", "-a",
                         metavar = "<file>",
@@ -27,7 +287,35 @@ if __name__ == '__main__':
     parser.add_argument("--load", "-l",
                         metavar = "<load>",
                         default = 50,
-                        help = "How many credentials to request from Vault")
+                        type = int,
+                        help = "How many credentials to request from Vault (default: 50)")
+    parser.add_argument("--duration", "-d",
+                        metavar = "<seconds>",
+                        type = int,
+                        help = "Request credentials for this many seconds instead of a fixed --load")
+    parser.add_argument("--concurrency", "-c",
+                        metavar = "<workers>",
+                        default = 10,
+                        type = int,
+                        help = "How many credentials to request at the same time (default: 10)")
+    parser.add_argument("--no-use",
+                        action = "store_true",
+                        help = "Don't use each credential after it is issued")
+    parser.add_argument("--consistency-timeout",
+                        metavar = "<seconds>",
+                        default = 60,
+                        type = int,
+                        help = "How long to wait for IAM to accept a new credential (default: 60)")
+    parser.add_argument("--output", "-o",
+                        metavar = "<file>",
+                        help = "Save the results as JSON to the given file")
+    parser.add_argument("--vault-url",
+                        metavar = "<url>",
+                        help = "Connect directly to Vault, such as a local dev server, instead of through the bastion")
+    parser.add_argument("--vault-token",
+                        metavar = "<token>",
+                        default = os.environ.get("VAULT_TOKEN"),
+                        help = "Token to use with --vault-url (default: VAULT_TOKEN)")
     parser.add_argument("domain",
                         metavar = "domain",
                         help = "Domain to target")
@@ -39,107 +327,36 @@ if __name__ == '__main__':
         print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
         sys.exit(1)
 
-    if args.ssh_key is None:
-        parser.print_usage()
-        print("Error: SSH key not provided and SSH_KEY is not defined")
-        sys.exit(1)
-
-    session = aws.create_session(args.aws_credentials)
-    bastion = aws.machine_lookup(session, 'bastion.' + args.domain)
-    iam = session.resource('iam')
-    client = session.client('iam')
+    credentials = json.load(args.aws_credentials)
+    session = aws.create_session(credentials)
 
-    domain = args.domain.replace('.', '-')
+    if args.vault_url:
+        if args.vault_token is None:
+            parser.print_usage()
+            print("Error: Vault token not provided and VAULT_TOKEN is not defined")
+            sys.exit(1)
 
-    print("Opening ssh tunnel")
-    with vault_tunnel(args.ssh_key, bastion):
-        print("\tcomplete")
+        make_client = lambda: hvac.Client(url = args.vault_url, token = args.vault_token)
+        configure_dev_server(make_client(), credentials)
+        results = run(args, session, make_client)
+    else:
+        if args.ssh_key is None:
+            parser.print_usage()
+            print("Error: SSH key not provided and SSH_KEY is not defined")
+            sys.exit(1)
 
-        v = Vault('vault.' + args.domain)
-
-        #while True:
-        #    try:
-        #        v.revoke_secret_prefix('aws/creds/ingest-loadtest')
-        #    except Exception as ex:
-        #        print(ex)
-        #
-        #    time.sleep(10)
-        #sys.exit(0)
-
-        print("Creating IAM policy")
-        policy = iam.create_policy(
-            PolicyName = '{}-ingest_client-loadtest'.format(domain),
-            PolicyDocument = json.dumps({
-                "Version": "2012-10-17",
-                "Statement": [
-                    {
-                        "Effect": "Allow",
-                        "Action": [
-                            "iam:ListUsers"
-                        ],
-                        "Resource": [
-                            "*"
-                        ]
-                    }
-                ]
-            }),
-            Path = '/{}/ingest/'.format(domain),
-            Description = 'Vault IAM load test'
-        )
-        print("\tcomplete")
+        bastion = aws.machine_lookup(session, 'bastion.' + args.domain)
 
-        try:
-            print("Creating Vault AWS role")
-            v.write('aws/roles/ingest-loadtest', arn = policy.arn)
+        print("Opening ssh tunnel")
+        with vault_tunnel(args.ssh_key, bastion) as port:
             print("\tcomplete")
 
-            try:
-                print("Starting test")
-                creds = []
-                for i in range(int(args.load)):
-                    cred = v.read('aws/creds/ingest-loadtest')['data']
-                    print(cred)
-                    creds.append(cred)
-
-                time.sleep(10)
-
-                for cred in creds:
-                    try:
-                        c = aws.create_session({'aws_access_key': cred['access_key'],
-                                                'aws_secret_key': cred['secret_key']}).client('iam')
-                        c.list_users()
-                    except Exception as ex:
-                        print(ex)
-
-                print("\tcomplete")
-            finally:
-                try:
-                    v.revoke_secret_prefix('aws/creds/ingest-loadtest')
-                except Exception as ex:
-                    print(ex)
+            v = Vault('vault.' + args.domain, proxy=port)
+            token = v.connect(VAULT_TOKEN).token
+            make_client = lambda: hvac.Client(url = v.url, token = token, proxies = v.proxy)
+            results = run(args, session, make_client)
 
-                try:
-                    v.delete('aws/roles/ingest-loadtest')
-                except Exception as ex:
-                    print(ex)
-        finally:
-            attached = client.list_entities_for_policy(
-                PolicyArn = policy.arn,
-                EntityFilter = 'User'
-            )['PolicyUsers']
-
-            if len(attached) > 0:
-                print("Still have attached users")
-                for a in attached:
-                    try:
-                        client.detach_user_policy(UserName = a['UserName'],
-                                                  PolicyArn = policy.arn)
-                        for key in client.list_access_keys(UserName = a['UserName'])['AccessKeyMetadata']:
-                            client.delete_access_key(UserName = a['UserName'],
-                                                     AccessKeyId = key['AccessKeyId'])
-                        client.delete_user(UserName = a['UserName'])
-                    except Exception as ex:
-                        print("{}: {}".format(a['UserName'], ex))
-
-            policy.delete()
-            
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=3, sort_keys=True)